@@ -0,0 +1,205 @@
+"""Offline simulator for the CPU alarm scaling policy in create_asg.py.
+
+Replays a load trace through the same semantics the scale-out/scale-in
+alarms configure (average CPU over `Period`, breached for
+`EvaluationPeriods` consecutive periods, one instance added or removed per
+alarm within MinSize..MaxSize) for many policy combinations at once. Every
+policy is a column of the state arrays, so a sweep over thousands of
+combinations costs one pass over the trace.
+
+Run directly for a sweep over a synthetic day of traffic:
+    python autoscaling_simulator.py
+"""
+import time
+
+import numpy as np
+
+# The policy create_asg.py deploys today
+CURRENT_POLICY = {
+    'high_threshold': 70.0,
+    'low_threshold': 30.0,
+    'period': 300,
+    'evaluation_periods': 1,
+    'min_size': 1,
+    'max_size': 3,
+}
+
+# Requests per second one instance serves at 100% CPU
+CAPACITY_PER_INSTANCE = 500.0
+# Seconds from launch until a new instance serves traffic (boot + user data)
+WARMUP = 180
+# HealthCheckGracePeriod of the group: new instances are left out of the metric until it passes
+HEALTH_CHECK_GRACE_PERIOD = 300
+# Seconds after a scaling activity during which further alarms are ignored
+COOLDOWN = 300
+# A step violates the SLO when serving instances run above this CPU
+SLO_CPU = 90.0
+
+
+def synthetic_trace(hours=24, step=60, base=300.0, peak=1500.0, spikes=4, noise=0.1, seed=0):
+    """Requests per second for a day-shaped load with a few sharp spikes"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(hours * 3600 / step)) * step
+    # Daily cycle peaking in the afternoon
+    load = base + (peak - base) * 0.5 * (1 - np.cos(2 * np.pi * (t / 86400.0 - 0.1)))
+    for start in rng.integers(0, len(t), spikes):
+        width = int(rng.integers(5, 30))
+        load[start:start + width] *= rng.uniform(1.5, 2.5)
+    load *= 1 + noise * rng.standard_normal(len(t))
+    return np.clip(load, 0, None)
+
+
+def cpu_to_load(cpu, instances, capacity_per_instance=CAPACITY_PER_INSTANCE):
+    """Convert a recorded per-instance CPU trace (and the instance count behind it) into requests per second"""
+    return np.asarray(cpu, dtype=float) / 100.0 * np.asarray(instances, dtype=float) * capacity_per_instance
+
+
+def policy_grid(**values):
+    """Return every combination of the given policy values as a dict of equal-length arrays.
+
+    Keys not given take their value from CURRENT_POLICY, e.g.
+    policy_grid(high_threshold=range(50, 95, 5), max_size=[3, 5, 8]).
+    """
+    params = {key: np.atleast_1d(values.get(key, default)) for key, default in CURRENT_POLICY.items()}
+    mesh = np.meshgrid(*params.values(), indexing='ij')
+    grid = {key: axis.ravel() for key, axis in zip(params, mesh)}
+    # Combinations where scale-in would trigger above scale-out are meaningless
+    valid = (grid['low_threshold'] < grid['high_threshold']) & (grid['min_size'] <= grid['max_size'])
+    return {key: column[valid] for key, column in grid.items()}
+
+
+def simulate(load, policies, step=60, capacity_per_instance=CAPACITY_PER_INSTANCE, warmup=WARMUP,
+             grace=HEALTH_CHECK_GRACE_PERIOD, cooldown=COOLDOWN, slo_cpu=SLO_CPU, record_capacity=False):
+    """Replay a load trace (requests per second, one value per `step` seconds) through every policy.
+
+    `policies` is a dict of equal-length arrays as returned by policy_grid.
+    Returns a dict of per-policy arrays: 'instance_hours', 'slo_violation_minutes',
+    'dropped_fraction', 'scale_outs', 'scale_ins' and, with record_capacity,
+    'capacity' of shape (steps, policies) with the serving instances over time.
+    """
+    load = np.asarray(load, dtype=float)
+    steps = len(load)
+    n = len(policies['high_threshold'])
+    high = np.asarray(policies['high_threshold'], dtype=float)
+    low = np.asarray(policies['low_threshold'], dtype=float)
+    period_steps = np.maximum(1, np.asarray(policies['period']) // step).astype(int)
+    evaluation_periods = np.asarray(policies['evaluation_periods'], dtype=int)
+    min_size = np.asarray(policies['min_size'], dtype=int)
+    max_size = np.asarray(policies['max_size'], dtype=int)
+
+    warmup_steps = max(1, int(np.ceil(warmup / step)))
+    grace_steps = max(warmup_steps, int(np.ceil(grace / step)))
+    cooldown_steps = int(np.ceil(cooldown / step))
+
+    # Cumulative launches per policy, so "launched in the last k steps" is one subtraction.
+    # Only the last grace period is ever looked at, keep it in a ring buffer.
+    window = grace_steps + 1
+    history = np.zeros((window, n), dtype=int)
+
+    def launched(k):
+        return history[max(0, k) % window]
+
+    ready = min_size.copy()
+    cpu_sum = np.zeros(n)
+    samples = np.zeros(n, dtype=int)
+    high_breaches = np.zeros(n, dtype=int)
+    low_breaches = np.zeros(n, dtype=int)
+    last_activity = np.full(n, -cooldown_steps)
+
+    instance_steps = np.zeros(n)
+    violation_steps = np.zeros(n, dtype=int)
+    dropped = np.zeros(n)
+    scale_outs = np.zeros(n, dtype=int)
+    scale_ins = np.zeros(n, dtype=int)
+    capacity = np.zeros((steps, n), dtype=int) if record_capacity else None
+
+    for t in range(steps):
+        # Instances launched `warmup` ago start serving traffic
+        if t >= warmup_steps:
+            ready += launched(t - warmup_steps + 1) - launched(t - warmup_steps)
+        pending = launched(t) - launched(t - warmup_steps + 1)
+        in_grace = launched(t - warmup_steps + 1) - launched(t - grace_steps + 1)
+
+        serving_capacity = np.maximum(ready, 0) * capacity_per_instance
+        cpu = np.where(serving_capacity > 0, 100.0 * load[t] / np.maximum(serving_capacity, 1e-9), 100.0)
+        violation_steps += cpu > slo_cpu
+        dropped += np.maximum(0.0, load[t] - serving_capacity)
+        instance_steps += ready + pending
+        if record_capacity:
+            capacity[t] = ready
+
+        # The alarm metric averages CPU over the instances past their grace period
+        counted = np.maximum(ready - in_grace, 0)
+        cpu_sum += np.where(counted > 0, np.minimum(cpu, 100.0), 0.0)
+        samples += counted > 0
+        evaluate = (t + 1) % period_steps == 0
+        average = np.where(samples > 0, cpu_sum / np.maximum(samples, 1), 0.0)
+        high_breaches = np.where(evaluate, np.where(average > high, high_breaches + 1, 0), high_breaches)
+        low_breaches = np.where(evaluate, np.where((samples > 0) & (average < low), low_breaches + 1, 0), low_breaches)
+        cpu_sum = np.where(evaluate, 0.0, cpu_sum)
+        samples = np.where(evaluate, 0, samples)
+
+        # Alarms in ALARM state trigger one scaling activity, outside of the cooldown
+        idle = t - last_activity >= cooldown_steps
+        desired = ready + pending
+        scale_out = evaluate & idle & (high_breaches >= evaluation_periods) & (desired < max_size)
+        scale_in = evaluate & idle & ~scale_out & (low_breaches >= evaluation_periods) & (desired > min_size) & (ready > 0)
+        history[(t + 1) % window] = launched(t) + scale_out
+        ready -= scale_in
+        last_activity = np.where(scale_out | scale_in, t, last_activity)
+        scale_outs += scale_out
+        scale_ins += scale_in
+
+    result = {
+        'instance_hours': instance_steps * step / 3600.0,
+        'slo_violation_minutes': violation_steps * step / 60.0,
+        'dropped_fraction': dropped / max(load.sum(), 1e-9),
+        'scale_outs': scale_outs,
+        'scale_ins': scale_ins,
+    }
+    if record_capacity:
+        result['capacity'] = capacity
+    return result
+
+
+def best_policies(policies, result, top=5, max_violation_minutes=0.0):
+    """Indices of the cheapest policies that stay within the SLO violation budget"""
+    ok = np.flatnonzero(result['slo_violation_minutes'] <= max_violation_minutes)
+    if not len(ok):
+        # Nothing meets the budget: rank by violations first, then by cost
+        return np.lexsort((result['instance_hours'], result['slo_violation_minutes']))[:top]
+    return ok[np.argsort(result['instance_hours'][ok])][:top]
+
+
+def describe(policies, result, i):
+    policy = ', '.join(f"{key}={policies[key][i]:g}" for key in CURRENT_POLICY)
+    return (f"{policy}: {result['instance_hours'][i]:.1f} instance-hours, "
+            f"{result['slo_violation_minutes'][i]:.0f} min above {SLO_CPU:.0f}% CPU, "
+            f"{100 * result['dropped_fraction'][i]:.2f}% requests dropped, "
+            f"{result['scale_outs'][i]} scale-outs / {result['scale_ins'][i]} scale-ins")
+
+
+if __name__ == '__main__':
+    load = synthetic_trace()
+
+    current = policy_grid()
+    print("Current policy:")
+    print("  " + describe(current, simulate(load, current), 0))
+
+    policies = policy_grid(
+        high_threshold=np.arange(40, 95, 5),
+        low_threshold=np.arange(10, 60, 5),
+        period=[60, 120, 300, 600],
+        evaluation_periods=[1, 2, 3],
+        min_size=[1, 2, 3],
+        max_size=[3, 5, 8, 12],
+    )
+    start = time.perf_counter()
+    result = simulate(load, policies)
+    elapsed = time.perf_counter() - start
+    print(f"Simulated {len(policies['high_threshold'])} policies over {len(load)} steps in {elapsed:.2f}s")
+
+    budget = np.percentile(result['slo_violation_minutes'], 5)
+    print(f"Cheapest policies with at most {budget:.0f} min above {SLO_CPU:.0f}% CPU:")
+    for i in best_policies(policies, result, max_violation_minutes=budget):
+        print("  " + describe(policies, result, i))
@@ -0,0 +1,144 @@
+import logging
+import threading
+
+from instrumentation import tracer
+from rate_limiter import rate_limiter
+
+# Clients are created on first use and kept for the life of the process, so a
+# warm Lambda invocation reuses them and a cold start only pays for the
+# services the requested action actually touches. All clients of a region
+# (and credentials profile) share one session and the connection pool
+# settings below.
+MAX_POOL_CONNECTIONS = 50
+
+_sessions = {}
+_clients = {}
+_resources = threading.local()
+_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'clients_created': 0, 'connections_opened': 0}
+
+
+def client_config():
+    """botocore config shared by every client: a larger connection pool with TCP keep-alive"""
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=5,
+        read_timeout=60,
+        # Retries are decided by the shared rate limiter, not by botocore
+        retries={'mode': 'standard', 'total_max_attempts': 1},
+    )
+
+
+def get_session(region_name=None, profile_name=None):
+    """Return the shared boto3 session for a region and profile, creating it on first use"""
+    key = (region_name, profile_name)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                # boto3 itself is imported lazily, it is a large part of the import cost
+                import boto3
+                session = boto3.session.Session(region_name=region_name, profile_name=profile_name)
+                _sessions[key] = session
+    return session
+
+
+def get_client(service_name, region_name=None, profile_name=None):
+    """Return the shared boto3 client for a service, creating it on first use"""
+    key = (service_name, region_name, profile_name)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session(region_name, profile_name)
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                _count_connections()
+                client = session.client(service_name, config=client_config())
+                rate_limiter.register(client)
+                tracer.register(client)
+                _clients[key] = client
+                with _stats_lock:
+                    _stats['clients_created'] += 1
+    return client
+
+
+def get_resource(service_name, region_name=None, profile_name=None):
+    """Return a boto3 resource for a service, cached per thread since resources are not thread-safe"""
+    cache = _resources.__dict__.setdefault('cache', {})
+    key = (service_name, region_name, profile_name)
+    if key not in cache:
+        session = get_session(region_name, profile_name)
+        # Creating from the shared session is not thread-safe, so it happens under the lock like get_client
+        with _lock:
+            _count_connections()
+            resource = session.resource(service_name, config=client_config())
+            rate_limiter.register(resource.meta.client)
+            tracer.register(resource.meta.client)
+        cache[key] = resource
+        with _stats_lock:
+            _stats['clients_created'] += 1
+    return cache[key]
+
+
+def reset_clients():
+    """Drop every cached session and client (used by benchmarks and local stand-ins)"""
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+    _resources.__dict__.pop('cache', None)
+
+
+def reset_stats():
+    """Zero the client and connection counters, e.g. at the start of an invocation"""
+    with _stats_lock:
+        _stats['clients_created'] = 0
+        _stats['connections_opened'] = 0
+
+
+def get_stats():
+    """Return how many clients and HTTP connections were created since the last reset"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+class _ConnectionCounter(logging.Filter):
+    """Count the new connections urllib3 reports, then keep its log output as it was"""
+
+    def __init__(self, passthrough_level):
+        super().__init__()
+        self.passthrough_level = passthrough_level
+
+    def filter(self, record):
+        if record.getMessage().startswith('Starting new HTTP'):
+            with _stats_lock:
+                _stats['connections_opened'] += 1
+        return record.levelno >= self.passthrough_level
+
+
+def _count_connections():
+    # urllib3 logs every new pooled connection at DEBUG level. Lower the logger
+    # level so those records are produced, and let the filter drop whatever
+    # would not have been logged before.
+    logger = logging.getLogger('urllib3.connectionpool')
+    if not any(isinstance(f, _ConnectionCounter) for f in logger.filters):
+        logger.addFilter(_ConnectionCounter(logger.getEffectiveLevel()))
+        logger.setLevel(logging.DEBUG)
+
+
+class LazyClient:
+    """Module-level stand-in for a boto3 client that resolves it on first attribute access"""
+
+    def __init__(self, service_name, region_name=None, profile_name=None):
+        self.service_name = service_name
+        self.region_name = region_name
+        self.profile_name = profile_name
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service_name, self.region_name, self.profile_name), name)
+
+    def __repr__(self):
+        return f"LazyClient({self.service_name!r}, {self.region_name!r})"
@@ -0,0 +1,60 @@
+"""Benchmark the CIDR free-space allocator against the original linear scan.
+
+Builds a synthetic /16 VPC with a few hundred existing subnets and times how
+long each approach takes to find free /26 blocks.
+
+    python benchmark_cidr_allocator.py [existing_subnets] [blocks_wanted]
+"""
+import random
+import sys
+import time
+from ipaddress import IPv4Network
+
+from cidr_allocator import CidrAllocator
+
+
+def linear_scan(vpc_cidr, existing_cidrs, subnet_prefix=26):
+    """The original create_ec2.get_available_cidr_block search, minus the AWS calls"""
+    for subnet in IPv4Network(vpc_cidr).subnets(new_prefix=subnet_prefix):
+        if all(IPv4Network(existing_cidr).overlaps(subnet) is False for existing_cidr in existing_cidrs):
+            return str(subnet)
+    raise ValueError("No available CIDR block found")
+
+
+def synthetic_vpc(existing_subnets, seed=42):
+    """A /16 VPC whose /24s are randomly taken from the lower three quarters"""
+    rng = random.Random(seed)
+    candidates = list(IPv4Network('10.0.0.0/16').subnets(new_prefix=24))[:192]
+    return '10.0.0.0/16', [str(net) for net in rng.sample(candidates, existing_subnets)]
+
+
+def main():
+    existing_subnets = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    blocks_wanted = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    vpc_cidr, existing = synthetic_vpc(existing_subnets)
+    print(f"VPC {vpc_cidr} with {len(existing)} existing subnets, finding {blocks_wanted} free /26 blocks")
+
+    started = time.perf_counter()
+    taken = list(existing)
+    for _ in range(blocks_wanted):
+        taken.append(linear_scan(vpc_cidr, taken))
+    linear = time.perf_counter() - started
+
+    started = time.perf_counter()
+    allocator = CidrAllocator([vpc_cidr], existing)
+    build = time.perf_counter() - started
+    blocks = allocator.allocate_many(26, blocks_wanted)
+    indexed = time.perf_counter() - started
+
+    # Sanity check: nothing handed out overlaps anything else
+    everything = [IPv4Network(cidr) for cidr in existing] + blocks
+    everything.sort()
+    assert all(not a.overlaps(b) for a, b in zip(everything, everything[1:]))
+
+    print(f"linear scan     {linear * 1000:9.1f} ms")
+    print(f"allocator       {indexed * 1000:9.1f} ms (index build {build * 1000:.1f} ms)")
+    print(f"speed-up        {linear / indexed:9.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Compare cold-start cost of eager vs lazy boto3 client creation.
+
+Each scenario runs in a fresh interpreter so import and client setup costs are
+paid from scratch, the same way a Lambda cold start pays them. Every client
+is created through aws_clients, so all scenarios use the same client config.
+
+The clients (and sessions) each action needs are found first by running it
+against moto on a deployed stack; each lazy scenario then imports the
+action's module and creates exactly those clients. Eager creation pays for
+every stack service whatever the action, lazy creation only for what the
+action touches, so the gap shows on actions that use few services.
+
+    python benchmark_cold_start.py [repeats]
+
+Needs moto (pip install moto) to find each action's clients.
+"""
+import contextlib
+import io
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# (label, module, event) of every action measured; the bake is cut short by a tiny time budget
+ACTIONS = [
+    ('teardown', 'create_tear_infra', {'action': 'teardown'}),
+    ('plan', 'create_tear_infra', {'action': 'plan'}),
+    ('update', 'create_tear_infra', {'action': 'update', 'wait': False}),
+    ('bake', 'create_tear_infra', {'action': 'bake'}),
+    ('create_s3 handler', 'create_s3', {}),
+]
+
+
+class ShortContext:
+    """Lambda context with just enough time left for a bake to start and hand over"""
+
+    def get_remaining_time_in_millis(self):
+        import create_tear_infra
+        return (create_tear_infra.bake_time_reserve + 1) * 1000
+
+
+def action_clients():
+    """Return {label: [(service, region, profile)]}: the clients each action creates on a deployed stack"""
+    from moto import mock_aws
+
+    import aws_clients
+    import benchmark_deploy
+    import create_tear_infra
+    from stack_spec import StackSpec
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', benchmark_deploy.REGION)
+    for variable in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ.setdefault(variable, 'testing')
+    found = {}
+    with mock_aws(), contextlib.redirect_stdout(io.StringIO()):
+        aws_clients.reset_clients()
+        spec = StackSpec(name='cold-start', region=benchmark_deploy.REGION,
+                         manifest_uri='/tmp/benchmark_cold_start_manifest.json', **benchmark_deploy.create_network())
+        if os.path.exists(spec.manifest_uri):
+            os.remove(spec.manifest_uri)
+        create_tear_infra.lambda_handler({'action': 'deploy', 'stack': spec.to_dict()}, None)
+        ami_id = aws_clients.get_client('ec2', spec.region).describe_images()['Images'][1]['ImageId']
+        stacks = {
+            'update': dict(spec.to_dict()),
+            'bake': dict(spec.to_dict(), bake_image=True),
+        }
+        for label, module, event in ACTIONS:
+            event = dict(event, stack=stacks.get(label, spec.to_dict()))
+            if label == 'update':
+                event['new_ami_id'] = ami_id
+            # The teardown runs last, every action before it sees the deployed stack
+            for stack in create_tear_infra._stacks.values():
+                stack.drop_snapshot()
+            aws_clients.reset_clients()
+            try:
+                __import__(module).lambda_handler(event, ShortContext() if label == 'bake' else None)
+            except Exception as e:
+                # An action moto cannot finish still shows which clients it needed up to that point
+                print(f"{label}: {e}")
+            found[label] = sorted(aws_clients._clients)
+        aws_clients.reset_clients()
+    order = [label for label, _, _ in ACTIONS if label != 'teardown'] + ['teardown']
+    return {label: found[label] for label in order}
+
+
+def lazy_scenario(module, clients):
+    return (
+        f"import {module}\n"
+        "import aws_clients\n"
+        f"for key in {clients!r}:\n"
+        "    aws_clients.get_client(*key)\n"
+    )
+
+
+def time_scenario(code, repeats):
+    """Run a snippet in fresh interpreters and return the wall times in milliseconds"""
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, env=env,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    import create_tear_infra
+
+    clients_by_action = action_clients()
+    modules = {label: module for label, module, _ in ACTIONS}
+    all_clients = [(service, None, None) for service in create_tear_infra.stack_services]
+    scenarios = [
+        # What create_tear_infra used to do at import time, whatever the action
+        ('eager (at import)', all_clients, "import aws_clients\n"
+                                           f"for key in {all_clients!r}:\n"
+                                           "    aws_clients.get_client(*key)\n"
+                                           "import create_tear_infra\n"),
+        ('lazy, import only', [], "import create_tear_infra\n"),
+    ] + [(f"lazy, {label}", clients, lazy_scenario(modules[label], clients))
+         for label, clients in clients_by_action.items()]
+
+    interpreter_ms = statistics.median(time_scenario("pass\n", repeats))
+    print(f"Interpreter start-up: {interpreter_ms:.0f} ms (subtracted below)")
+    print(f"{'scenario':<28} {'clients':>7} {'sessions':>8} {'median ms':>9} {'min ms':>7}  services")
+    medians = {}
+    for name, clients, code in scenarios:
+        timings = time_scenario(code, repeats)
+        medians[name] = statistics.median(timings) - interpreter_ms
+        sessions = len({(region, profile) for _, region, profile in clients})
+        print(f"{name:<28} {len(clients):>7} {sessions:>8} {medians[name]:>9.0f} {min(timings) - interpreter_ms:>7.0f}  "
+              f"{', '.join(service for service, _, _ in clients) or '-'}")
+
+    eager = medians['eager (at import)']
+    for label in clients_by_action:
+        lazy = medians[f"lazy, {label}"]
+        print(f"{label:<20} lazy vs eager: {lazy - eager:+6.0f} ms ({(lazy - eager) / eager:+.0%})")
+
+
+if __name__ == '__main__':
+    main()
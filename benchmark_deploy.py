@@ -0,0 +1,304 @@
+"""Benchmark the create_tear_infra actions: AWS calls, wall time and peak memory.
+
+Every scenario runs lambda_handler against moto's in-process AWS stand-in,
+with a fixed latency injected before each API call so the wall time
+reflects how many calls sit on the critical path rather than how fast moto
+is. For each stack size it runs deploy, a no-op redeploy, a drifted deploy
+(size and alarm), an update onto a new AMI, an update left running and its
+rollback, a fleet scale-out and teardown. The size sets the ASG's capacity,
+the objects teardown purges from the bucket and the fleet's instances.
+
+moto has no instance refreshes, so a stand-in answers those calls: a
+refresh completes on its second poll and a rollback takes one poll.
+
+Results are compared against a stored baseline; one more call of any
+operation (beyond one extra waiter poll) or a wall-time increase beyond
+the tolerance fails the run.
+
+    python benchmark_deploy.py [--sizes 1,10,50] [--latency-ms 20] [--update-baseline]
+
+Needs moto (pip install moto).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_deploy_baseline.json')
+REGION = 'us-west-2'
+SERVICES = ('ec2', 'elbv2', 'autoscaling', 's3', 'cloudwatch', 'sns', 'resourcegroupstaggingapi')
+
+# Describe calls the shared waiter polls with. How many polls a wait takes depends on
+# how the ticks line up with the injected latency, so these may make one call more in total.
+WAITER_OPERATIONS = (
+    'ec2.DescribeInstances', 'ec2.DescribeImages', 'elbv2.DescribeLoadBalancers', 'elbv2.DescribeTargetHealth',
+    'autoscaling.DescribeAutoScalingGroups', 'autoscaling.DescribeInstanceRefreshes',
+)
+WAITER_CALL_TOLERANCE = 1
+# Allowed wall-time growth before it counts as a regression; every other call count must match exactly
+WALL_TIME_TOLERANCE = 0.25
+# Seconds of wall-time noise tolerated on top of the relative tolerance
+WALL_TIME_SLACK = 0.1
+# Objects put in the stack's bucket before teardown, per unit of stack size
+BUCKET_OBJECTS_PER_SIZE = 20
+
+
+def create_network():
+    """Create the VPC, subnets, security group and key pair the stack expects to exist"""
+    import boto3
+    ec2 = boto3.client('ec2', region_name=REGION)
+    vpc_id = ec2.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+    zones = [zone['ZoneName'] for zone in ec2.describe_availability_zones()['AvailabilityZones']][:2]
+    subnet_ids = [
+        ec2.create_subnet(VpcId=vpc_id, CidrBlock=f'10.0.{i + 1}.0/24', AvailabilityZone=zone)['Subnet']['SubnetId']
+        for i, zone in enumerate(zones)
+    ]
+    security_group_id = ec2.create_security_group(GroupName='web', Description='web', VpcId=vpc_id)['GroupId']
+    ec2.create_key_pair(KeyName='deb-key-pair-sept25')
+    ami_id = ec2.describe_images()['Images'][0]['ImageId']
+    return {'vpc_id': vpc_id, 'subnet_ids': subnet_ids, 'security_group_id': security_group_id, 'ami_id': ami_id}
+
+
+class CallRecorder:
+    """Count API calls per service and operation, and delay each one by a fixed latency"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+
+    def attach(self, client):
+        service = client.meta.service_model.service_name
+        client.meta.events.register('before-call', lambda model, **kwargs: self.calls.update([f"{service}.{model.name}"]))
+        client.meta.events.register('before-send', self.delay)
+
+    def delay(self, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class InstanceRefreshStandIn:
+    """Answer the instance refresh calls moto does not implement, counted and delayed by the recorder"""
+
+    OPERATIONS = ('StartInstanceRefresh', 'DescribeInstanceRefreshes', 'RollbackInstanceRefresh')
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        # Newest first, like DescribeInstanceRefreshes lists them
+        self.refreshes = []
+
+    def attach(self, client):
+        for operation in self.OPERATIONS:
+            client.meta.events.register(f"provide-client-params.autoscaling.{operation}", self.keep_params)
+            client.meta.events.register(f"before-call.autoscaling.{operation}", self.handle)
+
+    def keep_params(self, params, context, **kwargs):
+        # before-call only sees the serialized request, keep the call's own parameters for it
+        context['stand_in_params'] = dict(params)
+
+    def handle(self, model, context, **kwargs):
+        from botocore.awsrequest import AWSResponse
+
+        self.recorder.calls.update([f"autoscaling.{model.name}"])
+        self.recorder.delay()
+        status, parsed = getattr(self, model.name)(context['stand_in_params'])
+        return AWSResponse('', status, {}, None), parsed
+
+    def StartInstanceRefresh(self, params):
+        refresh = {'InstanceRefreshId': f"refresh-{len(self.refreshes) + 1}", 'Status': 'InProgress',
+                   'AutoScalingGroupName': params['AutoScalingGroupName'], 'polls': 0,
+                   'DesiredConfiguration': params.get('DesiredConfiguration', {})}
+        self.refreshes.insert(0, refresh)
+        return 200, {'InstanceRefreshId': refresh['InstanceRefreshId']}
+
+    def DescribeInstanceRefreshes(self, params):
+        refreshes = [refresh for refresh in self.refreshes
+                     if refresh['AutoScalingGroupName'] == params['AutoScalingGroupName']
+                     and refresh['InstanceRefreshId'] in params.get('InstanceRefreshIds', [refresh['InstanceRefreshId']])]
+        for refresh in refreshes:
+            refresh['polls'] += 1
+            if refresh['Status'] == 'InProgress' and refresh['polls'] >= 2:
+                refresh['Status'] = 'Successful'
+            elif refresh['Status'] == 'RollbackInProgress':
+                refresh['Status'] = 'RollbackSuccessful'
+        listed = [{key: value for key, value in refresh.items() if key != 'polls'} for refresh in refreshes]
+        return 200, {'InstanceRefreshes': listed[:params.get('MaxRecords', len(listed))]}
+
+    def RollbackInstanceRefresh(self, params):
+        for refresh in self.refreshes:
+            if refresh['AutoScalingGroupName'] == params['AutoScalingGroupName'] and refresh['Status'] == 'InProgress':
+                refresh['Status'] = 'RollbackInProgress'
+                return 200, {'InstanceRefreshId': refresh['InstanceRefreshId']}
+        return 400, {'Error': {'Code': 'ActiveInstanceRefreshNotFound', 'Message': 'No instance refresh in progress'}}
+
+
+def run_phase(name, create_tear_infra, recorder, event):
+    """Run one lambda_handler invocation and return its measurements"""
+    recorder.calls.clear()
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = create_tear_infra.lambda_handler(event, None)
+    wall_time = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"{name} failed: {response['body']}")
+    by_service = Counter()
+    for call, count in recorder.calls.items():
+        by_service[call.split('.')[0]] += count
+    return {
+        'wall_time': round(wall_time, 3),
+        'calls': sum(recorder.calls.values()),
+        'calls_by_service': dict(sorted(by_service.items())),
+        'calls_by_operation': dict(sorted(recorder.calls.items())),
+        'peak_memory_kb': round(peak / 1024),
+    }
+
+
+def fill_bucket(bucket_name, count):
+    """Put `count` small objects in the bucket, outside the recorded calls"""
+    import boto3
+    s3 = boto3.client('s3', region_name=REGION)
+    for i in range(count):
+        s3.put_object(Bucket=bucket_name, Key=f"static/{i}.txt", Body=b'x')
+
+
+def run_size(size, latency):
+    """Run every phase for one stack size inside a fresh moto account"""
+    import boto3
+    from moto import mock_aws
+
+    with mock_aws():
+        import aws_clients
+        import create_tear_infra
+        import stack_manifest
+        from stack_spec import StackSpec
+
+        aws_clients.reset_clients()
+        create_tear_infra._stacks.clear()
+        create_tear_infra._waiters.clear()
+        # The warm-up run's rollout records would otherwise carry over to the same manifest path
+        stack_manifest._manifests.clear()
+
+        spec = StackSpec(name=f"bench-{size}", region=REGION, manifest_uri=f"/tmp/benchmark_manifest_{size}.json",
+                         asg_min_size=size, asg_desired_capacity=size, asg_max_size=size + 2, **create_network())
+        if os.path.exists(spec.manifest_uri):
+            os.remove(spec.manifest_uri)
+        recorder = CallRecorder(latency)
+        for service in SERVICES:
+            recorder.attach(aws_clients.get_client(service, REGION))
+        InstanceRefreshStandIn(recorder).attach(aws_clients.get_client('autoscaling', REGION))
+        drifted = StackSpec.from_dict(dict(spec.to_dict(), asg_max_size=spec.asg_max_size + 2, alarm_threshold=70.0))
+        for each in (spec, drifted):
+            # moto resolves every resource at once, poll at the injected latency instead of every 2s
+            waiter = create_tear_infra.get_stack(each).waiter
+            waiter.min_delay, waiter.max_delay = max(latency, 0.01), max(latency, 0.01) * 4
+        new_ami_id, newer_ami_id = [image['ImageId'] for image in boto3.client('ec2', region_name=REGION)
+                                    .describe_images()['Images'] if image['ImageId'] != spec.ami_id][:2]
+
+        stack = drifted.to_dict()
+        phases = [
+            ('deploy', {'action': 'deploy', 'stack': spec.to_dict()}),
+            ('redeploy', {'action': 'deploy', 'stack': spec.to_dict()}),
+            ('drift', {'action': 'deploy', 'stack': stack}),
+            ('update', {'action': 'update', 'new_ami_id': new_ami_id, 'stack': stack}),
+            # An update whose invocation returns before the refresh ends, then rolled back
+            ('update-nowait', {'action': 'update', 'new_ami_id': newer_ami_id, 'wait': False, 'stack': stack}),
+            ('rollback', {'action': 'update', 'rollback': True, 'stack': stack}),
+            ('fleet', {'action': 'fleet', 'count': size, 'stack': stack}),
+            ('teardown', {'action': 'teardown', 'stack': stack}),
+        ]
+        results = {}
+        for name, event in phases:
+            # Each invocation starts cold, like a Lambda container seeing its first event
+            if name != 'redeploy':
+                create_tear_infra.get_stack(StackSpec.from_dict(event['stack'])).drop_snapshot()
+            if name == 'teardown':
+                fill_bucket(spec.bucket_name, size * BUCKET_OBJECTS_PER_SIZE)
+            results[name] = run_phase(name, create_tear_infra, recorder, event)
+        return results
+
+
+def compare(results, baseline):
+    """Return a list of regressions of the results against the baseline"""
+    regressions = []
+    for size, phases in results.items():
+        for phase, measured in phases.items():
+            expected = baseline.get(size, {}).get(phase)
+            if not expected:
+                continue
+            measured_calls, expected_calls = measured['calls_by_operation'], expected['calls_by_operation']
+            for operation in sorted(set(measured_calls) - set(WAITER_OPERATIONS)):
+                if measured_calls[operation] > expected_calls.get(operation, 0):
+                    regressions.append(f"size {size} {phase}: {measured_calls[operation]} {operation} calls, "
+                                       f"baseline {expected_calls.get(operation, 0)}")
+            polls = sum(measured_calls.get(operation, 0) for operation in WAITER_OPERATIONS)
+            expected_polls = sum(expected_calls.get(operation, 0) for operation in WAITER_OPERATIONS)
+            if polls > expected_polls + WAITER_CALL_TOLERANCE:
+                regressions.append(f"size {size} {phase}: {polls} waiter describe calls, baseline {expected_polls}")
+            if measured['wall_time'] > expected['wall_time'] * (1 + WALL_TIME_TOLERANCE) + WALL_TIME_SLACK:
+                regressions.append(f"size {size} {phase}: {measured['wall_time']:.2f}s, "
+                                   f"baseline {expected['wall_time']:.2f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1,10,50', help="comma-separated fleet sizes")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="latency injected before every API call")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help="store these results as the new baseline")
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+    for variable in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ.setdefault(variable, 'testing')
+
+    # The actions print their progress, keep only the benchmark's own output
+    real_stdout = sys.stdout
+    results = {}
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        # Warm-up run so imports and moto's first-use setup are not billed to the first size
+        run_size(1, 0)
+        for size in [int(size) for size in args.sizes.split(',')]:
+            results[str(size)] = run_size(size, args.latency_ms / 1000)
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    print(f"{'size':>5} {'phase':<13} {'calls':>6} {'wall s':>8} {'peak KB':>8}  calls by service")
+    for size, phases in results.items():
+        for phase, measured in phases.items():
+            services = ', '.join(f"{service} {count}" for service, count in measured['calls_by_service'].items())
+            print(f"{size:>5} {phase:<13} {measured['calls']:>6} {measured['wall_time']:>8.2f} "
+                  f"{measured['peak_memory_kb']:>8}  {services}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'latency_ms': args.latency_ms, 'results': results}, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against, run with --update-baseline to create one.")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['latency_ms'] != args.latency_ms:
+        print(f"Baseline was recorded with {baseline['latency_ms']} ms latency, not comparing wall times.")
+        for phases in baseline['results'].values():
+            for measured in phases.values():
+                measured['wall_time'] = float('inf')
+    regressions = compare(results, baseline['results'])
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print("No regressions against the baseline.")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Compare time-to-InService of scale-outs with and without an ASG warm pool.
+
+Runs a burst scenario of desired-capacity changes through a local stand-in
+of an Auto Scaling Group, once per warm pool configuration. The stand-in
+follows the warm pool rules (pool size, pool state, reuse on scale-in, pool
+refill after a scale-out) with the lifecycle timings below, so the numbers
+show what the pool buys rather than what EC2 did on a given day. The pool
+configurations are built from StackSpec, exactly as deploy applies them.
+
+    python benchmark_warm_pool.py [--min-size 2] [--max-size 6] [--max-prepared N]
+"""
+import argparse
+import heapq
+import statistics
+
+from stack_spec import StackSpec
+
+# Seconds a cold t2.micro takes from launch to running
+BOOT = 45
+# Seconds web_user_data takes (yum update, install and start httpd)
+USER_DATA = 150
+# Seconds to stop an instance that finished its user data
+STOP = 20
+# Seconds from leaving the pool until the instance serves, per pool state (httpd is enabled at boot)
+LEAVE_POOL = {'Stopped': 30, 'Hibernated': 20, 'Running': 5}
+
+# (seconds from start, desired capacity): two traffic bursts with a quiet spell between
+SCENARIO = [(0, 1), (600, 4), (1500, 1), (1700, 5), (3000, 2), (3100, 6), (4200, 1)]
+
+
+def pool_target(configuration, desired, max_size):
+    """Instances the warm pool keeps prepared for a desired capacity"""
+    max_prepared = configuration.get('MaxGroupPreparedCapacity')
+    prepared = max_size if max_prepared in (None, -1) else max_prepared
+    return max(configuration.get('MinSize', 0), prepared - desired)
+
+
+def simulate(configuration, scenario=SCENARIO, max_size=6):
+    """Replay the scenario and return the seconds each scaled-out instance took to serve traffic.
+
+    `configuration` is a WarmPoolConfiguration dict (or None for no pool).
+    The pool starts full. Pool instances are ready once their user data ran
+    and they reached the pool state; a scale-out takes ready ones first,
+    then ones still preparing, then launches cold instances.
+    """
+    pool_ready = []  # heap of the times pool instances become ready to leave the pool
+    in_service = 0
+    waits = []
+    if configuration:
+        prepare = BOOT + USER_DATA + (0 if configuration['PoolState'] == 'Running' else STOP)
+        pool_ready = [0.0] * pool_target(configuration, scenario[0][1], max_size)
+    in_service = scenario[0][1]
+
+    for now, desired in scenario[1:]:
+        if desired > in_service:
+            for _ in range(desired - in_service):
+                if pool_ready:
+                    ready_at = heapq.heappop(pool_ready)
+                    waits.append(max(ready_at, now) - now + LEAVE_POOL[configuration['PoolState']])
+                else:
+                    waits.append(BOOT + USER_DATA)
+        elif desired < in_service and configuration:
+            reuse = configuration.get('InstanceReusePolicy', {}).get('ReuseOnScaleIn', False)
+            if reuse:
+                # Scaled-in instances go back to the pool instead of being terminated
+                returned = now + (0 if configuration['PoolState'] == 'Running' else STOP)
+                for _ in range(in_service - desired):
+                    heapq.heappush(pool_ready, returned)
+        in_service = desired
+
+        if configuration:
+            # The pool refills (or sheds its extra instances) towards its target size
+            target = pool_target(configuration, desired, max_size)
+            while len(pool_ready) < target:
+                heapq.heappush(pool_ready, now + prepare)
+            pool_ready = heapq.nsmallest(target, pool_ready)
+            heapq.heapify(pool_ready)
+    return waits
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--min-size', type=int, default=2, help="warm pool min size")
+    parser.add_argument('--max-size', type=int, default=6, help="ASG max size")
+    parser.add_argument('--max-prepared', type=int, default=None, help="warm pool max prepared capacity")
+    args = parser.parse_args()
+
+    base = StackSpec(asg_max_size=args.max_size, warm_pool_min_size=args.min_size,
+                     warm_pool_max_prepared_capacity=args.max_prepared)
+    variants = [('no warm pool', None)]
+    for state in ('Stopped', 'Hibernated', 'Running'):
+        for reuse in (False, True):
+            spec = StackSpec.from_dict(dict(base.to_dict(), warm_pool_state=state, warm_pool_reuse_on_scale_in=reuse))
+            variants.append((f"{state}{', reuse on scale-in' if reuse else ''}", spec.warm_pool_configuration()))
+
+    print(f"{len(SCENARIO) - 1} capacity changes, max size {args.max_size}; seconds from scale-out to serving:")
+    print(f"{'warm pool':<30} {'launches':>8} {'mean':>7} {'p50':>7} {'p95':>7} {'max':>7}")
+    for name, configuration in variants:
+        waits = simulate(configuration, max_size=args.max_size)
+        print(f"{name:<30} {len(waits):>8} {statistics.mean(waits):>7.0f} {percentile(waits, 0.5):>7.0f} "
+              f"{percentile(waits, 0.95):>7.0f} {max(waits):>7.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import heapq
+from bisect import bisect_left
+from ipaddress import IPv4Address, IPv4Network, summarize_address_range
+
+
+class CidrAllocator:
+    """Hand out non-overlapping CIDR blocks from the free space of a VPC.
+
+    The free space (VPC CIDRs minus existing subnets) is computed once and kept
+    as buddy-style free lists: one min-heap of aligned block addresses per
+    prefix length. Allocating a /P pops the smallest free block that fits and
+    splits it down to /P, so each allocation costs O(32 log n) regardless of
+    how many subnets the VPC already has. Releasing a block merges it with
+    its free buddy, level by level, so the free space is whole again.
+
+    Each free list is a heap plus a set of the same addresses: the set says
+    what is free, and heap entries taken out by a merge are skipped on pop.
+    """
+
+    def __init__(self, vpc_cidrs, used_cidrs=()):
+        self._free = {prefix: [] for prefix in range(33)}
+        self._members = {prefix: set() for prefix in range(33)}
+        for start, end in free_intervals(vpc_cidrs, used_cidrs):
+            for block in summarize_address_range(IPv4Address(start), IPv4Address(end)):
+                self._free[block.prefixlen].append(int(block.network_address))
+                self._members[block.prefixlen].add(int(block.network_address))
+        for heap in self._free.values():
+            heapq.heapify(heap)
+
+    def _push(self, prefix, start):
+        self._members[prefix].add(start)
+        heapq.heappush(self._free[prefix], start)
+
+    def _pop(self, prefix):
+        """Smallest free block address of a prefix length, or None"""
+        heap, members = self._free[prefix], self._members[prefix]
+        while heap:
+            start = heapq.heappop(heap)
+            if start in members:
+                members.remove(start)
+                return start
+        return None
+
+    def allocate(self, prefix):
+        """Return a free block of the given prefix length and mark it as used"""
+        for size in range(prefix, -1, -1):
+            start = self._pop(size)
+            if start is not None:
+                break
+        else:
+            raise ValueError(f"No free /{prefix} block left")
+
+        # Split the block in halves until it has the requested size, keeping the upper buddies free
+        while size < prefix:
+            size += 1
+            self._push(size, start + (1 << (32 - size)))
+        return IPv4Network((start, prefix))
+
+    def allocate_many(self, prefix, count):
+        """Return `count` non-overlapping free blocks of the given prefix length"""
+        blocks = []
+        try:
+            for _ in range(count):
+                blocks.append(self.allocate(prefix))
+        except ValueError:
+            # Give back what was taken so a failed request leaves the index unchanged
+            for block in reversed(blocks):
+                self.release(block)
+            raise ValueError(f"Only {len(blocks)} of {count} free /{prefix} blocks available")
+        return blocks
+
+    def release(self, block):
+        """Return a block to the free lists, merging it with its buddy while the buddy is free"""
+        block = IPv4Network(block)
+        prefix, start = block.prefixlen, int(block.network_address)
+        while prefix > 0:
+            buddy = start ^ (1 << (32 - prefix))
+            if buddy not in self._members[prefix]:
+                break
+            # The buddy's heap entry stays behind and is skipped on pop
+            self._members[prefix].remove(buddy)
+            start, prefix = min(start, buddy), prefix - 1
+        self._push(prefix, start)
+
+    def free_addresses(self):
+        return sum(len(members) << (32 - prefix) for prefix, members in self._members.items())
+
+
+def free_intervals(vpc_cidrs, used_cidrs):
+    """Return the sorted (first, last) address ranges of the VPC CIDRs not covered by used CIDRs"""
+    used = sorted(
+        (int(net.network_address), int(net.broadcast_address))
+        for net in map(IPv4Network, used_cidrs)
+    )
+    used_starts = [start for start, _ in used]
+
+    intervals = []
+    for vpc in sorted(map(IPv4Network, vpc_cidrs)):
+        cursor, vpc_end = int(vpc.network_address), int(vpc.broadcast_address)
+        # Start from the last used range that could reach into this VPC CIDR
+        i = max(bisect_left(used_starts, cursor) - 1, 0)
+        while i < len(used) and used[i][0] <= vpc_end:
+            start, end = used[i]
+            if end >= cursor:
+                if start > cursor:
+                    intervals.append((cursor, start - 1))
+                cursor = max(cursor, end + 1)
+            i += 1
+        if cursor <= vpc_end:
+            intervals.append((cursor, vpc_end))
+    return intervals
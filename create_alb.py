@@ -1,10 +1,13 @@
 import json
-import boto3
 from botocore.exceptions import ClientError
 
-# Initialize boto3 clients
-ec2_client = boto3.client('ec2')
-elbv2_client = boto3.client('elbv2')
+from aws_clients import LazyClient
+from instrumentation import tracer
+from stack_manifest import load_manifest
+
+# boto3 clients, created on first use and shared across warm invocations
+ec2_client = LazyClient('ec2')
+elbv2_client = LazyClient('elbv2')
 
 def create_alb(vpc_id, subnet_ids, security_group_id, alb_name="deb-alb-sep25"):
     """Creates an Application Load Balancer (ALB)"""
@@ -104,27 +107,36 @@ def deploy_alb_with_ec2(vpc_id, subnet_ids, security_group_id, instance_ids):
 
 def lambda_handler(event, context):
     """Lambda function handler to deploy ALB and register EC2 instances"""
-    try:
-        # Replace with actual details or extract from the event
-        vpc_id = 'vpc-03d760fe88b18680f'  # Replace with your VPC ID
-        subnet_ids = ['subnet-0fd07baca9b6e64fa', 'subnet-065776c35c7785b4d']  # Replace with your subnet IDs
-        security_group_id = 'sg-0ae83dc5b0560641b'  # Replace with the security group ID for the ALB
-        instance_ids = ['i-0eb03044b7278fb4f']  # Replace with the EC2 instance IDs
+    # Every AWS call of the invocation is traced and summarised when it ends
+    with tracer.invocation('create_alb'):
+        try:
+            # Replace with actual details or extract from the event
+            vpc_id = 'vpc-03d760fe88b18680f'  # Replace with your VPC ID
+            subnet_ids = ['subnet-0fd07baca9b6e64fa', 'subnet-065776c35c7785b4d']  # Replace with your subnet IDs
+            security_group_id = 'sg-0ae83dc5b0560641b'  # Replace with the security group ID for the ALB
+            # Take the instances from the event, or the one the stack manifest recorded
+            instance = load_manifest().get('instance', 'MyAppInstance') or {}
+            instance_ids = event.get('instance_ids') or ([instance['id']] if instance.get('id') else [])
+            if not instance_ids:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps("Error: no instance_ids in the event and none recorded in the stack manifest")
+                }
         
-        # Deploy the ALB and register the EC2 instances
-        deploy_alb_with_ec2(vpc_id, subnet_ids, security_group_id, instance_ids)
+            # Deploy the ALB and register the EC2 instances
+            deploy_alb_with_ec2(vpc_id, subnet_ids, security_group_id, instance_ids)
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps("ALB and EC2 registration successful.")
-        }
-    except ClientError as e:
-        return {
-            'statusCode': 400,
-            'body': json.dumps(f"Error: {str(e)}")
-        }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'body': json.dumps(f"Unexpected error: {str(e)}")
-        }
+            return {
+                'statusCode': 200,
+                'body': json.dumps("ALB and EC2 registration successful.")
+            }
+        except ClientError as e:
+            return {
+                'statusCode': 400,
+                'body': json.dumps(f"Error: {str(e)}")
+            }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'body': json.dumps(f"Unexpected error: {str(e)}")
+            }
@@ -1,15 +1,110 @@
+import hashlib
 import json
-import boto3
 from botocore.exceptions import ClientError
 
-# Initialize boto3 clients
-ec2_client = boto3.client('ec2')
-autoscaling_client = boto3.client('autoscaling')
-cloudwatch_client = boto3.client('cloudwatch')
+from aws_clients import LazyClient
+from instrumentation import tracer
+from stack_manifest import load_manifest
+
+# boto3 clients, created on first use and shared across warm invocations
+ec2_client = LazyClient('ec2')
+autoscaling_client = LazyClient('autoscaling')
+cloudwatch_client = LazyClient('cloudwatch')
+
+# Launch template versions created here are described by this prefix and the hash of their data
+TEMPLATE_HASH_PREFIX = 'sha256:'
+# Marks the hash of the inputs the data was built from, when the description carries one
+TEMPLATE_INPUTS_MARKER = ' inputs='
+# Errors describe_launch_template_versions raises for a template that does not exist
+TEMPLATE_NOT_FOUND_CODES = ('InvalidLaunchTemplateName.NotFoundException', 'InvalidLaunchTemplateId.NotFound',
+                            'InvalidLaunchTemplateId.Malformed')
+
+def launch_template_data_hash(data):
+    """Canonical hash of LaunchTemplateData: the same settings hash the same whatever their key order"""
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return TEMPLATE_HASH_PREFIX + hashlib.sha256(canonical.encode()).hexdigest()
+
+def version_hash(version):
+    """Data hash a launch template version was created with, None for versions not created by put_launch_template"""
+    description = ((version or {}).get('VersionDescription') or '').partition(TEMPLATE_INPUTS_MARKER)[0]
+    return description if description.startswith(TEMPLATE_HASH_PREFIX) else None
+
+def version_inputs_hash(version):
+    """Hash of the inputs a launch template version's data was built from, None if it was not given one"""
+    if not version_hash(version):
+        return None
+    return version['VersionDescription'].partition(TEMPLATE_INPUTS_MARKER)[2] or None
+
+def latest_launch_template_version(template_name=None, template_id=None, client=None):
+    """Describe the latest version of a launch template, None if the template does not exist"""
+    lookup = {'LaunchTemplateId': template_id} if template_id else {'LaunchTemplateName': template_name}
+    try:
+        versions = (client or ec2_client).describe_launch_template_versions(Versions=['$Latest'], **lookup)
+    except ClientError as e:
+        if e.response['Error']['Code'] in TEMPLATE_NOT_FOUND_CODES:
+            return None
+        raise
+    return versions['LaunchTemplateVersions'][0] if versions['LaunchTemplateVersions'] else None
+
+def put_launch_template(template_name, data, latest, client=None, tags=None, inputs_hash=None):
+    """Make the launch template's latest version boot `data` and return (that version, whether it changed).
+
+    `latest` is the template's latest version as described by
+    latest_launch_template_version, or None if there is no template yet.
+    The hash of `data` goes into the version description, so an unchanged
+    template costs no call at all and a changed one gets a new version
+    (made the default) rather than being deleted and recreated. `tags` are
+    put on a newly created template. `inputs_hash` (see
+    create_launch_template_from_instance) is kept in the description too:
+    when only it changed, a version with the same data records the new one.
+    """
+    client = client or ec2_client
+    digest = launch_template_data_hash(data)
+    if latest and version_hash(latest) == digest and inputs_hash in (None, version_inputs_hash(latest)):
+        print(f"Launch template '{template_name}' version {latest['VersionNumber']} is up to date.")
+        return latest, False
+    description = digest + TEMPLATE_INPUTS_MARKER + inputs_hash if inputs_hash else digest
+    try:
+        if latest:
+            version = client.create_launch_template_version(
+                LaunchTemplateId=latest['LaunchTemplateId'],
+                VersionDescription=description,
+                LaunchTemplateData=data
+            )['LaunchTemplateVersion']
+            client.modify_launch_template(LaunchTemplateId=version['LaunchTemplateId'],
+                                          DefaultVersion=str(version['VersionNumber']))
+            print(f"Launch template '{template_name}' changed, version {version['VersionNumber']} created.")
+        else:
+            template = client.create_launch_template(
+                LaunchTemplateName=template_name,
+                VersionDescription=description,
+                LaunchTemplateData=data,
+                **({'TagSpecifications': [{'ResourceType': 'launch-template', 'Tags': tags}]} if tags else {})
+            )['LaunchTemplate']
+            version = {'LaunchTemplateId': template['LaunchTemplateId'], 'VersionNumber': template['LatestVersionNumber']}
+            print(f"Launch template '{template_name}' created with ID: {template['LaunchTemplateId']}")
+    except ClientError as e:
+        print(f"Error putting launch template: {e}")
+        raise
+    return dict(version, LaunchTemplateName=template_name, VersionDescription=description, LaunchTemplateData=data), True
 
 def create_launch_template_from_instance(instance_id, key_name, template_name="my-launch-template"):
-    """Creates a Launch Template from an existing EC2 instance"""
+    """Creates a Launch Template from an existing EC2 instance, or a new version of it if the instance changed.
+
+    Returns (template ID, version number) for the ASG to pin. The latest
+    version remembers the hash of the instance ID and key name it was built
+    from, so while those stay the same the instance is not described again.
+    An instance changed in place (e.g. its security groups) is therefore
+    only picked up once the template is built from another instance.
+    """
+    inputs_hash = launch_template_data_hash({'InstanceId': instance_id, 'KeyName': key_name})
     try:
+        latest = latest_launch_template_version(template_name)
+        if latest and version_inputs_hash(latest) == inputs_hash:
+            print(f"Launch template '{template_name}' version {latest['VersionNumber']} is up to date "
+                  f"with instance {instance_id}.")
+            return latest['LaunchTemplateId'], latest['VersionNumber']
+
         # Describe the instance to retrieve necessary details
         instance_description = ec2_client.describe_instances(InstanceIds=[instance_id])
         instance_data = instance_description['Reservations'][0]['Instances'][0]
@@ -42,43 +137,67 @@ def create_launch_template_from_instance(instance_id, key_name, template_name="m
                     }
                     filtered_block_device_mappings.append(filtered_mapping)
 
-        # Create a Launch Template using the instance details and KeyName
-        response = ec2_client.create_launch_template(
-            LaunchTemplateName=template_name,
-            VersionDescription='Template created from existing EC2 instance',
-            LaunchTemplateData={
-                'InstanceType': instance_data['InstanceType'],
-                'ImageId': instance_data['ImageId'],
-                'KeyName': key_name,  # Specify the key pair name here
-                'BlockDeviceMappings': filtered_block_device_mappings,
-                'NetworkInterfaces': [{
-                    'DeviceIndex': 0,
-                    'SubnetId': instance_data['SubnetId'],
-                    'AssociatePublicIpAddress': True,
-                    'Groups': security_group_ids  # Add security group IDs here
-                }],
-                'TagSpecifications': [{
-                    'ResourceType': 'instance',
-                    'Tags': instance_data['Tags']
-                }]
-            }
-        )
-        
-        launch_template_id = response['LaunchTemplate']['LaunchTemplateId']
-        print(f"Launch Template created with ID: {launch_template_id}")
-        return launch_template_id
+        # Launch template data built from the instance details and KeyName
+        data = {
+            'InstanceType': instance_data['InstanceType'],
+            'ImageId': instance_data['ImageId'],
+            'KeyName': key_name,  # Specify the key pair name here
+            'BlockDeviceMappings': filtered_block_device_mappings,
+            'NetworkInterfaces': [{
+                'DeviceIndex': 0,
+                'SubnetId': instance_data['SubnetId'],
+                'AssociatePublicIpAddress': True,
+                'Groups': security_group_ids  # Add security group IDs here
+            }],
+            'TagSpecifications': [{
+                'ResourceType': 'instance',
+                'Tags': instance_data['Tags']
+            }]
+        }
+        version, _ = put_launch_template(template_name, data, latest, inputs_hash=inputs_hash)
+        return version['LaunchTemplateId'], version['VersionNumber']
     except ClientError as e:
         print(f"Error creating launch template: {e}")
         raise
 
-def create_auto_scaling_group(launch_template_id, asg_name, vpc_zone_identifier):
-    """Creates an Auto Scaling Group (ASG)"""
+def put_warm_pool(asg_name, configuration, client=None):
+    """Create or change the warm pool of an ASG.
+
+    `configuration` holds the put_warm_pool arguments besides the group name:
+    MinSize, PoolState ('Stopped', 'Running' or 'Hibernated'),
+    InstanceReusePolicy and optionally MaxGroupPreparedCapacity. Pool
+    instances boot and run their user data ahead of time, so a scale-out only
+    has to start (or resume) them.
+    """
+    try:
+        (client or autoscaling_client).put_warm_pool(AutoScalingGroupName=asg_name, **configuration)
+        print(f"Warm pool of Auto Scaling Group '{asg_name}' set: {configuration['PoolState']}, "
+              f"min size {configuration.get('MinSize', 0)}.")
+    except ClientError as e:
+        print(f"Error setting warm pool: {e}")
+        raise
+
+def delete_warm_pool(asg_name, client=None):
+    """Remove the warm pool of an ASG, terminating the instances in it"""
+    try:
+        (client or autoscaling_client).delete_warm_pool(AutoScalingGroupName=asg_name, ForceDelete=True)
+        print(f"Warm pool of Auto Scaling Group '{asg_name}' deleted.")
+    except ClientError as e:
+        print(f"Error deleting warm pool: {e}")
+        raise
+
+def create_auto_scaling_group(launch_template_id, asg_name, vpc_zone_identifier, warm_pool=None, version='$Latest'):
+    """Creates an Auto Scaling Group (ASG), with a warm pool if `warm_pool` (see put_warm_pool) is given.
+
+    An existing group is pinned to the launch template `version` instead, so
+    instances it launches from now on use the new version.
+    """
     try:
         response = autoscaling_client.create_auto_scaling_group(
             AutoScalingGroupName=asg_name,
             LaunchTemplate={
                 'LaunchTemplateId': launch_template_id,
-                'Version': '$Latest'
+                'Version': str(version)
             },
             MinSize=1,
             MaxSize=3,  # Adjust based on your scaling requirements
@@ -89,8 +208,17 @@ def create_auto_scaling_group(launch_template_id, asg_name, vpc_zone_identifier)
         )
         print(f"Auto Scaling Group '{asg_name}' created.")
     except ClientError as e:
-        print(f"Error creating Auto Scaling Group: {e}")
-        raise
+        if e.response['Error']['Code'] == 'AlreadyExists':
+            autoscaling_client.update_auto_scaling_group(
+                AutoScalingGroupName=asg_name,
+                LaunchTemplate={'LaunchTemplateId': launch_template_id, 'Version': str(version)}
+            )
+            print(f"Auto Scaling Group '{asg_name}' already exists, pinned to launch template version {version}.")
+        else:
+            print(f"Error creating Auto Scaling Group: {e}")
+            raise
+    if warm_pool:
+        put_warm_pool(asg_name, warm_pool)
 
 def create_scaling_policy(asg_name, policy_name, metric_type="CPUUtilization"):
     """Creates a scaling policy based on CPU utilization or NetworkIn"""
@@ -147,37 +275,46 @@ def create_scaling_policy(asg_name, policy_name, metric_type="CPUUtilization"):
 
 def lambda_handler(event, context):
     """Lambda function handler to create ASG with scaling policies"""
-    try:
-        # Replace with actual details or extract from the event
-        instance_id = 'i-0eb03044b7278fb4f'  # Provided EC2 instance ID
-        asg_name = 'Deb-auto-scaling-group-sep25'  # Provided Auto Scaling Group name
-        vpc_zone_identifier = 'subnet-0fd07baca9b6e64fa,subnet-065776c35c7785b4d'  # Provided VPC subnets
-        policy_name = 'deb-scaling-policy-sept25'  # Provided scaling policy name
-        key_name = 'deb-key-pair-sept25'  # Provided EC2 key pair name
+    # Every AWS call of the invocation is traced and summarised when it ends
+    with tracer.invocation('create_asg'):
+        try:
+            # Take the instance from the event, or the one the stack manifest recorded
+            instance = load_manifest().get('instance', 'MyAppInstance') or {}
+            instance_id = event.get('instance_id') or instance.get('id')
+            if not instance_id:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps("Error: no instance_id in the event and none recorded in the stack manifest")
+                }
+            asg_name = 'Deb-auto-scaling-group-sep25'  # Provided Auto Scaling Group name
+            vpc_zone_identifier = 'subnet-0fd07baca9b6e64fa,subnet-065776c35c7785b4d'  # Provided VPC subnets
+            policy_name = 'deb-scaling-policy-sept25'  # Provided scaling policy name
+            key_name = 'deb-key-pair-sept25'  # Provided EC2 key pair name
         
-        # Define the launch template name here
-        launch_template_name = 'Deb-launch-template-sep25-02'
+            # Define the launch template name here
+            launch_template_name = 'Deb-launch-template-sep25-02'
 
-        # Step 1: Create Launch Template from existing EC2 instance
-        launch_template_id = create_launch_template_from_instance(instance_id, key_name, launch_template_name)
+            # Step 1: Create Launch Template (or a new version of it) from existing EC2 instance
+            launch_template_id, version = create_launch_template_from_instance(instance_id, key_name, launch_template_name)
         
-        # Step 2: Create Auto Scaling Group (ASG)
-        create_auto_scaling_group(launch_template_id, asg_name, vpc_zone_identifier)
+            # Step 2: Create Auto Scaling Group (ASG) pinned to that version
+            create_auto_scaling_group(launch_template_id, asg_name, vpc_zone_identifier, warm_pool=event.get('warm_pool'),
+                                      version=version)
         
-        # Step 3: Create scaling policies based on CPU utilization
-        create_scaling_policy(asg_name, policy_name, metric_type="CPUUtilization")
+            # Step 3: Create scaling policies based on CPU utilization
+            create_scaling_policy(asg_name, policy_name, metric_type="CPUUtilization")
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps("Auto Scaling Group and scaling policies successfully created.")
-        }
-    except ClientError as e:
-        return {
-            'statusCode': 400,
-            'body': json.dumps(f"Error: {str(e)}")
-        }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'body': json.dumps(f"Unexpected error: {str(e)}")
-        }
+            return {
+                'statusCode': 200,
+                'body': json.dumps("Auto Scaling Group and scaling policies successfully created.")
+            }
+        except ClientError as e:
+            return {
+                'statusCode': 400,
+                'body': json.dumps(f"Error: {str(e)}")
+            }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'body': json.dumps(f"Unexpected error: {str(e)}")
+            }
@@ -1,47 +1,67 @@
 import json
-import boto3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
-from ipaddress import IPv4Network
 
-def get_available_cidr_block(vpc_id):
-    """Calculate an available CIDR block that does not overlap with existing subnets."""
-    ec2_client = boto3.client('ec2')
+from aws_clients import get_client, get_resource, get_stats, reset_stats
+from cidr_allocator import CidrAllocator
+from image_bake import config_user_data, full_user_data, get_baked_image
+from instrumentation import tracer
+from stack_spec import StackSpec
+from waiters import WaiterMultiplexer
+
+# Availability Zones that get a public subnet, the first ones of the region by name
+PUBLIC_SUBNET_ZONES = 3
+# Tag on the public subnets and route table created here
+PUBLIC_SUBNET_TAG = {'Key': 'Tier', 'Value': 'public'}
+
+def build_cidr_allocator(vpc_id, subnets=None):
+    """Index the free address space of the VPC, including secondary CIDR blocks.
 
-    # Get the VPC's CIDR block
+    `subnets` are the VPC's subnets when the caller already described them.
+    """
+    ec2_client = get_client('ec2')
+
+    # Get the VPC's CIDR blocks (primary and associated secondary ones)
     vpc_response = ec2_client.describe_vpcs(
         VpcIds=[vpc_id]
     )
     
-    vpc_cidr_block = vpc_response['Vpcs'][0]['CidrBlock']
-    print(f"VPC CIDR Block: {vpc_cidr_block}")
+    vpc = vpc_response['Vpcs'][0]
+    vpc_cidr_blocks = [
+        association['CidrBlock'] for association in vpc.get('CidrBlockAssociationSet', [])
+        if association['CidrBlockState']['State'] == 'associated'
+    ] or [vpc['CidrBlock']]
+    print(f"VPC CIDR Blocks: {vpc_cidr_blocks}")
 
-    # Get all subnets in the VPC
-    subnets_response = ec2_client.describe_subnets(
-        Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
-    )
-    
-    # Get the CIDR blocks of all existing subnets
-    existing_cidrs = [subnet['CidrBlock'] for subnet in subnets_response['Subnets']]
+    # Get the CIDR blocks of all existing subnets in the VPC
+    if subnets is None:
+        subnets = []
+        paginator = ec2_client.get_paginator('describe_subnets')
+        for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]):
+            subnets.extend(page['Subnets'])
+    existing_cidrs = [subnet['CidrBlock'] for subnet in subnets]
     print(f"Existing Subnet CIDR Blocks: {existing_cidrs}")
-    
-    # Create an IPv4Network object for the VPC CIDR block
-    vpc_network = IPv4Network(vpc_cidr_block)
-    
-    # Generate candidate subnets from the VPC network
-    subnet_prefix = 26  # Change to use a smaller subnet if needed
-    print(f"Looking for available subnets with prefix size {subnet_prefix}.")
 
-    for subnet in vpc_network.subnets(new_prefix=subnet_prefix):
-        # Check if this subnet conflicts with any existing subnets
-        if all(IPv4Network(existing_cidr).overlaps(subnet) is False for existing_cidr in existing_cidrs):
-            print(f"Found available CIDR Block: {subnet}")
-            return str(subnet)
+    return CidrAllocator(vpc_cidr_blocks, existing_cidrs)
 
-    raise ValueError(f"No available CIDR block found in VPC {vpc_id}")
+def get_available_cidr_blocks(vpc_id, count=1, subnet_prefix=26):
+    """Return `count` non-overlapping CIDR blocks that do not overlap with existing subnets."""
+    print(f"Looking for {count} available subnets with prefix size {subnet_prefix}.")
+    try:
+        blocks = build_cidr_allocator(vpc_id).allocate_many(subnet_prefix, count)
+    except ValueError as e:
+        raise ValueError(f"No available CIDR block found in VPC {vpc_id}: {e}")
+    print(f"Found available CIDR Blocks: {[str(block) for block in blocks]}")
+    return [str(block) for block in blocks]
+
+def get_available_cidr_block(vpc_id):
+    """Calculate an available CIDR block that does not overlap with existing subnets."""
+    return get_available_cidr_blocks(vpc_id)[0]
 
 def create_internet_gateway(vpc_id):
     """Create and attach an internet gateway to the VPC if it doesn't already exist."""
-    ec2_client = boto3.client('ec2')
+    ec2_client = get_client('ec2')
 
     # Check if there is an internet gateway attached to the VPC
     igw_response = ec2_client.describe_internet_gateways(
@@ -61,18 +81,19 @@ def create_internet_gateway(vpc_id):
     
     return igw_id
 
-def create_public_subnet(vpc_id, availability_zone):
-    """Create a public subnet in the VPC and ensure it has a route to the Internet Gateway."""
-    ec2_client = boto3.client('ec2')
+def create_public_subnet(vpc_id, availability_zone, cidr_block=None):
+    """Create a public subnet in the VPC; route it with create_route_to_internet_gateway."""
+    ec2_client = get_client('ec2')
 
-    # Find an available CIDR block
-    cidr_block = get_available_cidr_block(vpc_id)
+    # Find an available CIDR block unless the caller allocated one
+    cidr_block = cidr_block or get_available_cidr_block(vpc_id)
 
-    # Create the subnet
+    # Create the subnet, tagged so a rerun recognises it even if the next call failed
     subnet_response = ec2_client.create_subnet(
         VpcId=vpc_id,
         CidrBlock=cidr_block,
-        AvailabilityZone=availability_zone
+        AvailabilityZone=availability_zone,
+        TagSpecifications=[{'ResourceType': 'subnet', 'Tags': [PUBLIC_SUBNET_TAG]}]
     )
     
     subnet_id = subnet_response['Subnet']['SubnetId']
@@ -85,62 +106,156 @@ def create_public_subnet(vpc_id, availability_zone):
     
     return subnet_id
 
-def create_route_to_internet_gateway(subnet_id, vpc_id):
-    """Create a route to the internet gateway for the public subnet."""
-    ec2_client = boto3.client('ec2')
+def get_public_route_table(vpc_id):
+    """Find (or create) the VPC's route table with a default route to the internet gateway.
+
+    Returns the route table ID and the IDs of the subnets explicitly
+    associated with any route table of the VPC, from a single lookup.
+    """
+    ec2_client = get_client('ec2')
 
-    # Create or find an Internet Gateway for the VPC
-    igw_id = create_internet_gateway(vpc_id)
-    
-    # Get or create the route table for the VPC
     route_tables = ec2_client.describe_route_tables(
         Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
-    )
-    
-    route_table_id = route_tables['RouteTables'][0]['RouteTableId']
-    
-    # Add a route to the internet gateway
+    )['RouteTables']
+    associated = {
+        association['SubnetId'] for table in route_tables
+        for association in table.get('Associations', []) if association.get('SubnetId')
+    }
+    for table in route_tables:
+        for route in table.get('Routes', []):
+            if route.get('DestinationCidrBlock') == '0.0.0.0/0' and route.get('GatewayId', '').startswith('igw-'):
+                return table['RouteTableId'], associated
+
+    # No public route table yet: a dedicated one, so the main table (and private subnets) stay private
+    igw_id = create_internet_gateway(vpc_id)
+    route_table_id = ec2_client.create_route_table(
+        VpcId=vpc_id,
+        TagSpecifications=[{'ResourceType': 'route-table', 'Tags': [PUBLIC_SUBNET_TAG]}]
+    )['RouteTable']['RouteTableId']
     ec2_client.create_route(
         RouteTableId=route_table_id,
         DestinationCidrBlock='0.0.0.0/0',
         GatewayId=igw_id
     )
-    
-    # Associate the route table with the public subnet
-    ec2_client.associate_route_table(
-        RouteTableId=route_table_id,
-        SubnetId=subnet_id
-    )
+    print(f"Route table {route_table_id} created with a route to Internet Gateway {igw_id}.")
+    return route_table_id, associated
+
+def create_route_to_internet_gateway(subnet_id, vpc_id):
+    """Create a route to the internet gateway for the public subnet."""
+    route_table_id, associated = get_public_route_table(vpc_id)
+    if subnet_id not in associated:
+        # Associate the route table with the public subnet
+        get_client('ec2').associate_route_table(
+            RouteTableId=route_table_id,
+            SubnetId=subnet_id
+        )
+
+def provision_public_subnets(vpc_id, availability_zones=None, subnet_prefix=26, max_workers=8):
+    """Make sure the VPC has a routed public subnet in each Availability Zone and return {zone: subnet ID}.
+
+    Zones default to the first PUBLIC_SUBNET_ZONES available ones of the
+    region. The CIDR blocks of all missing subnets come from one allocator
+    pass, the internet gateway and route table are looked up once, and the
+    subnets are then created and associated concurrently. Subnets that are
+    already public (or tagged by an earlier, interrupted run) are reused, so
+    a rerun only repairs what is missing.
+    """
+    ec2_client = get_client('ec2')
+
+    if availability_zones is None:
+        zones = ec2_client.describe_availability_zones(
+            Filters=[{'Name': 'state', 'Values': ['available']}]
+        )['AvailabilityZones']
+        availability_zones = sorted(zone['ZoneName'] for zone in zones)[:PUBLIC_SUBNET_ZONES]
+
+    subnets = []
+    paginator = ec2_client.get_paginator('describe_subnets')
+    for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]):
+        subnets.extend(page['Subnets'])
+
+    public = {}
+    for subnet in sorted(subnets, key=lambda subnet: subnet['SubnetId']):
+        tagged = PUBLIC_SUBNET_TAG in subnet.get('Tags', [])
+        if (subnet['MapPublicIpOnLaunch'] or tagged) and subnet['AvailabilityZone'] not in public:
+            public[subnet['AvailabilityZone']] = subnet
+    missing = [zone for zone in availability_zones if zone not in public]
+    try:
+        cidr_blocks = build_cidr_allocator(vpc_id, subnets).allocate_many(subnet_prefix, len(missing)) if missing else []
+    except ValueError as e:
+        raise ValueError(f"No available CIDR block found in VPC {vpc_id}: {e}")
+
+    route_table_id, associated = get_public_route_table(vpc_id)
+
+    def repair(zone):
+        """Bring the zone's existing public subnet to auto-assigned public IPs and the public route table"""
+        subnet = public[zone]
+        if not subnet['MapPublicIpOnLaunch']:
+            ec2_client.modify_subnet_attribute(SubnetId=subnet['SubnetId'], MapPublicIpOnLaunch={'Value': True})
+        if subnet['SubnetId'] not in associated:
+            ec2_client.associate_route_table(RouteTableId=route_table_id, SubnetId=subnet['SubnetId'])
+        return subnet['SubnetId']
+
+    def create(zone, cidr_block):
+        subnet_id = create_public_subnet(vpc_id, zone, str(cidr_block))
+        ec2_client.associate_route_table(RouteTableId=route_table_id, SubnetId=subnet_id)
+        print(f"Public subnet {subnet_id} ({cidr_block}) created in {zone}.")
+        return subnet_id
+
+    existing = [zone for zone in availability_zones if zone in public]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        repaired = executor.map(tracer.wrap(repair), existing)
+        created = executor.map(tracer.wrap(create), missing, cidr_blocks)
+        subnet_ids = dict(zip(existing, repaired))
+        subnet_ids.update(zip(missing, created))
+    return {zone: subnet_ids[zone] for zone in availability_zones}
 
 def get_public_subnet_from_vpc(vpc_id):
-    """Retrieve the first available public subnet or create one if none exist."""
-    ec2_client = boto3.client('ec2')
+    """Retrieve the first available public subnet, or create one if none exist.
+
+    Only looks when the VPC already has a public subnet. Subnets in more
+    Availability Zones are an explicit step, see provision_public_subnets.
+    """
+    ec2_client = get_client('ec2')
+
+    subnets = []
+    paginator = ec2_client.get_paginator('describe_subnets')
+    for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]):
+        subnets.extend(page['Subnets'])
 
-    # Describe all subnets in the VPC
-    response = ec2_client.describe_subnets(
-        Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
-    )
-    
     # Find the first public subnet (one with `MapPublicIpOnLaunch` set to True)
-    for subnet in response['Subnets']:
+    for subnet in subnets:
         if subnet['MapPublicIpOnLaunch']:
             return subnet['SubnetId']
-    
-    # If no public subnets exist, create a new one
-    availability_zones = ec2_client.describe_availability_zones()['AvailabilityZones']
-    availability_zone = availability_zones[0]['ZoneName']
-    
-    public_subnet_id = create_public_subnet(vpc_id, availability_zone)
-    create_route_to_internet_gateway(public_subnet_id, vpc_id)
-    
-    return public_subnet_id
 
-def launch_ec2_instance():
-    """Launch an EC2 instance in the first available public subnet of the given VPC."""
-    ec2 = boto3.resource('ec2')
+    # None yet: provision one, in the zone of a subnet an interrupted run left tagged if there is one
+    tagged = [subnet['AvailabilityZone'] for subnet in subnets if PUBLIC_SUBNET_TAG in subnet.get('Tags', [])]
+    if tagged:
+        availability_zone = tagged[0]
+    else:
+        zones = ec2_client.describe_availability_zones(
+            Filters=[{'Name': 'state', 'Values': ['available']}]
+        )['AvailabilityZones']
+        availability_zone = sorted(zone['ZoneName'] for zone in zones)[0]
+    return provision_public_subnets(vpc_id, [availability_zone])[availability_zone]
+
+# Nginx is installed into the image (or on boot), the web page is written on every boot
+nginx_recipe = {'packages': ['nginx'], 'services': ['nginx']}
+nginx_config_script = """echo "<html><body><h1>Welcome to my EC2 web server with Nginx!</h1><p>This is a simple web app served by Nginx.</p></body></html>" > /usr/share/nginx/html/index.html
+systemctl start nginx
+"""
+base_ami_id = 'ami-08d8ac128e0a1b91c'  # Replace with your preferred Amazon Linux 2 AMI ID
+default_vpc_id = 'vpc-03d760fe88b18680f'  # Replace with your VPC ID
+
+def launch_ec2_instance(bake=False, deadline=None):
+    """Launch an EC2 instance in the first available public subnet of the given VPC.
+
+    With `bake`, Nginx comes from an image baked once per recipe (see
+    image_bake.py) and the instance only runs the configuration on boot.
+    """
+    ec2 = get_resource('ec2')
 
     # Manually set your VPC ID
-    vpc_id = 'vpc-03d760fe88b18680f'  # Replace with your VPC ID
+    vpc_id = default_vpc_id
     
     # Retrieve the first available public subnet or create one
     subnet_id = get_public_subnet_from_vpc(vpc_id)
@@ -160,10 +275,12 @@ def launch_ec2_instance():
         sg = existing_groups[0]
     else:
         # Create the security group if it doesn't exist
+        # The stack tag lets the default stack's teardown find the group and instance made here
         sg = ec2.create_security_group(
             GroupName=group_name,
             Description=description,
-            VpcId=vpc_id
+            VpcId=vpc_id,
+            TagSpecifications=[{'ResourceType': 'security-group', 'Tags': StackSpec().stack_tags()}]
         )
         # Add ingress rules
         sg.authorize_ingress(
@@ -183,20 +300,19 @@ def launch_ec2_instance():
             ]
         )
 
-    # User data script for EC2 instance to install Nginx
-    user_data = '''#!/bin/bash
-    yum update -y
-    yum install -y nginx
-    systemctl start nginx
-    systemctl enable nginx
-
-    # Create a simple web page
-    echo "<html><body><h1>Welcome to my EC2 web server with Nginx!</h1><p>This is a simple web app served by Nginx.</p></body></html>" > /usr/share/nginx/html/index.html
-    '''
+    waiter = WaiterMultiplexer({'ec2': get_client('ec2')})
+    if bake:
+        image_id = get_baked_image(get_client('ec2'), waiter, base_ami_id, nginx_recipe, subnet_id, sg.id,
+                                   tags=StackSpec().stack_tags(), deadline=deadline)
+        user_data = config_user_data(nginx_config_script)
+    else:
+        # User data script for EC2 instance to install Nginx and create a simple web page
+        image_id = base_ami_id
+        user_data = full_user_data(nginx_recipe, nginx_config_script)
 
     # Launch EC2 instance with a network interface (no SubnetId at the instance level)
     instances = ec2.create_instances(
-        ImageId='ami-08d8ac128e0a1b91c',  # Replace with your preferred Amazon Linux 2 AMI ID
+        ImageId=image_id,
         InstanceType='t2.micro',
         UserData=user_data,
         MinCount=1,
@@ -206,19 +322,38 @@ def launch_ec2_instance():
             'DeviceIndex': 0,
             'AssociatePublicIpAddress': True,
             'Groups': [sg.id]
-        }]
+        }],
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': StackSpec().stack_tags()}]
     )
 
     instance = instances[0]
-    instance.wait_until_running()  # Wait until the instance is running
+    # Wait until the instance is running, polling through the shared batched waiter
+    waiter.wait('instance_running', instance.id)
     instance.reload()  # Reload the instance to get the updated attributes
 
     return instance
 
 def lambda_handler(event, context):
-    """Lambda function handler to launch the EC2 instance."""
+    """Lambda function handler to launch the EC2 instance.
+
+    An event with 'provision_subnets' instead makes sure the VPC ('vpc_id',
+    the default VPC when absent) has a public subnet in each of the
+    'availability_zones' (see provision_public_subnets) and launches nothing.
+    """
+    reset_stats()
     try:
-        instance = launch_ec2_instance()
+        # Every AWS call of the invocation is traced and summarised when it ends
+        with tracer.invocation('create_ec2'):
+            if event.get('provision_subnets'):
+                subnet_ids = provision_public_subnets(event.get('vpc_id', default_vpc_id),
+                                                      event.get('availability_zones'))
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps(f"Public subnets: {subnet_ids}")
+                }
+            # A bake that would outlive the invocation is left for the next one to resume
+            deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 60 if context else None
+            instance = launch_ec2_instance(bake=event.get('bake', False), deadline=deadline)
         return {
             'statusCode': 200,
             'body': json.dumps(f"EC2 instance launched with ID: {instance.id}, Public IP: {instance.public_ip_address}")
@@ -233,3 +368,6 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': json.dumps(f"Unexpected error: {str(e)}")
         }
+    finally:
+        # Reuse check: a warm invocation should create no new clients and few connections
+        print(f"AWS clients/connections created during this invocation: {get_stats()}")
@@ -1,22 +1,39 @@
-import boto3
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Initialize boto3 clients
-sns_client = boto3.client('sns')
-cloudwatch_client = boto3.client('cloudwatch')
+from aws_clients import LazyClient
+from instrumentation import tracer
+from sns_dispatcher import NotificationDispatcher
+from stack_manifest import load_manifest
+
+# boto3 clients, created on first use and shared across warm invocations
+sns_client = LazyClient('sns')
+cloudwatch_client = LazyClient('cloudwatch')
+
+# Endpoints already subscribed to each topic ARN, as (listed at, {(protocol, endpoint)}).
+# Reused for SUBSCRIPTIONS_TTL seconds across warm invocations: subscriptions can be
+# removed out of band, and a pending confirmation expires, so older lists are re-read.
+SUBSCRIPTIONS_TTL = 60
+_subscriptions = {}
+_subscriptions_lock = threading.Lock()
+
+# Coalesces bursts of alerts into publish_batch calls
+dispatcher = NotificationDispatcher(sns_client)
 
 # Step 1: Create SNS Topics for different alerts
-def create_sns_topic(topic_name):
-    """Create an SNS topic"""
-    response = sns_client.create_topic(Name=topic_name)
+def create_sns_topic(topic_name, client=None, tags=None):
+    """Create an SNS topic, with `tags` as [{'Key': ..., 'Value': ...}] if given"""
+    response = (client or sns_client).create_topic(Name=topic_name, **({'Tags': tags} if tags else {}))
     topic_arn = response['TopicArn']
     print(f"SNS Topic {topic_name} created with ARN: {topic_arn}")
     return topic_arn
 
 # Step 2: Subscribe to SNS topics (email or SMS)
-def subscribe_to_topic(topic_arn, protocol, endpoint):
+def subscribe_to_topic(topic_arn, protocol, endpoint, client=None):
     """Subscribe an email or SMS to the SNS topic"""
-    response = sns_client.subscribe(
+    response = (client or sns_client).subscribe(
         TopicArn=topic_arn,
         Protocol=protocol,  # 'email' or 'sms'
         Endpoint=endpoint  # Email address or phone number
@@ -24,6 +41,63 @@ def subscribe_to_topic(topic_arn, protocol, endpoint):
     print(f"Subscription to {topic_arn} with {protocol} endpoint {endpoint} created.")
     return response
 
+def list_topic_subscriptions(topic_arn, refresh=False, client=None):
+    """Return the (protocol, endpoint) pairs subscribed to a topic, including pending confirmations"""
+    with _subscriptions_lock:
+        cached = _subscriptions.get(topic_arn)
+        if not refresh and cached and time.monotonic() - cached[0] <= SUBSCRIPTIONS_TTL:
+            return cached[1]
+    listed_at = time.monotonic()
+    subscribed = set()
+    paginator = (client or sns_client).get_paginator('list_subscriptions_by_topic')
+    for page in paginator.paginate(TopicArn=topic_arn):
+        for subscription in page['Subscriptions']:
+            subscribed.add((subscription['Protocol'], subscription['Endpoint']))
+    with _subscriptions_lock:
+        _subscriptions[topic_arn] = (listed_at, subscribed)
+    return subscribed
+
+def forget_subscriptions(topic_arn):
+    """Drop the cached subscriptions of a deleted topic (a recreated topic gets the same ARN)"""
+    with _subscriptions_lock:
+        _subscriptions.pop(topic_arn, None)
+
+def provision_topics(topics, known_arns=None, max_workers=16, client=None, tags=None):
+    """Create the missing topics and subscriptions, in parallel, and return {topic name: ARN}.
+
+    `topics` maps a topic name to a list of (protocol, endpoint) pairs and
+    `known_arns` holds the ARNs of topics that already exist. Existing
+    subscriptions are read once per topic, so a repeated run subscribes
+    nothing and does not trigger duplicate confirmation messages. `client`
+    selects the SNS client (and so the region) to use, `tags` are put on created topics.
+    """
+    topic_arns = dict(known_arns or {})
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Step 1: create_topic is idempotent, but only call it for topics we do not know yet
+        missing = [name for name in topics if name not in topic_arns]
+        for name, topic_arn in zip(missing, executor.map(tracer.wrap(lambda name: create_sns_topic(name, client, tags)), missing)):
+            topic_arns[name] = topic_arn
+
+        # Step 2: read the current subscriptions of every topic
+        names = list(topics)
+        existing = dict(zip(names, executor.map(tracer.wrap(lambda name: list_topic_subscriptions(topic_arns[name], client=client)), names)))
+
+        # Step 3: subscribe only the endpoints that are not subscribed yet
+        wanted = [
+            (name, protocol, endpoint)
+            for name, endpoints in topics.items()
+            for protocol, endpoint in endpoints
+            if (protocol, endpoint) not in existing[name]
+        ]
+        list(executor.map(tracer.wrap(lambda pair: subscribe_to_topic(topic_arns[pair[0]], pair[1], pair[2], client)), wanted))
+
+    with _subscriptions_lock:
+        for name, protocol, endpoint in wanted:
+            if topic_arns[name] in _subscriptions:
+                _subscriptions[topic_arns[name]][1].add((protocol, endpoint))
+    print(f"SNS topics provisioned: {len(missing)} topics created, {len(wanted)} subscriptions added.")
+    return topic_arns
+
 # Step 3: Publish SNS notifications
 def send_sns_notification(topic_arn, subject, message):
     """Publish a message to the SNS topic"""
@@ -58,69 +132,72 @@ def create_cpu_utilization_alarm(instance_id, lambda_function_arn):
     print(f"CloudWatch Alarm for CPU utilization on instance {instance_id} created.")
 
 # Hardcoded Setup Function
-def setup_sns_and_cloudwatch():
+def setup_sns_and_cloudwatch(instance_id):
     """Set up SNS topics, subscriptions, and CloudWatch alarms with hardcoded values"""
 
-    # Step 1: Create SNS topics and store the ARNs
-    health_topic_arn = create_sns_topic("HealthIssuesAlert-deb-sep25")
-    scaling_topic_arn = create_sns_topic("ScalingEventsAlert-deb-sep25")
-    traffic_topic_arn = create_sns_topic("HighTrafficAlert-deb-sep25")
-
-    # Step 2: Subscribe to SNS topics with provided email and phone number
-    subscribe_to_topic(health_topic_arn, 'email', 'debkiitian@gmail.com')  # Health alerts to email
-    subscribe_to_topic(health_topic_arn, 'sms', '+919731429550')  # Health alerts to SMS
-
-    subscribe_to_topic(scaling_topic_arn, 'email', 'debkiitian@gmail.com')  # Scaling alerts to email
-    subscribe_to_topic(scaling_topic_arn, 'sms', '+919731429550')  # Scaling alerts to SMS
-
-    subscribe_to_topic(traffic_topic_arn, 'email', 'debkiitian@gmail.com')  # Traffic alerts to email
-    subscribe_to_topic(traffic_topic_arn, 'sms', '+919731429550')  # Traffic alerts to SMS
+    # Step 1 and 2: Create the SNS topics and subscribe the email and phone number to each
+    # Health, scaling and traffic alerts all go to email and SMS
+    endpoints = [('email', 'debkiitian@gmail.com'), ('sms', '+919731429550')]
+    topic_arns = provision_topics({
+        "HealthIssuesAlert-deb-sep25": endpoints,
+        "ScalingEventsAlert-deb-sep25": endpoints,
+        "HighTrafficAlert-deb-sep25": endpoints,
+    })
 
     # Step 4: Create a CloudWatch alarm to monitor CPU utilization
-    instance_id = 'i-0eb03044b7278fb4f'  # EC2 instance ID hardcoded
     lambda_function_arn = 'arn:aws:lambda:us-west-2:975050024946:function:create_s3_deb_sept25'  # Lambda ARN hardcoded
     create_cpu_utilization_alarm(instance_id, lambda_function_arn)
 
     # Return the ARNs to use them in notifications
     return {
-        'health': health_topic_arn,
-        'scaling': scaling_topic_arn,
-        'traffic': traffic_topic_arn
+        'health': topic_arns["HealthIssuesAlert-deb-sep25"],
+        'scaling': topic_arns["ScalingEventsAlert-deb-sep25"],
+        'traffic': topic_arns["HighTrafficAlert-deb-sep25"]
     }
 
 # Hardcoded Notification Sending Function
-def send_notifications(topic_arns):
+def send_notifications(topic_arns, instance_id):
     """Send hardcoded notifications for different alert types using actual topic ARNs"""
 
-    # Hardcoded Instance ID
-    instance_id = 'i-0eb03044b7278fb4f'  # EC2 instance ID hardcoded
-    
     # Send Scaling Notification
     subject = 'Scaling Event Detected'
     message = f"An Auto Scaling event occurred on instance {instance_id}."
-    send_sns_notification(topic_arns['scaling'], subject, message)
+    dispatcher.notify(topic_arns['scaling'], 'scaling', instance_id, subject, message)
 
     # Send Health Notification
     subject = 'Health Issue Detected'
     message = f"Health check failure detected for instance {instance_id}."
-    send_sns_notification(topic_arns['health'], subject, message)
+    dispatcher.notify(topic_arns['health'], 'health', instance_id, subject, message)
 
     # Send High Traffic Notification
     subject = 'High Traffic Alert'
     message = f"High traffic detected on instance {instance_id}."
-    send_sns_notification(topic_arns['traffic'], subject, message)
+    dispatcher.notify(topic_arns['traffic'], 'traffic', instance_id, subject, message)
+
+    # Publish before the invocation returns, the container may be frozen right after
+    dispatcher.close()
 
 # Combined Setup and Notification Function (Hardcoded)
 def lambda_handler(event, context):
     """Lambda function to set up SNS topics, subscriptions, CloudWatch alarms, and send notifications"""
-
-    # Step 1: Set up SNS topics, subscriptions, and CloudWatch alarm (hardcoded)
-    topic_arns = setup_sns_and_cloudwatch()
-
-    # Step 2: Send hardcoded notifications using actual topic ARNs
-    send_notifications(topic_arns)
-
-    return {
-        'statusCode': 200,
-        'body': json.dumps("SNS topics, CloudWatch alarms, and notifications successfully set up and sent.")
-    }
+    # Every AWS call of the invocation is traced and summarised when it ends
+    with tracer.invocation('create_sns_topic'):
+        # Take the instance from the event, or the one the stack manifest recorded
+        instance = load_manifest().get('instance', 'MyAppInstance') or {}
+        instance_id = event.get('instance_id') or instance.get('id')
+        if not instance_id:
+            return {
+                'statusCode': 400,
+                'body': json.dumps("Error: no instance_id in the event and none recorded in the stack manifest")
+            }
+
+        # Step 1: Set up SNS topics, subscriptions, and CloudWatch alarm (hardcoded)
+        topic_arns = setup_sns_and_cloudwatch(instance_id)
+
+        # Step 2: Send hardcoded notifications using actual topic ARNs
+        send_notifications(topic_arns, instance_id)
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps("SNS topics, CloudWatch alarms, and notifications successfully set up and sent.")
+        }
@@ -1,387 +1,1169 @@
-import boto3
+import base64
+import contextlib
 import json
+import math
+import threading
+import time
+from functools import partial
 
-# Initialize boto3 clients
-ec2_client = boto3.client('ec2')
-sns_client = boto3.client('sns')
-cloudwatch_client = boto3.client('cloudwatch')
-elb_client = boto3.client('elbv2')
-asg_client = boto3.client('autoscaling')
-s3_client = boto3.client('s3')
-
-# Infrastructure Parameters
-key_name = 'deb-key-pair-sept25'
-instance_type = 't2.micro'
-ami_id = 'ami-08d8ac128e0a1b91c'
-subnet_ids = ['subnet-0fd07baca9b6e64fa', 'subnet-1fd07baca9b6e64fb']  # Replace with your subnet IDs in different AZs
-security_group_id = 'sg-0ae83dc5b0560641b'
-bucket_name = 'your-webapp-static-files-deb-sep251'
-alb_name = 'deb-alb-sep25'
-target_group_name = 'Deb-target-group-sep25'
-auto_scaling_group_name = 'Deb-auto-scaling-group-sep25'
-launch_template_name = 'Deb-launch-template-sep25'
-alarm_name = 'HighCPUUtilization-deb-sept25'
-lambda_function_arn = 'arn:aws:lambda:us-west-2:975050024946:function:create_s3_deb_sept25'
-
-# Hardcoded email and phone number
-email = 'debkiitian@gmail.com'
-phone_number = '+919731429550'
-
-# Multiple SNS Topics
-sns_topics = {
-    "HealthIssuesAlert-deb-sep252": {
-        "email": email,
-        "sms": phone_number
-    },
-    "ScalingEventsAlert-deb-sep252": {
-        "email": email,
-        "sms": phone_number
-    },
-    "HighTrafficAlert-deb-sep25-2": {
-        "email": email,
-        "sms": phone_number
-    }
-}
+from botocore.exceptions import ClientError
+
+from aws_clients import LazyClient, get_stats, reset_stats
+from create_asg import delete_warm_pool, launch_template_data_hash, put_launch_template, put_warm_pool
+from create_sns_topic import forget_subscriptions, provision_topics
+from dag_executor import run_dag, subgraph
+from fanout import fan_out
+from image_bake import BakeInProgress, config_user_data, full_user_data, get_baked_image, recipe_hash
+from instrumentation import tracer
+from inventory import (
+    discover_auto_scaling_group, discover_bucket, discover_instances, discover_launch_template,
+    discover_load_balancer, discover_target_group, drop_snapshot, get_snapshot, launch_template_record
+)
+from s3_purge import purge_bucket
+from stack_manifest import load_manifest
+from stack_plan import build_plan, format_plan
+from stack_spec import STACK_TAG_KEY, StackSpec, warm_pool_label
+from waiters import WaiterMultiplexer
+
+# What the web server image needs installed, and the per-instance configuration on top of it
+web_recipe = {'packages': ['httpd'], 'services': ['httpd']}
+web_config_script = """echo "Hello from WebApp" > /var/www/html/index.html
+systemctl start httpd
+"""
+
+# Boot script that installs and starts the web server, and the one for an image that has it baked in
+web_user_data = full_user_data(web_recipe, web_config_script)
+web_config_user_data = config_user_data(web_config_script)
+
+# register_targets calls are split into chunks of this many instances
+register_targets_chunk_size = 50
+# tag_resources takes at most this many ARNs per call
+tag_resources_chunk_size = 20
+# Kinds of resources deploy makes sure carry the stack tag: the ones discovery finds through it
+tagged_kinds = ('instance', 'load_balancer', 'target_group', 'bucket', 'alarm', 'sns_topic')
+
+# Seconds of the invocation a bake leaves for the deploy steps after it
+bake_time_reserve = 120
+
+# Services every stack talks to
+stack_services = ('ec2', 'elbv2', 'autoscaling', 's3', 'cloudwatch', 'sns', 'resourcegroupstaggingapi')
+
+# One polling loop per region and profile, shared by every wait of every stack there
+_waiters = {}
+_stacks = {}
+_stacks_lock = threading.Lock()
+
+
+class Stack:
+    """A stack spec bound to the clients, waiter and manifest of its account and region"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        # boto3 clients, created on first use and shared across warm invocations and stacks of the region
+        self.clients = {service: LazyClient(service, spec.region, spec.profile_name) for service in stack_services}
+        self.ec2_client = self.clients['ec2']
+        self.sns_client = self.clients['sns']
+        self.cloudwatch_client = self.clients['cloudwatch']
+        self.elb_client = self.clients['elbv2']
+        self.asg_client = self.clients['autoscaling']
+        self.s3_client = self.clients['s3']
+        self.waiter = _waiters.setdefault((spec.region, spec.profile_name), WaiterMultiplexer(self.clients))
+        self.manifest = load_manifest(spec.manifest_location())
+        # The snapshot an action runs on, see pin_snapshot
+        self._pinning = False
+        self._pinned = None
+
+    def snapshot(self, refresh=False, attributes=True):
+        """Return the stack inventory, discovered in one pass and reused across warm invocations"""
+        if self._pinned is not None and not refresh:
+            return self._pinned
+        # IDs recorded in the manifest by earlier runs are looked up directly instead of by name
+        snapshot = get_snapshot(self.clients, self.spec.names(), refresh=refresh,
+                                known=self.manifest.known_ids(), scope=self.spec.scope(), attributes=attributes)
+        if self._pinning:
+            self._pinned = snapshot
+        return snapshot
+
+    @contextlib.contextmanager
+    def pin_snapshot(self):
+        """Keep every step of an action on one snapshot.
+
+        The snapshot's TTL then only applies between actions: a rediscovery
+        halfway through cannot drop records the earlier steps made.
+        """
+        self._pinning = True
+        try:
+            yield self
+        finally:
+            self._pinning = False
+            self._pinned = None
+
+    def drop_snapshot(self):
+        self._pinned = None
+        drop_snapshot(self.spec.names(), scope=self.spec.scope())
+
+    def image_id(self):
+        """The AMI instances should boot, None while the baked image for the spec is not known yet"""
+        if not self.spec.bake_image:
+            return self.spec.ami_id
+        entry = self.manifest.get('image', recipe_hash(self.spec.ami_id, web_recipe))
+        return entry['id'] if entry else None
+
+    def rolled_out_image_id(self):
+        """The AMI an update rolled the ASG onto, None while it runs the stack's image.
+
+        Kept in the manifest under the spec's ami_id, so changing the spec's
+        AMI puts deploy back in charge of the launch template's image.
+        """
+        entry = self.manifest.get('rollout', self.spec.ami_id)
+        return entry['id'] if entry else None
+
+    def user_data(self):
+        """Boot script for the stack's instances: config only when the packages are baked into the image"""
+        return web_config_user_data if self.spec.bake_image else web_user_data
+
+    def resource_names(self, kind):
+        """All names of one kind of resource in this stack"""
+        if kind == 'sns_topic':
+            return list(self.spec.sns_topics)
+        if kind == 'listener':
+            return [self.spec.alb_name]
+        return [self.spec.names()[kind]]
+
+    def __repr__(self):
+        return f"Stack({self.spec.name!r}, region={self.spec.region!r})"
+
+
+def get_stack(spec=None):
+    """Return the Stack for a spec (the original stack by default), reused across warm invocations"""
+    spec = spec or StackSpec()
+    key = spec.key()
+    with _stacks_lock:
+        if key not in _stacks:
+            _stacks[key] = Stack(spec)
+        return _stacks[key]
+
+def sync_manifest(stack, *kinds):
+    """Copy what the snapshot knows about these kinds of resources into the stack manifest"""
+    snapshot = stack.snapshot()
+    for kind in kinds:
+        for name in stack.resource_names(kind):
+            if not snapshot.is_known(kind, name):
+                continue
+            record = snapshot.get(kind, name)
+            if record:
+                stack.manifest.record(kind, name, record['id'], record.get('arn'), record.get('version'))
+            else:
+                stack.manifest.remove(kind, name)
+
+def with_manifest(stack, func, *kinds):
+    """Wrap a deploy or teardown step so the manifest is saved as soon as it finishes"""
+    def step(*args):
+        result = func(stack, *args)
+        sync_manifest(stack, *kinds)
+        return result
+    return step
 
 ### DEPLOY INFRASTRUCTURE ###
 
-def create_s3_bucket():
+def create_s3_bucket(stack):
     """Create an S3 bucket to store web app static files"""
-    region = 'us-west-2'
-    try:
-        response = s3_client.head_bucket(Bucket=bucket_name)
+    bucket_name = stack.spec.bucket_name
+    s3_client = stack.s3_client
+    region = s3_client.meta.region_name
+    snapshot = stack.snapshot()
+    if snapshot.lookup('bucket', bucket_name, lambda: discover_bucket(stack.clients, bucket_name)):
         print(f"S3 bucket '{bucket_name}' already exists.")
-    except:
-        try:
-            if region == 'us-east-1':
-                s3_client.create_bucket(Bucket=bucket_name)
-            else:
-                s3_client.create_bucket(
-                    Bucket=bucket_name,
-                    CreateBucketConfiguration={
-                        'LocationConstraint': region
-                    }
-                )
-            print(f"S3 bucket '{bucket_name}' created in region {region}.")
-        except Exception as e:
-            print(f"Error creating S3 bucket: {e}")
+        return
+    try:
+        if region == 'us-east-1':
+            s3_client.create_bucket(Bucket=bucket_name)
+        else:
+            s3_client.create_bucket(
+                Bucket=bucket_name,
+                CreateBucketConfiguration={
+                    'LocationConstraint': region
+                }
+            )
+        s3_client.put_bucket_tagging(Bucket=bucket_name, Tagging={'TagSet': stack.spec.stack_tags()})
+        snapshot.record('bucket', bucket_name, {'id': bucket_name, 'arn': f"arn:aws:s3:::{bucket_name}", 'state': None,
+                                                'tags': stack.spec.stack_tag()})
+        print(f"S3 bucket '{bucket_name}' created in region {region}.")
+    except ClientError as e:
+        print(f"Error creating S3 bucket: {e}")
+
+def bake_stack_image(stack, deadline=None):
+    """Bake the web server into an image based on the spec's AMI, or reuse the one baked from the same recipe.
 
-def find_ec2_instance_by_name(instance_name):
+    `deadline` is when the invocation ends (a time.monotonic() value); a bake
+    that would run past it is left to the next deploy or bake to finish.
+    """
+    spec = stack.spec
+    return get_baked_image(stack.ec2_client, stack.waiter, spec.ami_id, web_recipe, spec.subnet_ids[0],
+                           spec.security_group_id, manifest=stack.manifest, instance_type=spec.instance_type,
+                           name_prefix=spec.name, tags=spec.stack_tags(),
+                           deadline=None if deadline is None else deadline - bake_time_reserve)
+
+def ensure_image(stack, deadline=None):
+    """The AMI to launch instances from: the spec's AMI, or with bake_image the image baked from it"""
+    if not stack.spec.bake_image:
+        return stack.spec.ami_id
+    return bake_stack_image(stack, deadline)
+
+def find_ec2_instance_by_name(stack, instance_name):
     """Check if an EC2 instance with the given name exists"""
-    filters = [{'Name': 'tag:Name', 'Values': [instance_name]}]
-    instances = ec2_client.describe_instances(Filters=filters)
-    if instances['Reservations']:
-        instance_id = instances['Reservations'][0]['Instances'][0]['InstanceId']
-        instance_state = instances['Reservations'][0]['Instances'][0]['State']['Name']
-        print(f"Found existing EC2 instance with ID {instance_id} in state {instance_state}.")
-        return instance_id, instance_state
+    def describe():
+        instances = discover_instances(stack.clients, instance_name)
+        return instances[0] if instances else None
+
+    instance = stack.snapshot().lookup('instance', instance_name, describe)
+    if instance:
+        print(f"Found existing EC2 instance with ID {instance['id']} in state {instance['state']}.")
+        return instance['id'], instance['state']
     return None, None
 
-def deploy_ec2_instance():
+def deploy_ec2_instance(stack, image_id=None):
     """Deploy an EC2 instance and wait until it's in running state."""
-    instance_id, instance_state = find_ec2_instance_by_name('MyAppInstance')
+    spec = stack.spec
+    instance_id, instance_state = find_ec2_instance_by_name(stack, spec.instance_name)
     
     if instance_id and instance_state == 'running':
         print(f"EC2 instance with ID {instance_id} is already running.")
         return instance_id
     elif instance_id and instance_state != 'terminated':
+        if instance_state in ('stopping', 'stopped'):
+            stack.waiter.wait('instance_stopped', instance_id)
+            stack.ec2_client.start_instances(InstanceIds=[instance_id])
+            print(f"Starting stopped EC2 instance {instance_id}...")
         print(f"Waiting for EC2 instance {instance_id} to reach running state...")
-        ec2_client.get_waiter('instance_running').wait(InstanceIds=[instance_id])
+        stack.waiter.wait('instance_running', instance_id)
         print(f"EC2 instance {instance_id} is now running.")
-        return instance_id
     else:
         print("Launching new EC2 instance...")
-        instances = ec2_client.run_instances(
-            ImageId=ami_id,
-            InstanceType=instance_type,
-            KeyName=key_name,
+        instances = stack.ec2_client.run_instances(
+            ImageId=image_id or spec.ami_id,
+            InstanceType=spec.instance_type,
+            KeyName=spec.key_name,
             MinCount=1,
             MaxCount=1,
             NetworkInterfaces=[
                 {
-                    'SubnetId': subnet_ids[0],
+                    'SubnetId': spec.subnet_ids[0],
                     'DeviceIndex': 0,
                     'AssociatePublicIpAddress': True,
-                    'Groups': [security_group_id]
+                    'Groups': [spec.security_group_id]
                 }
             ],
             TagSpecifications=[
                 {
                     'ResourceType': 'instance',
-                    'Tags': [{'Key': 'Name', 'Value': 'MyAppInstance'}]
+                    'Tags': [{'Key': 'Name', 'Value': spec.instance_name}] + spec.stack_tags()
                 }
             ],
-            UserData="""#!/bin/bash
-            sudo yum update -y
-            sudo yum install -y httpd
-            sudo systemctl start httpd
-            sudo systemctl enable httpd
-            echo "Hello from WebApp" > /var/www/html/index.html
-            """
+            UserData=stack.user_data()
         )
         instance_id = instances['Instances'][0]['InstanceId']
         print(f"New EC2 instance launched with ID: {instance_id}")
 
         # Wait for the instance to enter running state
         print(f"Waiting for EC2 instance {instance_id} to reach running state...")
-        ec2_client.get_waiter('instance_running').wait(InstanceIds=[instance_id])
+        stack.waiter.wait('instance_running', instance_id)
         print(f"EC2 instance {instance_id} is now running.")
-        return instance_id
 
-def create_application_load_balancer():
+    stack.snapshot().record('instance', spec.instance_name, {
+        'id': instance_id, 'arn': None, 'state': 'running', 'tags': dict(spec.stack_tag(), Name=spec.instance_name)
+    })
+    return instance_id
+
+def launch_fleet(stack, count, deadline=None):
+    """Make sure `count` instances of the stack are running, spread across all subnets.
+
+    Missing instances are launched with one run_instances call per subnet and
+    waited on together, so a 50-node fleet costs a handful of API calls.
+    """
+    spec = stack.spec
+    existing = [instance['id'] for instance in discover_instances(stack.clients, spec.instance_name)]
+    missing = count - len(existing)
+    print(f"Fleet has {len(existing)} of {count} instances.")
+
+    launched = []
+    if missing > 0:
+        image_id = ensure_image(stack, deadline)
+        # Round-robin the missing instances over the subnets (one per AZ)
+        per_subnet = [missing // len(spec.subnet_ids) + (1 if i < missing % len(spec.subnet_ids) else 0)
+                      for i in range(len(spec.subnet_ids))]
+        for subnet_id, subnet_count in zip(spec.subnet_ids, per_subnet):
+            if not subnet_count:
+                continue
+            response = stack.ec2_client.run_instances(
+                ImageId=image_id,
+                InstanceType=spec.instance_type,
+                KeyName=spec.key_name,
+                MinCount=subnet_count,
+                MaxCount=subnet_count,
+                NetworkInterfaces=[
+                    {
+                        'SubnetId': subnet_id,
+                        'DeviceIndex': 0,
+                        'AssociatePublicIpAddress': True,
+                        'Groups': [spec.security_group_id]
+                    }
+                ],
+                TagSpecifications=[
+                    {
+                        'ResourceType': 'instance',
+                        'Tags': [{'Key': 'Name', 'Value': spec.instance_name}] + spec.stack_tags()
+                    }
+                ],
+                UserData=stack.user_data()
+            )
+            launched.extend(instance['InstanceId'] for instance in response['Instances'])
+        print(f"Launched {len(launched)} instances, waiting for them to reach running state...")
+        stack.waiter.wait_all([('instance_running', instance_id) for instance_id in launched])
+        stack.snapshot().invalidate('instance', spec.instance_name)
+
+    return existing + launched
+
+def create_application_load_balancer(stack):
     """Create an Application Load Balancer (ALB)"""
-    response = elb_client.describe_load_balancers(Names=[alb_name])
-    if response['LoadBalancers']:
-        alb_arn = response['LoadBalancers'][0]['LoadBalancerArn']
-        print(f"ALB '{alb_name}' already exists with ARN: {alb_arn}")
+    spec = stack.spec
+    snapshot = stack.snapshot()
+    alb = snapshot.lookup('load_balancer', spec.alb_name, lambda: discover_load_balancer(stack.clients, spec.alb_name)[0])
+    if alb:
+        alb_arn = alb['arn']
+        print(f"ALB '{spec.alb_name}' already exists with ARN: {alb_arn}")
         return alb_arn
     else:
-        response = elb_client.create_load_balancer(
-            Name=alb_name,
-            Subnets=subnet_ids,
-            SecurityGroups=[security_group_id],
+        response = stack.elb_client.create_load_balancer(
+            Name=spec.alb_name,
+            Subnets=spec.subnet_ids,
+            SecurityGroups=[spec.security_group_id],
             Scheme='internet-facing',
             Type='application',
-            IpAddressType='ipv4'
+            IpAddressType='ipv4',
+            Tags=spec.stack_tags()
         )
         alb_arn = response['LoadBalancers'][0]['LoadBalancerArn']
+        snapshot.record('load_balancer', spec.alb_name, {'id': spec.alb_name, 'arn': alb_arn, 'state': 'provisioning',
+                                                         'tags': spec.stack_tag()})
+        snapshot.record('listener', spec.alb_name, None)
         print(f"ALB created with ARN: {alb_arn}")
         return alb_arn
 
-def create_target_group(vpc_id):
+def create_target_group(stack, vpc_id):
     """Create a Target Group for the ALB"""
-    response = elb_client.describe_target_groups(Names=[target_group_name])
-    if response['TargetGroups']:
-        target_group_arn = response['TargetGroups'][0]['TargetGroupArn']
-        print(f"Target Group '{target_group_name}' already exists with ARN: {target_group_arn}")
+    spec = stack.spec
+    snapshot = stack.snapshot()
+    target_group = snapshot.lookup('target_group', spec.target_group_name,
+                                   lambda: discover_target_group(stack.clients, spec.target_group_name))
+    if target_group:
+        target_group_arn = target_group['arn']
+        print(f"Target Group '{spec.target_group_name}' already exists with ARN: {target_group_arn}")
+        if target_group.get('attributes', {}).get('HealthCheckPath') not in (None, spec.health_check_path):
+            stack.elb_client.modify_target_group(TargetGroupArn=target_group_arn, HealthCheckPath=spec.health_check_path)
+            snapshot.invalidate('target_group', spec.target_group_name)
+            print(f"Target Group '{spec.target_group_name}' health check path set to {spec.health_check_path}.")
         return target_group_arn
     else:
-        response = elb_client.create_target_group(
-            Name=target_group_name,
+        response = stack.elb_client.create_target_group(
+            Name=spec.target_group_name,
             Protocol='HTTP',
             Port=80,
             VpcId=vpc_id,
             TargetType='instance',
             HealthCheckProtocol='HTTP',
-            HealthCheckPath='/'
+            HealthCheckPath=spec.health_check_path,
+            Tags=spec.stack_tags()
         )
         target_group_arn = response['TargetGroups'][0]['TargetGroupArn']
+        snapshot.record('target_group', spec.target_group_name,
+                        {'id': spec.target_group_name, 'arn': target_group_arn, 'state': None, 'targets': {},
+                         'tags': spec.stack_tag()})
         print(f"Target Group created with ARN: {target_group_arn}")
         return target_group_arn
 
-def register_targets(target_group_arn, instance_id):
-    """Register EC2 instances with the Target Group"""
-    response = elb_client.describe_target_health(TargetGroupArn=target_group_arn)
-    targets = [target['Target']['Id'] for target in response['TargetHealthDescriptions']]
-    
-    if instance_id in targets:
-        print(f"EC2 instance {instance_id} is already registered with Target Group {target_group_arn}.")
+def register_fleet_targets(stack, target_group_arn, instance_ids):
+    """Register many EC2 instances with the Target Group, skipping those already registered"""
+    snapshot = stack.snapshot()
+    target_group = snapshot.get_by_arn(target_group_arn)
+    if target_group is None:
+        response = stack.elb_client.describe_target_health(TargetGroupArn=target_group_arn)
+        targets = {target['Target']['Id']: target['TargetHealth']['State'] for target in response['TargetHealthDescriptions']}
     else:
-        elb_client.register_targets(
+        targets = target_group['targets']
+
+    missing = [instance_id for instance_id in instance_ids if instance_id not in targets]
+    if not missing:
+        print(f"EC2 instances {instance_ids} are already registered with Target Group {target_group_arn}.")
+        return []
+
+    for i in range(0, len(missing), register_targets_chunk_size):
+        stack.elb_client.register_targets(
             TargetGroupArn=target_group_arn,
-            Targets=[{'Id': instance_id}]
+            Targets=[{'Id': instance_id} for instance_id in missing[i:i + register_targets_chunk_size]]
         )
-        print(f"EC2 instance {instance_id} registered with Target Group {target_group_arn}")
+    if target_group is not None:
+        snapshot.record('target_group', target_group['name'],
+                        dict(target_group, targets=dict(targets, **{instance_id: 'initial' for instance_id in missing})))
+    print(f"EC2 instances {missing} registered with Target Group {target_group_arn}")
+    return missing
+
+def register_targets(stack, target_group_arn, instance_id):
+    """Register EC2 instances with the Target Group"""
+    return register_fleet_targets(stack, target_group_arn, [instance_id])
 
-def create_listener(alb_arn, target_group_arn):
+def create_listener(stack, alb_arn, target_group_arn):
     """Create a listener for the ALB"""
-    response = elb_client.describe_listeners(LoadBalancerArn=alb_arn)
-    if response['Listeners']:
+    spec = stack.spec
+    snapshot = stack.snapshot()
+
+    def describe():
+        listeners = stack.elb_client.describe_listeners(LoadBalancerArn=alb_arn)['Listeners']
+        return {'id': listeners[0]['ListenerArn'], 'arn': listeners[0]['ListenerArn'], 'state': None} if listeners else None
+
+    if snapshot.lookup('listener', spec.alb_name, describe):
         print(f"Listener already exists for ALB {alb_arn}.")
     else:
-        elb_client.create_listener(
+        response = stack.elb_client.create_listener(
             LoadBalancerArn=alb_arn,
             Protocol='HTTP',
             Port=80,
-            DefaultActions=[{'Type': 'forward', 'TargetGroupArn': target_group_arn}]
+            DefaultActions=[{'Type': 'forward', 'TargetGroupArn': target_group_arn}],
+            Tags=spec.stack_tags()
         )
+        listener_arn = response['Listeners'][0]['ListenerArn']
+        snapshot.record('listener', spec.alb_name, {'id': listener_arn, 'arn': listener_arn, 'state': None})
         print(f"Listener created for ALB {alb_arn}")
 
-def create_launch_template():
-    """Create a launch template for the ASG"""
-    response = ec2_client.describe_launch_templates(LaunchTemplateNames=[launch_template_name])
-    if response['LaunchTemplates']:
-        template_id = response['LaunchTemplates'][0]['LaunchTemplateId']
-        print(f"Launch template '{launch_template_name}' already exists with ID: {template_id}")
-        return template_id
-    else:
-        response = ec2_client.create_launch_template(
-            LaunchTemplateName=launch_template_name,
-            LaunchTemplateData={
-                'ImageId': ami_id,
-                'InstanceType': instance_type,
-                'KeyName': key_name,
-                'NetworkInterfaces': [
-                    {
-                        'SubnetId': subnet_ids[0],
-                        'DeviceIndex': 0,
-                        'AssociatePublicIpAddress': True,
-                        'Groups': [security_group_id]
-                    }
-                ],
-                'UserData': """#!/bin/bash
-                sudo yum update -y
-                sudo yum install -y httpd
-                sudo systemctl start httpd
-                sudo systemctl enable httpd
-                echo "Hello from WebApp" > /var/www/html/index.html
-                """
+def launch_template_data(stack, image_id=None):
+    """LaunchTemplateData of the stack's ASG instances, booting `image_id`, the rolled-out AMI or the stack's image"""
+    spec = stack.spec
+    return {
+        'ImageId': image_id or stack.rolled_out_image_id() or stack.image_id() or spec.ami_id,
+        'InstanceType': spec.instance_type,
+        'KeyName': spec.key_name,
+        'NetworkInterfaces': [
+            {
+                'SubnetId': spec.subnet_ids[0],
+                'DeviceIndex': 0,
+                'AssociatePublicIpAddress': True,
+                'Groups': [spec.security_group_id]
             }
-        )
-        template_id = response['LaunchTemplate']['LaunchTemplateId']
-        print(f"Launch template created with ID: {template_id}")
-        return template_id
-
-def create_auto_scaling_group(template_id, target_group_arn):
-    """Create an Auto Scaling Group (ASG)"""
-    response = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[auto_scaling_group_name])
-    if response['AutoScalingGroups']:
-        print(f"Auto Scaling Group '{auto_scaling_group_name}' already exists.")
+        ],
+        # Launch templates, unlike run_instances, take the user data base64-encoded
+        'UserData': base64.b64encode(stack.user_data().encode()).decode()
+    }
+
+def put_stack_launch_template(stack, data):
+    """Bring the launch template to `data` (see create_asg.put_launch_template) and return its record"""
+    spec = stack.spec
+    snapshot = stack.snapshot()
+    template = snapshot.lookup('launch_template', spec.launch_template_name,
+                               lambda: discover_launch_template(stack.clients, spec.launch_template_name))
+    latest = template['data'] if template else None
+    version, changed = put_launch_template(spec.launch_template_name, data, latest, client=stack.ec2_client,
+                                           tags=spec.stack_tags())
+    if changed:
+        template = snapshot.record('launch_template', spec.launch_template_name, launch_template_record(version))
+    return template
+
+def create_launch_template(stack, image_id=None):
+    """Create the launch template for the ASG, or a new version of it when its data changed"""
+    # An AMI rolled out by an update stays until the spec's ami_id changes
+    return put_stack_launch_template(stack, launch_template_data(stack, stack.rolled_out_image_id() or image_id))['id']
+
+def create_auto_scaling_group(stack, template_id, target_group_arn):
+    """Create an Auto Scaling Group (ASG), or bring its sizes, launch template version and warm pool in line with the spec"""
+    spec = stack.spec
+    snapshot = stack.snapshot()
+    asg = snapshot.lookup('auto_scaling_group', spec.auto_scaling_group_name,
+                          lambda: discover_auto_scaling_group(stack.clients, spec.auto_scaling_group_name))
+    warm_pool = spec.warm_pool_configuration()
+    # The group is pinned to the template's latest version, which the launch_template step keeps in line with the spec
+    template = snapshot.lookup('launch_template', spec.launch_template_name,
+                               lambda: discover_launch_template(stack.clients, spec.launch_template_name))
+    version = str(template['version'])
+    if asg:
+        print(f"Auto Scaling Group '{spec.auto_scaling_group_name}' already exists.")
+        attributes = asg.get('attributes', {})
+        if attributes.get('WarmPool') not in (None, warm_pool_label(warm_pool)):
+            if warm_pool:
+                put_warm_pool(spec.auto_scaling_group_name, warm_pool, client=stack.asg_client)
+            else:
+                delete_warm_pool(spec.auto_scaling_group_name, client=stack.asg_client)
+            snapshot.invalidate('auto_scaling_group', spec.auto_scaling_group_name)
+        changes = {}
+        if attributes and (attributes['MinSize'], attributes['MaxSize']) != (spec.asg_min_size, spec.asg_max_size):
+            changes.update(MinSize=spec.asg_min_size, MaxSize=spec.asg_max_size)
+        if attributes and attributes.get('LaunchTemplateVersion') != version:
+            # Only instances launched from now on use the new version, `update` with an AMI replaces running ones
+            changes['LaunchTemplate'] = {'LaunchTemplateId': template_id, 'Version': version}
+        if changes:
+            stack.asg_client.update_auto_scaling_group(AutoScalingGroupName=spec.auto_scaling_group_name, **changes)
+            snapshot.invalidate('auto_scaling_group', spec.auto_scaling_group_name)
+            if 'MinSize' in changes:
+                print(f"Auto Scaling Group '{spec.auto_scaling_group_name}' resized to {spec.asg_min_size}-{spec.asg_max_size}.")
+            if 'LaunchTemplate' in changes:
+                print(f"Auto Scaling Group '{spec.auto_scaling_group_name}' pinned to launch template version {version}.")
     else:
-        asg_client.create_auto_scaling_group(
-            AutoScalingGroupName=auto_scaling_group_name,
-            LaunchTemplate={'LaunchTemplateId': template_id},
-            MinSize=1,
-            MaxSize=3,
-            DesiredCapacity=1,
+        stack.asg_client.create_auto_scaling_group(
+            AutoScalingGroupName=spec.auto_scaling_group_name,
+            LaunchTemplate={'LaunchTemplateId': template_id, 'Version': version},
+            MinSize=spec.asg_min_size,
+            MaxSize=spec.asg_max_size,
+            DesiredCapacity=spec.asg_desired_capacity,
             TargetGroupARNs=[target_group_arn],
-            VPCZoneIdentifier=",".join(subnet_ids)
+            VPCZoneIdentifier=",".join(spec.subnet_ids),
+            # Propagated to the instances the group launches, so they are found with the rest of the stack
+            Tags=[dict(tag, PropagateAtLaunch=True) for tag in spec.stack_tags()]
         )
-        print(f"Auto Scaling Group '{auto_scaling_group_name}' created.")
+        if warm_pool:
+            put_warm_pool(spec.auto_scaling_group_name, warm_pool, client=stack.asg_client)
+        snapshot.record('auto_scaling_group', spec.auto_scaling_group_name, {
+            'id': spec.auto_scaling_group_name, 'arn': None, 'state': None,
+            'attributes': {'MinSize': spec.asg_min_size, 'MaxSize': spec.asg_max_size,
+                           'WarmPool': warm_pool_label(warm_pool), 'LaunchTemplateVersion': version}
+        })
+        print(f"Auto Scaling Group '{spec.auto_scaling_group_name}' created.")
+
+def create_sns_topics(stack):
+    """Create the missing SNS alert topics and subscribe the email and SMS endpoints to them"""
+    spec = stack.spec
+    snapshot = stack.snapshot()
+    known_arns = {}
+    for topic_name in spec.sns_topics:
+        topic = snapshot.get('sns_topic', topic_name)
+        if topic:
+            known_arns[topic_name] = topic['arn']
+    topic_arns = provision_topics(
+        {topic_name: list(endpoints.items()) for topic_name, endpoints in spec.sns_topics.items()}, known_arns,
+        client=stack.sns_client, tags=spec.stack_tags()
+    )
+    for topic_name, topic_arn in topic_arns.items():
+        tags = snapshot.get('sns_topic', topic_name)['tags'] if topic_name in known_arns else spec.stack_tag()
+        snapshot.record('sns_topic', topic_name, {'id': topic_name, 'arn': topic_arn, 'state': None, 'tags': tags})
+    return topic_arns
+
+def create_cpu_alarm(stack):
+    """Create or update the CloudWatch alarm on the ASG's average CPU utilization"""
+    spec = stack.spec
+    stack.cloudwatch_client.put_metric_alarm(
+        AlarmName=spec.alarm_name,
+        MetricName='CPUUtilization',
+        Namespace='AWS/EC2',
+        Statistic='Average',
+        Period=spec.alarm_period,
+        EvaluationPeriods=1,
+        Threshold=spec.alarm_threshold,
+        ComparisonOperator='GreaterThanThreshold',
+        AlarmActions=[spec.lambda_function_arn],
+        Dimensions=[{'Name': 'AutoScalingGroupName', 'Value': spec.auto_scaling_group_name}],
+        # Only applied when the alarm is created, tag_stack_resources tags an existing one
+        Tags=spec.stack_tags()
+    )
+    alarm = stack.snapshot().get('alarm', spec.alarm_name)
+    stack.snapshot().record('alarm', spec.alarm_name, {
+        'id': spec.alarm_name, 'arn': alarm and alarm['arn'], 'state': None,
+        'tags': alarm['tags'] if alarm else spec.stack_tag(),
+        'attributes': {'MetricName': 'CPUUtilization', 'Namespace': 'AWS/EC2', 'Statistic': 'Average',
+                       'Period': spec.alarm_period, 'EvaluationPeriods': 1, 'Threshold': spec.alarm_threshold,
+                       'ComparisonOperator': 'GreaterThanThreshold'}
+    })
+    print(f"CloudWatch alarm '{spec.alarm_name}' is set.")
+
+def untagged_resources(stack):
+    """(kind, name, record) of the stack's existing resources that do not carry the stack tag"""
+    snapshot = stack.snapshot()
+    untagged = []
+    for kind in tagged_kinds:
+        for name in stack.resource_names(kind):
+            record = snapshot.get(kind, name)
+            if record and STACK_TAG_KEY not in record['tags']:
+                untagged.append((kind, name, record))
+    return untagged
+
+def tag_stack_resources(stack):
+    """Put the stack tag on the stack's resources that lack it, with one call per service"""
+    spec = stack.spec
+    snapshot = stack.snapshot()
+    untagged = untagged_resources(stack)
+    instance_ids = [record['id'] for kind, _, record in untagged if kind == 'instance']
+    if instance_ids:
+        stack.ec2_client.create_tags(Resources=instance_ids, Tags=spec.stack_tags())
+    # Everything else is tagged across services by ARN through the tagging API
+    arns = [record['arn'] for kind, _, record in untagged if kind != 'instance']
+    failed = {}
+    for i in range(0, len(arns), tag_resources_chunk_size):
+        response = stack.clients['resourcegroupstaggingapi'].tag_resources(
+            ResourceARNList=arns[i:i + tag_resources_chunk_size], Tags=spec.stack_tag()
+        )
+        failed.update(response['FailedResourcesMap'])
+    for kind, name, record in untagged:
+        if record.get('arn') in failed:
+            print(f"Could not tag {kind} '{name}': {failed[record['arn']].get('ErrorMessage')}")
+        else:
+            snapshot.record(kind, name, dict(record, tags=dict(record['tags'], **spec.stack_tag())))
+    print(f"Tagged {len(untagged) - len(failed)} resources with {STACK_TAG_KEY}={spec.name}.")
 
 # Tear Down Infrastructure
 
-def terminate_ec2_instances():
+def terminate_ec2_instances(stack):
     """Terminate EC2 Instances"""
+    spec = stack.spec
     print("Terminating EC2 instances...")
-    response = ec2_client.describe_instances(Filters=[{'Name': 'tag:Name', 'Values': ['MyAppInstance']}])
-    instance_ids = [instance['InstanceId'] for reservation in response['Reservations'] for instance in reservation['Instances']]
+    instance_ids = [instance['id'] for instance in discover_instances(stack.clients, spec.instance_name)]
     if instance_ids:
-        ec2_client.terminate_instances(InstanceIds=instance_ids)
+        stack.ec2_client.terminate_instances(InstanceIds=instance_ids)
         print(f"Terminated EC2 instances: {instance_ids}")
     else:
         print("No EC2 instances found.")
+    stack.snapshot().record('instance', spec.instance_name, None)
+    return instance_ids
 
-def delete_load_balancer():
-    """Delete the Application Load Balancer (ALB)"""
-    print(f"Deleting ALB '{alb_name}'...")
-    response = elb_client.describe_load_balancers(Names=[alb_name])
-    if response['LoadBalancers']:
-        alb_arn = response['LoadBalancers'][0]['LoadBalancerArn']
-        elb_client.delete_load_balancer(LoadBalancerArn=alb_arn)
-        print(f"ALB '{alb_name}' deleted.")
-    else:
-        print(f"ALB '{alb_name}' not found.")
+def delete_load_balancer(stack):
+    """Delete the Application Load Balancer (ALB) and return its ARN"""
+    spec = stack.spec
+    print(f"Deleting ALB '{spec.alb_name}'...")
+    snapshot = stack.snapshot()
+    alb = snapshot.lookup('load_balancer', spec.alb_name, lambda: discover_load_balancer(stack.clients, spec.alb_name)[0])
+    if alb:
+        stack.elb_client.delete_load_balancer(LoadBalancerArn=alb['arn'])
+        snapshot.record('load_balancer', spec.alb_name, None)
+        snapshot.record('listener', spec.alb_name, None)
+        print(f"ALB '{spec.alb_name}' deletion started.")
+        return alb['arn']
+    print(f"ALB '{spec.alb_name}' not found.")
+    return None
 
-def delete_target_group():
+def delete_target_group(stack):
     """Delete the Target Group associated with the ALB"""
-    print(f"Deleting Target Group '{target_group_name}'...")
-    response = elb_client.describe_target_groups(Names=[target_group_name])
-    if response['TargetGroups']:
-        target_group_arn = response['TargetGroups'][0]['TargetGroupArn']
-        elb_client.delete_target_group(TargetGroupArn=target_group_arn)
-        print(f"Target Group '{target_group_name}' deleted.")
-    else:
-        print(f"Target Group '{target_group_name}' not found.")
-
-def delete_auto_scaling_group():
-    """Delete the Auto Scaling Group"""
-    print(f"Deleting Auto Scaling Group '{auto_scaling_group_name}'...")
-    response = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[auto_scaling_group_name])
-    if response['AutoScalingGroups']:
-        asg_client.delete_auto_scaling_group(AutoScalingGroupName=auto_scaling_group_name, ForceDelete=True)
-        print(f"Auto Scaling Group '{auto_scaling_group_name}' deleted.")
+    spec = stack.spec
+    print(f"Deleting Target Group '{spec.target_group_name}'...")
+    snapshot = stack.snapshot()
+    target_group = snapshot.lookup('target_group', spec.target_group_name,
+                                   lambda: discover_target_group(stack.clients, spec.target_group_name))
+    if target_group:
+        stack.elb_client.delete_target_group(TargetGroupArn=target_group['arn'])
+        snapshot.record('target_group', spec.target_group_name, None)
+        print(f"Target Group '{spec.target_group_name}' deleted.")
     else:
-        print(f"Auto Scaling Group '{auto_scaling_group_name}' not found.")
+        print(f"Target Group '{spec.target_group_name}' not found.")
 
-def delete_launch_template():
+def delete_auto_scaling_group(stack):
+    """Delete the Auto Scaling Group and return its name if a deletion was started"""
+    spec = stack.spec
+    print(f"Deleting Auto Scaling Group '{spec.auto_scaling_group_name}'...")
+    snapshot = stack.snapshot()
+    asg = snapshot.lookup('auto_scaling_group', spec.auto_scaling_group_name,
+                          lambda: discover_auto_scaling_group(stack.clients, spec.auto_scaling_group_name))
+    if asg:
+        stack.asg_client.delete_auto_scaling_group(AutoScalingGroupName=spec.auto_scaling_group_name, ForceDelete=True)
+        snapshot.record('auto_scaling_group', spec.auto_scaling_group_name, None)
+        print(f"Auto Scaling Group '{spec.auto_scaling_group_name}' deletion started.")
+        return spec.auto_scaling_group_name
+    print(f"Auto Scaling Group '{spec.auto_scaling_group_name}' not found.")
+    return None
+
+def delete_launch_template(stack):
     """Delete the Launch Template"""
-    print(f"Deleting Launch Template '{launch_template_name}'...")
-    response = ec2_client.describe_launch_templates(LaunchTemplateNames=[launch_template_name])
-    if response['LaunchTemplates']:
-        ec2_client.delete_launch_template(LaunchTemplateName=launch_template_name)
-        print(f"Launch Template '{launch_template_name}' deleted.")
+    spec = stack.spec
+    print(f"Deleting Launch Template '{spec.launch_template_name}'...")
+    snapshot = stack.snapshot()
+    template = snapshot.lookup('launch_template', spec.launch_template_name,
+                               lambda: discover_launch_template(stack.clients, spec.launch_template_name))
+    if template:
+        stack.ec2_client.delete_launch_template(LaunchTemplateName=spec.launch_template_name)
+        snapshot.record('launch_template', spec.launch_template_name, None)
+        print(f"Launch Template '{spec.launch_template_name}' deleted.")
     else:
-        print(f"Launch Template '{launch_template_name}' not found.")
+        print(f"Launch Template '{spec.launch_template_name}' not found.")
 
-def delete_s3_bucket():
+def delete_s3_bucket(stack):
     """Delete the S3 bucket and its contents"""
-    print(f"Deleting S3 bucket '{bucket_name}'...")
+    spec = stack.spec
+    print(f"Deleting S3 bucket '{spec.bucket_name}'...")
     try:
-        response = s3_client.list_objects_v2(Bucket=bucket_name)
-        if 'Contents' in response:
-            objects = [{'Key': obj['Key']} for obj in response['Contents']]
-            s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': objects})
-            print(f"Deleted all objects in bucket {bucket_name}")
-        s3_client.delete_bucket(Bucket=bucket_name)
-        print(f"S3 bucket '{bucket_name}' deleted.")
-    except Exception as e:
-        print(f"Error deleting S3 bucket '{bucket_name}': {e}")
-
-def tear_down_infrastructure():
-    """Tear down the full infrastructure"""
-    
-    # 1. Terminate EC2 Instances
-    terminate_ec2_instances()
-    
-    # 2. Delete Load Balancer and Target Group
-    delete_load_balancer()
-    delete_target_group()
-
-    # 3. Delete Auto Scaling Group and Launch Template
-    delete_auto_scaling_group()
-    delete_launch_template()
-
-    # 4. Delete S3 Bucket
-    delete_s3_bucket()
-
-def deploy_full_infrastructure():
-    """Deploy the entire infrastructure"""
-    create_s3_bucket()
-    ec2_instance_id = deploy_ec2_instance()
-    alb_arn = create_application_load_balancer()
-    target_group_arn = create_target_group(vpc_id=subnet_ids[0])
-    register_targets(target_group_arn, ec2_instance_id)
-    create_listener(alb_arn, target_group_arn)
-    launch_template_id = create_launch_template()
-    create_auto_scaling_group(launch_template_id, target_group_arn)
-
-def update_infrastructure(new_ami_id=None):
-    """Update components of the infrastructure"""
-    instance_id, instance_state = find_ec2_instance_by_name('MyAppInstance')
-    
-    if new_ami_id:
-        if instance_id and instance_state == 'running':
-            update_ec2_instance(instance_id, new_ami_id)
+        summary = purge_bucket(stack.s3_client, spec.bucket_name)
+        if summary['errors']:
+            print(f"S3 bucket '{spec.bucket_name}' not deleted: {summary['errors']} objects could not be removed.")
+            return
+        stack.s3_client.delete_bucket(Bucket=spec.bucket_name)
+        stack.snapshot().record('bucket', spec.bucket_name, None)
+        print(f"S3 bucket '{spec.bucket_name}' deleted.")
+    except ClientError as e:
+        print(f"Error deleting S3 bucket '{spec.bucket_name}': {e}")
+
+def delete_alarm_and_topics(stack):
+    """Delete the CPU alarm and the SNS alert topics"""
+    spec = stack.spec
+    stack.cloudwatch_client.delete_alarms(AlarmNames=[spec.alarm_name])
+    snapshot = stack.snapshot()
+    snapshot.record('alarm', spec.alarm_name, None)
+    print(f"CloudWatch alarm '{spec.alarm_name}' deleted.")
+    for topic_name in spec.sns_topics:
+        topic = snapshot.get('sns_topic', topic_name)
+        if topic:
+            stack.sns_client.delete_topic(TopicArn=topic['arn'])
+            forget_subscriptions(topic['arn'])
+            snapshot.record('sns_topic', topic_name, None)
+            print(f"SNS Topic {topic_name} deleted.")
+
+def delete_stray_resources(stack):
+    """Delete what carries the stack tag but none of the spec's names, e.g. the security group create_ec2 made"""
+    spec = stack.spec
+    by_type = {}
+    for record in stack.snapshot().find_by_tag(STACK_TAG_KEY, spec.name):
+        if record['kind'] == 'stray':
+            by_type.setdefault(record['type'], []).append(record)
+    if not by_type:
+        return
+
+    def take(resource_type, field='id'):
+        return [record[field] for record in by_type.pop(resource_type, [])]
+
+    print(f"Deleting resources tagged {STACK_TAG_KEY}={spec.name} outside the spec: "
+          f"{', '.join(f'{len(records)} {resource_type}' for resource_type, records in by_type.items())}")
+    # Groups first, they would replace the instances terminated underneath them
+    asg_names = [arn.rsplit('/', 1)[-1] for arn in take('autoscaling:autoScalingGroup', 'arn')]
+    for asg_name in asg_names:
+        stack.asg_client.delete_auto_scaling_group(AutoScalingGroupName=asg_name, ForceDelete=True)
+    stack.waiter.wait_all([('auto_scaling_group_deleted', asg_name) for asg_name in asg_names])
+
+    # Then everything nothing else depends on; listeners go with their load balancer
+    by_type.pop('elasticloadbalancing:listener', None)
+    instance_ids = take('ec2:instance')
+    if instance_ids:
+        stack.ec2_client.terminate_instances(InstanceIds=instance_ids)
+    alb_arns = take('elasticloadbalancing:loadbalancer', 'arn')
+    for alb_arn in alb_arns:
+        stack.elb_client.delete_load_balancer(LoadBalancerArn=alb_arn)
+    for template_id in take('ec2:launch-template'):
+        stack.ec2_client.delete_launch_template(LaunchTemplateId=template_id)
+    alarm_names = take('cloudwatch:alarm')
+    if alarm_names:
+        stack.cloudwatch_client.delete_alarms(AlarmNames=alarm_names)
+    for topic_arn in take('sns:topic', 'arn'):
+        stack.sns_client.delete_topic(TopicArn=topic_arn)
+        forget_subscriptions(topic_arn)
+    for bucket_name in take('s3:bucket'):
+        if not purge_bucket(stack.s3_client, bucket_name)['errors']:
+            stack.s3_client.delete_bucket(Bucket=bucket_name)
+
+    # Target groups and security groups are free once the load balancers and instances are gone
+    stack.waiter.wait_all([('instance_terminated', instance_id) for instance_id in instance_ids] +
+                          [('load_balancer_deleted', alb_arn) for alb_arn in alb_arns])
+    for target_group_arn in take('elasticloadbalancing:targetgroup', 'arn'):
+        stack.elb_client.delete_target_group(TargetGroupArn=target_group_arn)
+    for group_id in take('ec2:security-group'):
+        try:
+            stack.ec2_client.delete_security_group(GroupId=group_id)
+        except ClientError as e:
+            # Network interfaces of terminated instances can take a while to go away
+            print(f"Security group {group_id} not deleted, run the teardown again: {e}")
+    for resource_type, records in by_type.items():
+        print(f"Left {len(records)} {resource_type} in place: teardown does not handle that type.")
+
+def tear_down_infrastructure(stack):
+    """Tear down the full infrastructure, deleting independent resources in parallel.
+
+    Anything else carrying the stack tag is deleted once the named resources are gone.
+    """
+    spec = stack.spec
+    # Start from fresh state: the tagging API lists what exists, only what it cannot is described
+    stack.snapshot(refresh=True, attributes=False)
+
+    def remove_auto_scaling_group(stack):
+        asg_name = delete_auto_scaling_group(stack)
+        if asg_name:
+            # ForceDelete terminates the instances first, the group is gone once they are
+            stack.waiter.wait('auto_scaling_group_deleted', asg_name)
+            print(f"Auto Scaling Group '{asg_name}' deleted.")
+
+    def remove_load_balancer(stack):
+        alb_arn = delete_load_balancer(stack)
+        if alb_arn:
+            stack.waiter.wait('load_balancer_deleted', alb_arn)
+            print(f"ALB '{spec.alb_name}' deleted.")
+
+    # Reverse dependency graph: a resource is deleted only after everything using it is gone.
+    # The target group is referenced by the ALB listener and the ASG, the launch template by the ASG.
+    steps = {
+        'ec2_instances': (with_manifest(stack, terminate_ec2_instances, 'instance'), []),
+        'auto_scaling_group': (with_manifest(stack, remove_auto_scaling_group, 'auto_scaling_group'), []),
+        'load_balancer': (with_manifest(stack, remove_load_balancer, 'load_balancer', 'listener'), []),
+        'target_group': (with_manifest(stack, lambda stack, *_: delete_target_group(stack), 'target_group'),
+                         ['load_balancer', 'auto_scaling_group']),
+        'launch_template': (with_manifest(stack, lambda stack, *_: delete_launch_template(stack), 'launch_template'),
+                            ['auto_scaling_group']),
+        's3_bucket': (with_manifest(stack, delete_s3_bucket, 'bucket'), []),
+        'alarm_and_topics': (with_manifest(stack, delete_alarm_and_topics, 'alarm', 'sns_topic'), []),
+    }
+    steps['strays'] = (lambda *_: delete_stray_resources(stack), list(steps))
+    try:
+        return run_dag(steps)
+    finally:
+        stack.drop_snapshot()
+
+def wait_for_load_balancer(stack, alb_arn):
+    """Wait until the ALB has finished provisioning"""
+    stack.waiter.wait('load_balancer_active', alb_arn)
+    print(f"ALB {alb_arn} is active.")
+    return alb_arn
+
+def wait_for_healthy_targets(stack, target_group_arn, instance_ids):
+    """Wait until every instance passes the target group health check"""
+    stack.waiter.wait_all([('target_healthy', (target_group_arn, instance_id)) for instance_id in instance_ids])
+    print(f"Targets {instance_ids} are healthy in Target Group {target_group_arn}.")
+
+def desired_stack(stack):
+    """The desired state of every resource in the stack, built from its spec"""
+    spec = stack.spec
+    template = stack.snapshot().get('launch_template', spec.launch_template_name)
+    return [
+        {'kind': 'bucket', 'name': spec.bucket_name},
+        {'kind': 'instance', 'name': spec.instance_name, 'state': 'running',
+         # An image that is still to be baked is not compared
+         'attributes': {'ImageId': stack.image_id(), 'InstanceType': spec.instance_type}},
+        {'kind': 'load_balancer', 'name': spec.alb_name,
+         'attributes': {'Scheme': 'internet-facing', 'Type': 'application'}},
+        {'kind': 'target_group', 'name': spec.target_group_name,
+         'attributes': {'Protocol': 'HTTP', 'Port': 80, 'HealthCheckPath': spec.health_check_path},
+         'updatable': ['HealthCheckPath']},
+        {'kind': 'listener', 'name': spec.alb_name},
+        {'kind': 'launch_template', 'name': spec.launch_template_name,
+         # A changed AMI, instance type or user data adds a template version
+         'attributes': {'DataHash': launch_template_data_hash(launch_template_data(stack))
+                        if stack.rolled_out_image_id() or stack.image_id() else None},
+         'updatable': ['DataHash']},
+        {'kind': 'auto_scaling_group', 'name': spec.auto_scaling_group_name,
+         'attributes': {'MinSize': spec.asg_min_size, 'MaxSize': spec.asg_max_size,
+                        'WarmPool': warm_pool_label(spec.warm_pool_configuration()),
+                        'LaunchTemplateVersion': str(template['version']) if template else None},
+         'updatable': ['MinSize', 'MaxSize', 'WarmPool', 'LaunchTemplateVersion']},
+        {'kind': 'alarm', 'name': spec.alarm_name,
+         'attributes': {'MetricName': 'CPUUtilization', 'Namespace': 'AWS/EC2', 'Statistic': 'Average',
+                        'Period': spec.alarm_period, 'EvaluationPeriods': 1, 'Threshold': spec.alarm_threshold,
+                        'ComparisonOperator': 'GreaterThanThreshold'},
+         'updatable': ['Period', 'EvaluationPeriods', 'Threshold', 'ComparisonOperator', 'Statistic']},
+    ] + [{'kind': 'sns_topic', 'name': topic_name} for topic_name in spec.sns_topics]
+
+def plan_infrastructure(stack, refresh=False):
+    """Diff the desired stack against one snapshot of live state and return the changes deploy would make"""
+    spec = stack.spec
+    snapshot = stack.snapshot(refresh=refresh)
+    plan = build_plan(desired_stack(stack), snapshot)
+
+    # The instance must also be registered with the target group
+    instance = snapshot.get('instance', spec.instance_name)
+    target_group = snapshot.get('target_group', spec.target_group_name)
+    registered = instance and target_group and instance['id'] in target_group.get('targets', {})
+    if not registered:
+        plan.append({'kind': 'target_registration', 'name': spec.target_group_name, 'action': 'create', 'drift': {}})
+
+    # Resources deployed before they were tagged are tagged, so discovery and teardown find them by the tag
+    untagged = untagged_resources(stack)
+    if untagged:
+        plan.append({'kind': 'stack_tag', 'name': spec.name, 'action': 'update', 'drift': {
+            f"{kind} '{name}'": {'actual': None, 'desired': spec.name} for kind, name, _ in untagged
+        }})
+
+    for line in format_plan(plan):
+        print(line)
+    return plan
+
+# Deploy step(s) that bring each kind of resource to its desired state
+steps_for_kind = {
+    'bucket': ['s3_bucket'],
+    'instance': ['ec2_instance'],
+    'load_balancer': ['load_balancer', 'load_balancer_active'],
+    'target_group': ['target_group'],
+    'target_registration': ['register_targets'],
+    'stack_tag': ['stack_tags'],
+    'listener': ['listener'],
+    # A new template version is pinned in the group
+    'launch_template': ['launch_template', 'auto_scaling_group'],
+    'auto_scaling_group': ['auto_scaling_group'],
+    'alarm': ['alarm'],
+    'sns_topic': ['sns_topics'],
+}
+
+def deploy_full_infrastructure(stack, wait_for_healthy=False, deadline=None):
+    """Deploy the infrastructure, running only the steps needed to fix detected drift"""
+    plan = plan_infrastructure(stack)
+    # Replacing resources in place is destructive, deploy only creates, starts and updates
+    applicable = [change for change in plan if change['action'] != 'replace']
+    for change in plan:
+        if change['action'] == 'replace':
+            print(f"Skipping {change['kind']} '{change['name']}': it must be replaced, not updated in place.")
+    if not applicable and not wait_for_healthy:
+        print("Stack is up to date.")
+        return {}
+
+    # Each step maps to (function, [steps whose results it takes as arguments])
+    steps = {
+        's3_bucket': (with_manifest(stack, create_s3_bucket, 'bucket'), []),
+        'image': (partial(ensure_image, stack, deadline), []),
+        'ec2_instance': (with_manifest(stack, deploy_ec2_instance, 'instance'), ['image']),
+        'load_balancer': (with_manifest(stack, create_application_load_balancer, 'load_balancer'), []),
+        'target_group': (with_manifest(stack, lambda stack: create_target_group(stack, stack.spec.vpc_id), 'target_group'), []),
+        'register_targets': (partial(register_targets, stack), ['target_group', 'ec2_instance']),
+        'listener': (with_manifest(stack, create_listener, 'listener'), ['load_balancer', 'target_group']),
+        'launch_template': (with_manifest(stack, create_launch_template, 'launch_template'), ['image']),
+        'auto_scaling_group': (with_manifest(stack, create_auto_scaling_group, 'auto_scaling_group'),
+                               ['launch_template', 'target_group']),
+        'load_balancer_active': (partial(wait_for_load_balancer, stack), ['load_balancer']),
+        'sns_topics': (with_manifest(stack, create_sns_topics, 'sns_topic'), []),
+        'alarm': (with_manifest(stack, create_cpu_alarm, 'alarm'), []),
+        'stack_tags': (partial(tag_stack_resources, stack), []),
+        'targets_healthy': (
+            lambda target_group_arn, instance_id, *_: wait_for_healthy_targets(stack, target_group_arn, [instance_id]),
+            ['target_group', 'ec2_instance', 'register_targets', 'listener']
+        ),
+    }
+    # Only run what the plan needs; the steps it depends on are cheap snapshot lookups
+    wanted = [step for change in applicable for step in steps_for_kind[change['kind']]]
+    if wait_for_healthy:
+        wanted.append('targets_healthy')
+    return run_dag(subgraph(steps, wanted))
+
+def deploy_fleet(stack, count, deadline=None):
+    """Bring the instance fleet to `count` instances and register all of them with the Target Group"""
+    stack.snapshot()
+    steps = {
+        'fleet': (lambda: launch_fleet(stack, count, deadline), []),
+        'target_group': (lambda: create_target_group(stack, stack.spec.vpc_id), []),
+        'register_targets': (lambda instance_ids, target_group_arn: register_fleet_targets(stack, target_group_arn, instance_ids),
+                             ['fleet', 'target_group']),
+    }
+    return run_dag(steps)['fleet']
+
+### ROLLING UPDATE ###
+
+def create_launch_template_version(stack, ami_id):
+    """Add a launch template version that boots `ami_id` and return (template ID, version number).
+
+    The version holds the stack's launch template data with the AMI swapped
+    in; a repeated update finds its hash on the latest version and reuses it.
+    """
+    spec = stack.spec
+    if not stack.snapshot().lookup('launch_template', spec.launch_template_name,
+                                   lambda: discover_launch_template(stack.clients, spec.launch_template_name)):
+        raise ValueError(f"Launch template '{spec.launch_template_name}' does not exist, deploy the stack first.")
+    template = put_stack_launch_template(stack, launch_template_data(stack, ami_id))
+    record_rollout(stack, ami_id)
+    print(f"Launch template '{spec.launch_template_name}' version {template['version']} boots AMI {ami_id}.")
+    return template['id'], template['version']
+
+def record_rollout(stack, ami_id):
+    """Remember the AMI the ASG is rolled onto, so deploy keeps it in the launch template"""
+    spec = stack.spec
+    previous = stack.rolled_out_image_id()
+    if ami_id == previous:
+        return
+    if ami_id == stack.image_id():
+        stack.manifest.remove('rollout', spec.ami_id)
+    else:
+        stack.manifest.record('rollout', spec.ami_id, ami_id, previous=previous)
+
+def revert_rollout(stack):
+    """Forget the last rolled-out AMI after a rollback, going back to the one before it"""
+    entry = stack.manifest.get('rollout', stack.spec.ami_id)
+    if not entry:
+        return
+    if entry.get('previous'):
+        stack.manifest.record('rollout', stack.spec.ami_id, entry['previous'], previous=None)
+    else:
+        stack.manifest.remove('rollout', stack.spec.ami_id)
+
+def refresh_preferences(spec, desired_capacity):
+    """Instance refresh preferences for the spec's healthy percentage, warm-up and batch size"""
+    # Up to refresh_batch_size new instances launch (and warm up) before old ones are terminated,
+    # so the group never drops below refresh_min_healthy_percentage of its capacity
+    batch_percentage = min(100, math.ceil(100 * spec.refresh_batch_size / max(desired_capacity, 1)))
+    return {
+        'MinHealthyPercentage': spec.refresh_min_healthy_percentage,
+        'MaxHealthyPercentage': min(200, max(100, spec.refresh_min_healthy_percentage + batch_percentage)),
+        'InstanceWarmup': spec.refresh_instance_warmup,
+        # Instances already on the new version are left alone, so a repeated update replaces nothing
+        'SkipMatching': True,
+        # A failed refresh puts the previous launch template version back
+        'AutoRollback': True,
+    }
+
+def start_instance_refresh(stack, template_id, version):
+    """Start rolling the ASG onto a launch template version and return the refresh ID.
+
+    If a refresh to that same version is already running (e.g. started by an
+    update that timed out) its ID is returned instead.
+    """
+    spec = stack.spec
+    asg = stack.snapshot().lookup('auto_scaling_group', spec.auto_scaling_group_name,
+                                  lambda: discover_auto_scaling_group(stack.clients, spec.auto_scaling_group_name))
+    if not asg:
+        raise ValueError(f"Auto Scaling Group '{spec.auto_scaling_group_name}' does not exist, deploy the stack first.")
+    desired_capacity = asg.get('data', {}).get('DesiredCapacity', spec.asg_desired_capacity)
+    try:
+        response = stack.asg_client.start_instance_refresh(
+            AutoScalingGroupName=spec.auto_scaling_group_name,
+            Strategy='Rolling',
+            DesiredConfiguration={'LaunchTemplate': {'LaunchTemplateId': template_id, 'Version': str(version)}},
+            Preferences=refresh_preferences(spec, desired_capacity)
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InstanceRefreshInProgress':
+            raise
+        # Refreshes are listed newest first
+        refresh = stack.asg_client.describe_instance_refreshes(
+            AutoScalingGroupName=spec.auto_scaling_group_name, MaxRecords=1
+        )['InstanceRefreshes'][0]
+        target = refresh.get('DesiredConfiguration', {}).get('LaunchTemplate', {})
+        if (target.get('LaunchTemplateId'), str(target.get('Version'))) != (template_id, str(version)):
+            raise RuntimeError(f"Instance refresh {refresh['InstanceRefreshId']} of '{spec.auto_scaling_group_name}' "
+                               f"to another configuration is still in progress.")
+        print(f"Instance refresh {refresh['InstanceRefreshId']} to version {version} is already in progress.")
+        return refresh['InstanceRefreshId']
+    print(f"Instance refresh {response['InstanceRefreshId']} of '{spec.auto_scaling_group_name}' "
+          f"to launch template version {version} started.")
+    return response['InstanceRefreshId']
+
+def rolling_update(stack, ami_id, wait=True):
+    """Roll the ASG fleet onto a new AMI without taking it out of service and return the refresh ID.
+
+    Creates a launch template version with the AMI and starts an instance
+    refresh to it. With `wait`, progress is followed through the shared
+    waiter (one describe call per poll for every refresh in the region) for
+    up to refresh_timeout seconds; a refresh still running then carries on
+    and a repeated update picks it up again.
+    """
+    spec = stack.spec
+    template_id, version = create_launch_template_version(stack, ami_id)
+    refresh_id = start_instance_refresh(stack, template_id, version)
+    stack.snapshot().invalidate('auto_scaling_group', spec.auto_scaling_group_name)
+    if not wait:
+        return refresh_id
+    try:
+        stack.waiter.wait('instance_refresh_done', (spec.auto_scaling_group_name, refresh_id),
+                          timeout=spec.refresh_timeout)
+    except RuntimeError:
+        # The refresh failed or rolled back: the group went back to the previous version
+        revert_rollout(stack)
+        raise
+    except TimeoutError:
+        print(f"Instance refresh {refresh_id} is still running after {spec.refresh_timeout}s, "
+              f"run the update again to keep following it.")
+        return refresh_id
+    print(f"Auto Scaling Group '{spec.auto_scaling_group_name}' now runs AMI {ami_id} (launch template version {version}).")
+    return refresh_id
 
-    print("Infrastructure updated.")
+def rollback_update(stack):
+    """Stop the running instance refresh and put the previous launch template version back"""
+    spec = stack.spec
+    response = stack.asg_client.rollback_instance_refresh(AutoScalingGroupName=spec.auto_scaling_group_name)
+    refresh_id = response['InstanceRefreshId']
+    print(f"Rolling back instance refresh {refresh_id} of '{spec.auto_scaling_group_name}'...")
+    stack.waiter.wait('instance_refresh_rolled_back', (spec.auto_scaling_group_name, refresh_id),
+                      timeout=spec.refresh_timeout)
+    stack.snapshot().invalidate('auto_scaling_group', spec.auto_scaling_group_name)
+    revert_rollout(stack)
+    print(f"Instance refresh {refresh_id} rolled back.")
+    return refresh_id
+
+def update_infrastructure(stack, new_ami_id=None, wait=True, rollback=False):
+    """Roll the ASG fleet onto a new AMI, or roll back the update in progress.
+
+    The new AMI is recorded in the manifest, so later deploys keep it in the
+    launch template instead of reverting to the spec's ami_id. Changing the
+    spec's ami_id hands the template back to deploy. Use an S3 manifest_uri
+    for the record to outlive the Lambda container.
+    """
+    if rollback:
+        return rollback_update(stack)
+    if not new_ami_id:
+        print("No new AMI given, nothing to update.")
+        return None
+    return rolling_update(stack, new_ami_id, wait=wait)
 
 ### LAMBDA HANDLER ###
 
 def lambda_handler(event, context):
+    reset_stats()
+    try:
+        # Every AWS call of the invocation is traced per step and summarised when it ends
+        with tracer.invocation(event.get('action', 'deploy')):
+            # Long waits (an image bake) stop short of the Lambda timeout and resume on the next invocation
+            deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 if context else None
+            return handle_action(event, deadline)
+    finally:
+        print(f"AWS clients/connections created during this invocation: {get_stats()}")
+
+def run_action(stack, event, deadline=None):
+    """Run the action requested by the event on one stack and return its result"""
     action = event.get('action', 'deploy')  # Default action is 'deploy'
-    
-    if action == 'deploy':
-        deploy_full_infrastructure()
-        return {
-            'statusCode': 200,
-            'body': json.dumps("Infrastructure deployed successfully.")
-        }
-    elif action == 'update':
-        new_ami_id = event.get('new_ami_id', None)  # Update with new AMI if provided
-        update_infrastructure(new_ami_id=new_ami_id)
+
+    with stack.pin_snapshot():
+        if action == 'deploy':
+            deploy_full_infrastructure(stack, wait_for_healthy=event.get('wait_for_healthy', False), deadline=deadline)
+            return "Infrastructure deployed successfully."
+        elif action == 'update':
+            new_ami_id = event.get('new_ami_id', None)  # Update with new AMI if provided
+            refresh_id = update_infrastructure(stack, new_ami_id=new_ami_id, wait=event.get('wait', True),
+                                               rollback=event.get('rollback', False))
+            if refresh_id:
+                return f"Infrastructure updated successfully (instance refresh {refresh_id})."
+            return "Infrastructure updated successfully."
+        elif action == 'plan':
+            return plan_infrastructure(stack, refresh=event.get('refresh', True))
+        elif action == 'fleet':
+            instance_ids = deploy_fleet(stack, int(event.get('count', 1)), deadline)
+            return f"Fleet of {len(instance_ids)} instances running: {instance_ids}"
+        elif action == 'teardown':
+            tear_down_infrastructure(stack)
+            return "Infrastructure torn down successfully."
+        elif action == 'bake':
+            return f"Baked image: {bake_stack_image(stack, deadline)}"
+        raise ValueError("Invalid action. Use 'deploy', 'plan', 'update', 'fleet', 'bake', or 'teardown'.")
+
+def run_stacks(specs, event, max_workers=None, per_account=4, deadline=None):
+    """Run the event's action on many stacks at once, see fanout.fan_out"""
+    parent = tracer.current()
+
+    def run(spec):
+        with tracer.span(spec.name, parent):
+            return run_action(get_stack(spec), event, deadline)
+    return fan_out(specs, run, max_workers=max_workers, per_account=per_account)
+
+def handle_action(event, deadline=None):
+    """Run the action requested by the event and build the Lambda response.
+
+    The event names the stack with 'stack' (a StackSpec dict, the original
+    stack when absent) or several stacks with 'stacks', which then run
+    concurrently with at most 'per_account' stacks per account at a time.
+    """
+    try:
+        if 'stacks' in event:
+            specs = [StackSpec.from_dict(spec) for spec in event['stacks']]
+            results = run_stacks(specs, event, per_account=int(event.get('per_account', 4)), deadline=deadline)
+            failed = {name: str(result) for name, result in results.items() if isinstance(result, Exception)}
+            return {
+                'statusCode': 500 if failed else 200,
+                'body': json.dumps({
+                    name: str(result) if isinstance(result, Exception) else result
+                    for name, result in results.items()
+                })
+            }
+        stack = get_stack(StackSpec.from_dict(event.get('stack', {})))
         return {
             'statusCode': 200,
-            'body': json.dumps("Infrastructure updated successfully.")
+            'body': json.dumps(run_action(stack, event, deadline))
         }
-    elif action == 'teardown':
-        tear_down_infrastructure()
+    except ValueError as e:
         return {
-            'statusCode': 200,
-            'body': json.dumps("Infrastructure torn down successfully.")
+            'statusCode': 400,
+            'body': json.dumps(str(e))
         }
-    else:
+    except BakeInProgress as e:
+        # Nothing failed: the builder keeps going and the next deploy or bake picks it up
         return {
-            'statusCode': 400,
-            'body': json.dumps("Invalid action. Use 'deploy', 'update', or 'teardown'.")
+            'statusCode': 202,
+            'body': json.dumps(str(e))
         }
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from instrumentation import tracer
+
+
+def validate_dag(nodes):
+    """Check that every dependency exists and that the graph has no cycles"""
+    for name, (_, deps) in nodes.items():
+        for dep in deps:
+            if dep not in nodes:
+                raise ValueError(f"Step '{name}' depends on unknown step '{dep}'")
+
+    # Kahn's algorithm: if we cannot order every node there is a cycle
+    remaining = {name: set(deps) for name, (_, deps) in nodes.items()}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Dependency cycle between steps: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+def subgraph(nodes, targets):
+    """Return only the steps in `targets` plus every step they (transitively) depend on"""
+    selected = {}
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in selected:
+            selected[name] = nodes[name]
+            stack.extend(nodes[name][1])
+    return selected
+
+
+def run_dag(nodes, max_workers=8):
+    """Run a graph of steps on a thread pool, starting each step as soon as its inputs are ready.
+
+    `nodes` maps a step name to `(func, [dependency names])`. Each function is
+    called with the results of its dependencies as positional arguments, in
+    the order they are listed. Returns a dict of step name -> result. Each
+    step runs in its own trace span, nested under the caller's.
+    """
+    validate_dag(nodes)
+
+    results = {}
+    pending = dict(nodes)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start every step whose dependencies have all finished
+            for name in [n for n, (_, deps) in pending.items() if all(d in results for d in deps)]:
+                func, deps = pending.pop(name)
+                print(f"Starting step '{name}'...")
+                running[executor.submit(tracer.wrap(func, name), *[results[d] for d in deps])] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    # Do not start anything new, let in-flight steps finish and re-raise
+                    print(f"Step '{name}' failed: {e}")
+                    for other in running:
+                        other.cancel()
+                    raise
+                print(f"Step '{name}' finished.")
+
+    return results
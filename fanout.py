@@ -0,0 +1,49 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def fan_out(specs, func, max_workers=None, per_account=4):
+    """Call `func(spec)` for many stacks at once and return {stack name: result or exception}.
+
+    Stacks run on a thread pool (the work is waiting on AWS, not CPU), but
+    at most `per_account` stacks of the same account run at the same time so
+    a large rollout does not exhaust that account's API limits. Clients come
+    from the shared registry, so stacks in one region reuse one client per
+    service. A failing stack does not stop the others.
+    """
+    specs = list(specs)
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stack names must be unique, got {names}")
+
+    limits = {account: threading.BoundedSemaphore(per_account) for account in {spec.account for spec in specs}}
+    timings = {}
+
+    def run(spec):
+        with limits[spec.account]:
+            start = time.perf_counter()
+            try:
+                return func(spec)
+            finally:
+                timings[spec.name] = time.perf_counter() - start
+
+    results = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers or max(1, len(specs))) as executor:
+        futures = {executor.submit(run, spec): spec for spec in specs}
+        for future in as_completed(futures):
+            spec = futures[future]
+            try:
+                results[spec.name] = future.result()
+                print(f"Stack '{spec.name}' ({spec.account}/{spec.region or 'default region'}) "
+                      f"finished in {timings[spec.name]:.1f}s.")
+            except Exception as e:
+                results[spec.name] = e
+                print(f"Stack '{spec.name}' ({spec.account}/{spec.region or 'default region'}) failed: {e}")
+
+    elapsed = time.perf_counter() - start
+    slowest = max(timings.values(), default=0.0)
+    failed = sum(isinstance(result, Exception) for result in results.values())
+    print(f"Ran {len(specs)} stacks in {elapsed:.1f}s (slowest stack {slowest:.1f}s), {failed} failed.")
+    return results
@@ -0,0 +1,212 @@
+"""Bake the web server packages into an AMI once, instead of installing them on every boot.
+
+A recipe lists the packages to install and the services to enable. Baking
+launches a builder instance from the base AMI with the recipe as its user
+data; the script powers the instance off however it ends, and the stopped
+instance is imaged. Images and builders are tagged with the hash of (base
+AMI, recipe), so an unchanged recipe is found again instead of being
+rebaked, and a bake that outlives one invocation is resumed by the next
+one instead of starting another builder. Instances launched from a baked
+image only need a config-only user data script.
+"""
+import hashlib
+import json
+import re
+import time
+from datetime import datetime, timezone
+
+# Bump to rebake every recipe, e.g. after changing how install scripts are built
+RECIPE_VERSION = 1
+# Tag holding the recipe hash on baked images
+RECIPE_TAG = 'RecipeHash'
+# Seconds a bake may take: builder boot, package installation and imaging
+BAKE_TIMEOUT = 1800
+# Line the builder writes to its console on exit, with the exit status of the install script
+BAKE_STATUS_PATTERN = re.compile(r'webapp-bake-status: (\d+)')
+# Builder states a bake can be resumed from
+BUILDER_STATES = ('pending', 'running', 'stopping', 'stopped')
+
+
+class BakeInProgress(RuntimeError):
+    """The bake did not finish in the time this invocation had; the next bake of the recipe resumes it"""
+
+
+def install_script(recipe):
+    """Shell lines that update the OS, install the recipe's packages and enable its services"""
+    lines = ['yum update -y']
+    if recipe.get('packages'):
+        lines.append(f"yum install -y {' '.join(recipe['packages'])}")
+    lines.extend(f"systemctl enable {service}" for service in recipe.get('services', ()))
+    return '\n'.join(lines) + '\n'
+
+
+def full_user_data(recipe, config_script):
+    """User data for an unbaked image: install everything, then configure and start the app"""
+    return "#!/bin/bash\n" + install_script(recipe) + config_script
+
+
+def config_user_data(config_script):
+    """User data for a baked image: only the per-instance configuration"""
+    return "#!/bin/bash\n" + config_script
+
+
+def recipe_hash(base_ami, recipe):
+    """Content hash of everything that ends up in the image"""
+    canonical = json.dumps({'version': RECIPE_VERSION, 'base_ami': base_ami, 'recipe': recipe}, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def builder_user_data(recipe):
+    """Install script that reports its exit status and powers the builder off, failed or not"""
+    return ("#!/bin/bash\nset -e\n"
+            "trap 'status=$?; echo \"webapp-bake-status: $status\" > /dev/console; shutdown -h now' EXIT\n"
+            + install_script(recipe))
+
+
+def find_baked_image(ec2_client, digest, state='available'):
+    """Return the ID of an image baked from this recipe hash in the given state, or None"""
+    response = ec2_client.describe_images(
+        Owners=['self'],
+        Filters=[{'Name': f'tag:{RECIPE_TAG}', 'Values': [digest]}, {'Name': 'state', 'Values': [state]}]
+    )
+    images = sorted(response['Images'], key=lambda image: image.get('CreationDate', ''), reverse=True)
+    return images[0]['ImageId'] if images else None
+
+
+def find_builders(ec2_client, digest):
+    """Builder instances of this recipe hash that are still around, newest first"""
+    response = ec2_client.describe_instances(
+        Filters=[{'Name': f'tag:{RECIPE_TAG}', 'Values': [digest]},
+                 {'Name': 'instance-state-name', 'Values': list(BUILDER_STATES)}]
+    )
+    builders = [instance for reservation in response['Reservations'] for instance in reservation['Instances']]
+    return sorted(builders, key=lambda instance: instance['LaunchTime'], reverse=True)
+
+
+def terminate_builders(ec2_client, digest):
+    builder_ids = [instance['InstanceId'] for instance in find_builders(ec2_client, digest)]
+    if builder_ids:
+        ec2_client.terminate_instances(InstanceIds=builder_ids)
+
+
+def install_failed(ec2_client, builder_id):
+    """Exit status of a failed install script, from the builder's console; None when it succeeded or did not report"""
+    output = ec2_client.get_console_output(InstanceId=builder_id).get('Output') or ''
+    statuses = BAKE_STATUS_PATTERN.findall(output)
+    # The console is posted some time after the stop, so only a reported failure stops the bake
+    return statuses[-1] if statuses and statuses[-1] != '0' else None
+
+
+def wait_within(waiter, kind, resource_id, timeout, deadline, what):
+    """Wait up to `timeout` seconds, cut short by the invocation's deadline (raising BakeInProgress then)"""
+    budget = timeout if deadline is None else min(timeout, deadline - time.monotonic())
+    try:
+        waiter.wait(kind, resource_id, timeout=max(budget, 1))
+    except TimeoutError:
+        if budget < timeout:
+            raise BakeInProgress(f"{what} is still in progress; bake the recipe again to resume it") from None
+        raise
+
+
+def launch_builder(ec2_client, base_ami, recipe, digest, subnet_id, security_group_id, instance_type, name_prefix,
+                   tags=None):
+    """Start a builder instance running the recipe's install script, return its ID and launch time"""
+    print(f"Baking image for recipe {digest[:12]} from {base_ami}...")
+    response = ec2_client.run_instances(
+        ImageId=base_ami,
+        InstanceType=instance_type,
+        MinCount=1,
+        MaxCount=1,
+        NetworkInterfaces=[
+            {
+                'SubnetId': subnet_id,
+                'DeviceIndex': 0,
+                # Packages come from the internet, the builder needs a public address
+                'AssociatePublicIpAddress': True,
+                'Groups': [security_group_id]
+            }
+        ],
+        InstanceInitiatedShutdownBehavior='stop',
+        TagSpecifications=[
+            {
+                'ResourceType': 'instance',
+                'Tags': [{'Key': 'Name', 'Value': f"{name_prefix}-image-builder"},
+                         {'Key': RECIPE_TAG, 'Value': digest}] + list(tags or [])
+            }
+        ],
+        # Powering off marks the end of the installation, the image is taken from the stopped instance
+        UserData=builder_user_data(recipe)
+    )
+    instance = response['Instances'][0]
+    return instance['InstanceId'], instance['LaunchTime']
+
+
+def bake_image(ec2_client, waiter, base_ami, recipe, subnet_id, security_group_id, instance_type='t2.micro',
+               name_prefix='webapp', tags=None, deadline=None):
+    """Build an image from the recipe on a throwaway instance and return its ID.
+
+    A builder left by an earlier, interrupted bake of the same recipe is
+    reused. `deadline` (a time.monotonic() value) bounds the time spent
+    here: past it the builder is left running and BakeInProgress is raised.
+    `tags` go on the builder as well, so the stack's teardown finds it.
+    """
+    digest = recipe_hash(base_ami, recipe)
+    builders = find_builders(ec2_client, digest)
+    if builders:
+        builder_id, launched = builders[0]['InstanceId'], builders[0]['LaunchTime']
+        print(f"Resuming the bake of recipe {digest[:12]} on builder {builder_id} ({builders[0]['State']['Name']}).")
+    else:
+        builder_id, launched = launch_builder(ec2_client, base_ami, recipe, digest, subnet_id, security_group_id,
+                                              instance_type, name_prefix, tags)
+    started = time.monotonic()
+    remaining = BAKE_TIMEOUT - (datetime.now(timezone.utc) - launched).total_seconds()
+    try:
+        if remaining <= 0:
+            raise TimeoutError(f"Builder {builder_id} has been baking for more than {BAKE_TIMEOUT}s")
+        wait_within(waiter, 'instance_stopped', builder_id, remaining, deadline, f"Bake on builder {builder_id}")
+        status = install_failed(ec2_client, builder_id)
+        if status:
+            raise RuntimeError(f"Install script on builder {builder_id} failed with exit status {status}")
+        image_id = ec2_client.create_image(
+            InstanceId=builder_id,
+            Name=f"{name_prefix}-{digest[:16]}",
+            Description=f"Baked from {base_ami}: {json.dumps(recipe, sort_keys=True)}",
+            TagSpecifications=[
+                {'ResourceType': 'image', 'Tags': [{'Key': RECIPE_TAG, 'Value': digest}]}
+            ]
+        )['ImageId']
+        wait_within(waiter, 'image_available', image_id, BAKE_TIMEOUT, deadline, f"Image {image_id}")
+    except BakeInProgress:
+        raise
+    except BaseException:
+        ec2_client.terminate_instances(InstanceIds=[builder_id])
+        raise
+    ec2_client.terminate_instances(InstanceIds=[builder_id])
+    print(f"Image {image_id} baked in {time.monotonic() - started:.0f}s.")
+    return image_id
+
+
+def get_baked_image(ec2_client, waiter, base_ami, recipe, subnet_id, security_group_id, manifest=None, **kwargs):
+    """Return the image baked from this recipe, baking it only if no image has its hash yet.
+
+    The image is looked up by its tag rather than trusted from the manifest,
+    since an image can be deregistered behind our back. An image still being
+    created by an interrupted bake is waited for rather than baked again.
+    The manifest (when given) records it under kind 'image' and the recipe
+    hash, which is what a plan compares running instances against.
+    """
+    digest = recipe_hash(base_ami, recipe)
+    image_id = find_baked_image(ec2_client, digest)
+    pending_id = None if image_id else find_baked_image(ec2_client, digest, state='pending')
+    if image_id:
+        print(f"Using baked image {image_id} for recipe {digest[:12]}.")
+    elif pending_id:
+        print(f"Waiting for image {pending_id} of recipe {digest[:12]}, created by an earlier bake.")
+        wait_within(waiter, 'image_available', pending_id, BAKE_TIMEOUT, kwargs.get('deadline'), f"Image {pending_id}")
+        terminate_builders(ec2_client, digest)
+        image_id = pending_id
+    else:
+        image_id = bake_image(ec2_client, waiter, base_ami, recipe, subnet_id, security_group_id, **kwargs)
+    if manifest:
+        manifest.record('image', digest, image_id)
+    return image_id
@@ -0,0 +1,268 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from rate_limiter import THROTTLE_CODES
+
+# CloudWatch namespace of the metrics emitted in Embedded Metric Format
+METRICS_NAMESPACE = 'WebAppStack/Deploy'
+# Where the invocation summary goes: 'emf', a path for a JSON trace, or unset to print a short table
+TRACE_OUTPUT_VARIABLE = 'TRACE_OUTPUT'
+# Spans shown in the printed table, slowest first
+SUMMARY_SPANS = 15
+
+_SPAN_METRICS = [
+    ('Duration', 'Milliseconds'),
+    ('ApiCalls', 'Count'),
+    ('ApiLatency', 'Milliseconds'),
+    ('Retries', 'Count'),
+    ('Throttles', 'Count'),
+    ('ResponseBytes', 'Bytes'),
+]
+
+
+def _new_totals():
+    return {'calls': 0, 'api_ms': 0.0, 'max_ms': 0.0, 'retries': 0, 'throttles': 0, 'bytes': 0, 'errors': 0}
+
+
+def _new_span():
+    return dict(_new_totals(), count=0, duration_ms=0.0, failed=0, operations={})
+
+
+class Tracer:
+    """Record every AWS call of an invocation and attribute it to the step that made it.
+
+    Hooks into botocore events of every registered client: `before-call`
+    notes the start time and the current span, `response-received` counts
+    each attempt (throttles and response bytes) and `after-call` /
+    `after-call-error` record the call's latency and retries. Spans are
+    named steps ('deploy/target_group', 'deploy/load_balancer_active/wait:...')
+    kept per thread; work handed to a thread pool keeps its caller's span
+    when submitted through wrap(). Calls made outside an invocation are not
+    recorded.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._root = None
+        self._started = None
+        self._spans = []
+        self._calls = {}
+
+    def register(self, client):
+        """Attach the tracer to a boto3 client"""
+        events = client.meta.events
+        events.register('before-call', self.before_call)
+        events.register('response-received', self.response_received)
+        events.register('after-call', self.after_call)
+        events.register('after-call-error', self.after_call_error)
+
+    def current(self):
+        """Path of the span the calling thread is in, the invocation itself outside of any step"""
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else self._root
+
+    @contextmanager
+    def span(self, name, parent=None):
+        """Time a step; `parent` is needed when the step runs on another thread than its caller"""
+        parent = self.current() if parent is None else parent
+        path = f"{parent}/{name}" if parent else name
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(path)
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield path
+        except Exception:
+            failed = True
+            raise
+        finally:
+            stack.pop()
+            if self._started is not None:
+                with self._lock:
+                    self._spans.append({
+                        'span': path,
+                        'thread': threading.current_thread().name,
+                        'start_ms': round((start - self._started) * 1000, 1),
+                        'duration_ms': round((time.perf_counter() - start) * 1000, 1),
+                        'failed': failed,
+                    })
+
+    def wrap(self, func, name=None):
+        """Bind `func` to the calling thread's span, for running it on a pool thread (in its own span if named)"""
+        parent = self.current()
+
+        def traced(*args, **kwargs):
+            if name:
+                with self.span(name, parent):
+                    return func(*args, **kwargs)
+            stack = self._local.__dict__.setdefault('stack', [])
+            stack.append(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return traced
+
+    @contextmanager
+    def invocation(self, name, output=None):
+        """Trace one Lambda invocation under a root span and emit its summary when it ends"""
+        with self._lock:
+            self._spans, self._calls = [], {}
+            self._started = time.perf_counter()
+            self._root = name
+        try:
+            with self.span(name, parent=''):
+                yield
+        finally:
+            summary = self.summary()
+            with self._lock:
+                self._started = self._root = None
+            emit(summary, output)
+
+    # botocore event handlers
+
+    def before_call(self, model, context, **kwargs):
+        if self._started is not None:
+            context['trace'] = {'span': self.current(), 'start': time.perf_counter(),
+                                'operation': f"{model.service_model.service_name}.{model.name}",
+                                'attempts': 0, 'throttles': 0, 'bytes': 0}
+
+    def response_received(self, context, response_dict=None, parsed_response=None, **kwargs):
+        trace = context.get('trace')
+        if trace is None:
+            return
+        trace['attempts'] += 1
+        if parsed_response and parsed_response.get('Error', {}).get('Code') in THROTTLE_CODES:
+            trace['throttles'] += 1
+        if response_dict:
+            length = response_dict['headers'].get('content-length')
+            body = response_dict.get('body')
+            trace['bytes'] += int(length) if length else len(body) if isinstance(body, bytes) else 0
+
+    def after_call(self, context, parsed=None, **kwargs):
+        self._finish(context, parsed.get('Error', {}).get('Code') if parsed else None)
+
+    def after_call_error(self, context, exception=None, **kwargs):
+        self._finish(context, type(exception).__name__)
+
+    def _finish(self, context, error):
+        trace = context.pop('trace', None)
+        if trace is None:
+            return
+        elapsed = (time.perf_counter() - trace['start']) * 1000
+        with self._lock:
+            totals = self._calls.setdefault((trace['span'], trace['operation']), _new_totals())
+            totals['calls'] += 1
+            totals['api_ms'] += elapsed
+            totals['max_ms'] = max(totals['max_ms'], elapsed)
+            totals['retries'] += max(0, trace['attempts'] - 1)
+            totals['throttles'] += trace['throttles']
+            totals['bytes'] += trace['bytes']
+            totals['errors'] += error is not None
+
+    def summary(self):
+        """Per-span durations and call totals of the current invocation"""
+        with self._lock:
+            spans, calls = list(self._spans), dict(self._calls)
+            root = self._root
+        by_span = {}
+        for record in spans:
+            entry = by_span.setdefault(record['span'], _new_span())
+            entry['count'] += 1
+            entry['duration_ms'] += record['duration_ms']
+            entry['failed'] += record['failed']
+        for (span, operation), totals in calls.items():
+            entry = by_span.setdefault(span, _new_span())
+            entry['operations'][operation] = dict(totals, api_ms=round(totals['api_ms'], 1),
+                                                  max_ms=round(totals['max_ms'], 1))
+            for key in ('calls', 'retries', 'throttles', 'bytes', 'errors'):
+                entry[key] += totals[key]
+            entry['api_ms'] += totals['api_ms']
+            entry['max_ms'] = max(entry['max_ms'], totals['max_ms'])
+        for entry in by_span.values():
+            entry['api_ms'] = round(entry['api_ms'], 1)
+            entry['max_ms'] = round(entry['max_ms'], 1)
+            entry['duration_ms'] = round(entry['duration_ms'], 1)
+
+        totals = _new_totals()
+        for entry in by_span.values():
+            for key in ('calls', 'retries', 'throttles', 'bytes', 'errors'):
+                totals[key] += entry[key]
+        totals['api_ms'] = round(sum(entry['api_ms'] for entry in by_span.values()), 1)
+        totals['max_ms'] = max((entry['max_ms'] for entry in by_span.values()), default=0.0)
+        return {
+            'action': root,
+            'timestamp': int(time.time() * 1000),
+            'duration_ms': by_span.get(root, {}).get('duration_ms', 0.0),
+            'totals': totals,
+            'spans': by_span,
+            'timeline': sorted(spans, key=lambda record: record['start_ms']),
+        }
+
+
+def emf_records(summary, namespace=METRICS_NAMESPACE):
+    """One Embedded Metric Format record per span, for CloudWatch Logs to turn into metrics"""
+    records = []
+    for path, entry in summary['spans'].items():
+        records.append({
+            '_aws': {
+                'Timestamp': summary['timestamp'],
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['Action', 'Step']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in _SPAN_METRICS],
+                }],
+            },
+            'Action': summary['action'],
+            # The leaf name keeps the Step dimension small, the full path stays searchable in the log
+            'Step': path.rsplit('/', 1)[-1],
+            'Span': path,
+            'Duration': entry['duration_ms'],
+            'ApiCalls': entry['calls'],
+            'ApiLatency': entry['api_ms'],
+            'Retries': entry['retries'],
+            'Throttles': entry['throttles'],
+            'ResponseBytes': entry['bytes'],
+            'Operations': entry['operations'],
+        })
+    return records
+
+
+def format_summary(summary, limit=SUMMARY_SPANS):
+    """Lines of a table of the slowest spans"""
+    totals = summary['totals']
+    lines = [f"Trace of '{summary['action']}': {summary['duration_ms']:.0f} ms, {totals['calls']} AWS calls "
+             f"({totals['retries']} retries, {totals['throttles']} throttles, {totals['bytes']} bytes)"]
+    slowest = sorted(summary['spans'].items(), key=lambda item: -item[1]['duration_ms'])[:limit]
+    for path, entry in slowest:
+        lines.append(f"  {entry['duration_ms']:>9.0f} ms  {entry['calls']:>4} calls  {entry['api_ms']:>8.0f} ms in API  {path}")
+    return lines
+
+
+def emit(summary, output=None):
+    """Write the summary as EMF to stdout, as a JSON trace file, or as a printed table.
+
+    `output` defaults to the TRACE_OUTPUT environment variable, and to 'emf'
+    inside Lambda where CloudWatch Logs picks the records up.
+    """
+    output = output or os.environ.get(TRACE_OUTPUT_VARIABLE)
+    if output is None and os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        output = 'emf'
+    if output == 'emf':
+        for record in emf_records(summary):
+            print(json.dumps(record))
+    elif output:
+        with open(output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Trace of '{summary['action']}' written to {output}")
+    else:
+        for line in format_summary(summary):
+            print(line)
+
+
+# Shared by every client created through aws_clients
+tracer = Tracer()
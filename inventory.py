@@ -0,0 +1,474 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from create_asg import latest_launch_template_version, version_hash
+from instrumentation import tracer
+from stack_spec import STACK_TAG_KEY, warm_pool_label
+
+# Kinds of stack resources the Resource Groups Tagging API lists, by the type discover_tagged gives them
+_TAGGED_TYPES = {
+    'ec2:instance': 'instance',
+    'elasticloadbalancing:loadbalancer': 'load_balancer',
+    'elasticloadbalancing:targetgroup': 'target_group',
+    's3:bucket': 'bucket',
+    'cloudwatch:alarm': 'alarm',
+    'sns:topic': 'sns_topics',
+}
+TAGGED_KINDS = tuple(_TAGGED_TYPES.values())
+# Tagged resources that are described by name anyway, or go with the resource they belong to
+_OWNED_TYPES = {
+    'ec2:launch-template': 'launch_template',
+    'elasticloadbalancing:listener': 'load_balancer',
+    'autoscaling:autoScalingGroup': 'auto_scaling_group',
+}
+# Services whose ARNs end in the bare resource name
+_ARN_TYPES = {'s3': 'bucket', 'sns': 'topic'}
+
+
+class Snapshot:
+    """In-memory view of the stack's resources, indexed by name, tag and ARN.
+
+    A resource looked up by (kind, name) is either a record dict, None when
+    discovery found that it does not exist, or unknown once a mutation has
+    invalidated it. Records carry 'kind', 'name', 'id', 'arn', 'state', 'tags',
+    the settings a desired-state plan compares under 'attributes' and the raw
+    describe output under 'data'.
+    """
+
+    def __init__(self):
+        self.taken_at = time.monotonic()
+        self._lock = threading.RLock()
+        self._by_name = {}
+        self._by_arn = {}
+        self._by_tag = {}
+
+    def record(self, kind, name, record):
+        """Store the current state of a resource, or None if it does not exist"""
+        with self._lock:
+            self.invalidate(kind, name)
+            if record is not None:
+                record = dict(record, kind=kind, name=name)
+                record.setdefault('tags', {})
+                if record.get('arn'):
+                    self._by_arn[record['arn']] = record
+                for key, value in record['tags'].items():
+                    self._by_tag.setdefault((key, value), []).append(record)
+            self._by_name[(kind, name)] = record
+            return record
+
+    def invalidate(self, kind, name):
+        """Forget what is known about a resource after it was mutated"""
+        with self._lock:
+            old = self._by_name.pop((kind, name), None)
+            if old is None:
+                return
+            self._by_arn.pop(old.get('arn'), None)
+            for key, value in old['tags'].items():
+                records = self._by_tag.get((key, value), [])
+                if old in records:
+                    records.remove(old)
+
+    def is_known(self, kind, name):
+        with self._lock:
+            return (kind, name) in self._by_name
+
+    def get(self, kind, name):
+        """Return the record for a resource, or None if it is absent or unknown"""
+        with self._lock:
+            return self._by_name.get((kind, name))
+
+    def get_by_arn(self, arn):
+        with self._lock:
+            return self._by_arn.get(arn)
+
+    def find_by_tag(self, key, value):
+        with self._lock:
+            return list(self._by_tag.get((key, value), []))
+
+    def lookup(self, kind, name, loader):
+        """Return a known record, or call `loader()` to describe the resource and remember it"""
+        with self._lock:
+            if (kind, name) in self._by_name:
+                return self._by_name[(kind, name)]
+        return self.record(kind, name, loader())
+
+
+def _tags(tag_list):
+    return {tag['Key']: tag['Value'] for tag in tag_list or []}
+
+
+def _not_found(e, *codes):
+    return e.response['Error']['Code'] in codes
+
+
+def discover_instances(clients, instance_name, instance_ids=None):
+    """Describe the named, non-terminated instances, by ID when they are already known"""
+    filters = [{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}]
+    if instance_ids:
+        response = clients['ec2'].describe_instances(Filters=filters + [{'Name': 'instance-id', 'Values': instance_ids}])
+        if response['Reservations']:
+            return _instance_records(response)
+    response = clients['ec2'].describe_instances(Filters=filters + [{'Name': 'tag:Name', 'Values': [instance_name]}])
+    return _instance_records(response)
+
+
+def _instance_records(response):
+    instances = [instance for reservation in response['Reservations'] for instance in reservation['Instances']]
+    # Prefer a running instance when several share the name
+    instances.sort(key=lambda instance: instance['State']['Name'] != 'running')
+    return [{
+        'id': instance['InstanceId'],
+        'arn': None,
+        'state': instance['State']['Name'],
+        'tags': _tags(instance.get('Tags')),
+        'attributes': {'ImageId': instance['ImageId'], 'InstanceType': instance['InstanceType']},
+        'data': instance,
+    } for instance in instances]
+
+
+def discover_load_balancer(clients, alb_name, alb_arn=None):
+    """Describe the ALB together with its listeners, by ARN when it is already known"""
+    lookups = ([{'LoadBalancerArns': [alb_arn]}] if alb_arn else []) + [{'Names': [alb_name]}]
+    response = None
+    for lookup in lookups:
+        try:
+            response = clients['elbv2'].describe_load_balancers(**lookup)
+            break
+        except ClientError as e:
+            if not _not_found(e, 'LoadBalancerNotFound'):
+                raise
+    if response is None:
+        return None, None
+    alb = response['LoadBalancers'][0]
+    listeners = clients['elbv2'].describe_listeners(LoadBalancerArn=alb['LoadBalancerArn'])['Listeners']
+    alb_record = {
+        'id': alb['LoadBalancerName'],
+        'arn': alb['LoadBalancerArn'],
+        'state': alb['State']['Code'],
+        'attributes': {'Scheme': alb['Scheme'], 'Type': alb['Type']},
+        'data': alb,
+    }
+    listener_record = None
+    if listeners:
+        listener_record = {
+            'id': listeners[0]['ListenerArn'],
+            'arn': listeners[0]['ListenerArn'],
+            'state': None,
+            'data': listeners[0],
+        }
+    return alb_record, listener_record
+
+
+def discover_target_group(clients, target_group_name, target_group_arn=None):
+    """Describe the target group together with its registered targets, by ARN when it is already known"""
+    lookups = ([{'TargetGroupArns': [target_group_arn]}] if target_group_arn else []) + [{'Names': [target_group_name]}]
+    response = None
+    for lookup in lookups:
+        try:
+            response = clients['elbv2'].describe_target_groups(**lookup)
+            break
+        except ClientError as e:
+            if not _not_found(e, 'TargetGroupNotFound'):
+                raise
+    if response is None:
+        return None
+    target_group = response['TargetGroups'][0]
+    health = clients['elbv2'].describe_target_health(TargetGroupArn=target_group['TargetGroupArn'])
+    return {
+        'id': target_group['TargetGroupName'],
+        'arn': target_group['TargetGroupArn'],
+        'state': None,
+        'targets': {
+            target['Target']['Id']: target['TargetHealth']['State']
+            for target in health['TargetHealthDescriptions']
+        },
+        'attributes': {
+            'Protocol': target_group['Protocol'],
+            'Port': target_group['Port'],
+            'HealthCheckPath': target_group.get('HealthCheckPath'),
+        },
+        'data': target_group,
+    }
+
+
+def launch_template_record(version):
+    """Record of a launch template from the description of its latest version"""
+    return {
+        'id': version['LaunchTemplateId'],
+        'arn': None,
+        'state': None,
+        'version': version['VersionNumber'],
+        # Versions created outside put_launch_template carry no hash and always count as changed
+        'attributes': {'DataHash': version_hash(version) or 'untracked'},
+        'data': version,
+    }
+
+
+def discover_launch_template(clients, launch_template_name, launch_template_id=None):
+    """Describe the latest version of the launch template, by ID when it is already known"""
+    version = None
+    if launch_template_id:
+        version = latest_launch_template_version(template_id=launch_template_id, client=clients['ec2'])
+    if version is None:
+        version = latest_launch_template_version(launch_template_name, client=clients['ec2'])
+    return launch_template_record(version) if version else None
+
+
+def discover_auto_scaling_group(clients, asg_name):
+    response = clients['autoscaling'].describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+    if not response['AutoScalingGroups']:
+        return None
+    asg = response['AutoScalingGroups'][0]
+    return {
+        'id': asg['AutoScalingGroupName'],
+        'arn': asg['AutoScalingGroupARN'],
+        'state': asg.get('Status'),
+        'tags': _tags(asg.get('Tags')),
+        'attributes': {'MinSize': asg['MinSize'], 'MaxSize': asg['MaxSize'],
+                       'WarmPool': warm_pool_label(asg.get('WarmPoolConfiguration')),
+                       'LaunchTemplateVersion': asg.get('LaunchTemplate', {}).get('Version')},
+        'data': asg,
+    }
+
+
+def discover_bucket(clients, bucket_name):
+    try:
+        clients['s3'].head_bucket(Bucket=bucket_name)
+    except ClientError as e:
+        if _not_found(e, '404', 'NoSuchBucket', 'NotFound'):
+            return None
+        if e.response['Error']['Code'] in ('403', 'AccessDenied', 'Forbidden'):
+            # Bucket names are global: the name is taken by a bucket this account cannot use
+            print(f"S3 bucket '{bucket_name}' exists but is not accessible to this account, treating it as absent: {e}")
+            return None
+        raise
+    return {'id': bucket_name, 'arn': f"arn:aws:s3:::{bucket_name}", 'state': None}
+
+
+def discover_alarm(clients, alarm_name):
+    response = clients['cloudwatch'].describe_alarms(AlarmNames=[alarm_name])
+    if not response['MetricAlarms']:
+        return None
+    alarm = response['MetricAlarms'][0]
+    return {
+        'id': alarm['AlarmName'],
+        'arn': alarm['AlarmArn'],
+        'state': alarm['StateValue'],
+        'attributes': {
+            attribute: alarm.get(attribute)
+            for attribute in ('MetricName', 'Namespace', 'Statistic', 'Period', 'EvaluationPeriods',
+                              'Threshold', 'ComparisonOperator')
+        },
+        'data': alarm,
+    }
+
+
+def discover_sns_topics(clients, topic_names):
+    """Find the ARNs of the named topics with one paginated list_topics pass"""
+    found = {}
+    paginator = clients['sns'].get_paginator('list_topics')
+    for page in paginator.paginate():
+        for topic in page['Topics']:
+            name = topic['TopicArn'].rsplit(':', 1)[-1]
+            if name in topic_names:
+                found[name] = {'id': name, 'arn': topic['TopicArn'], 'state': None}
+    return {name: found.get(name) for name in topic_names}
+
+
+def parse_arn(arn):
+    """Split an ARN into (service, resource type, resource ID)"""
+    parts = arn.split(':', 5)
+    service, resource = parts[2], parts[5]
+    if service in _ARN_TYPES:
+        return service, _ARN_TYPES[service], resource
+    for i, char in enumerate(resource):
+        if char in '/:':
+            return service, resource[:i], resource[i + 1:]
+    return service, resource, ''
+
+
+def discover_tagged(clients, stack_name):
+    """Every resource carrying the stack tag, from one paginated Resource Groups Tagging API query.
+
+    Records are keyed by ARN and carry 'type' ('ec2:instance',
+    'elasticloadbalancing:targetgroup', ...) and 'resource_name', the name
+    the stack's spec would give the resource.
+    """
+    records = {}
+    paginator = clients['resourcegroupstaggingapi'].get_paginator('get_resources')
+    for page in paginator.paginate(TagFilters=[{'Key': STACK_TAG_KEY, 'Values': [stack_name]}]):
+        for mapping in page['ResourceTagMappingList']:
+            arn = mapping['ResourceARN']
+            service, resource_type, resource_id = parse_arn(arn)
+            tags = _tags(mapping.get('Tags'))
+            if resource_type == 'instance':
+                resource_name = tags.get('Name')
+            elif resource_type in ('loadbalancer', 'listener'):
+                # loadbalancer/app/<name>/<id> and listener/app/<load balancer name>/<id>/<id>
+                resource_name = resource_id.split('/')[1]
+            elif resource_type == 'targetgroup':
+                resource_name = resource_id.split('/')[0]
+            elif resource_type == 'autoScalingGroup':
+                resource_name = resource_id.rsplit('/', 1)[-1]
+            else:
+                resource_name = resource_id
+            records[arn] = {'id': resource_id, 'arn': arn, 'state': None, 'tags': tags,
+                            'type': f"{service}:{resource_type}", 'resource_name': resource_name}
+    return records
+
+
+def _from_tags(kind, record):
+    """Snapshot record of a resource known only from the tagging API, enough for steps that need no attributes"""
+    record = {key: record[key] for key in ('id', 'arn', 'state', 'tags', 'resource_name')}
+    if kind == 'instance':
+        return [dict(record, arn=None)]
+    record['id'] = record.pop('resource_name')
+    if kind == 'load_balancer':
+        return record, None
+    if kind == 'target_group':
+        return dict(record, targets={})
+    return record
+
+
+def _with_tags(record, tags_by_id):
+    """The record with the tags the tagging API reported for it, found by ARN or ID"""
+    if not record:
+        return record
+    tags = tags_by_id.get(record.get('arn') or record['id'])
+    return dict(record, tags=dict(record.get('tags', {}), **tags)) if tags else record
+
+
+def discover_stack(clients, names, known=None, attributes=True):
+    """Describe every resource of the stack in one parallel pass and return a Snapshot.
+
+    `names` maps a resource kind ('instance', 'load_balancer', 'target_group',
+    'launch_template', 'auto_scaling_group', 'bucket', 'alarm') to its name,
+    'sns_topics' to a tuple of topic names and 'stack_tag' to the stack tag's
+    value. `known` optionally maps {kind: {name: {'id', 'arn'}}} (e.g. from
+    the stack manifest): those resources are looked up directly by ID,
+    falling back to a name lookup if the ID has gone stale.
+
+    With 'stack_tag', one tagging API query runs first. A tagged
+    TAGGED_KINDS resource is looked up by its ID, or taken straight from the
+    query when nothing needs its `attributes` (teardown). A resource the
+    query did not return is still described by name: it may have lost its
+    tag, predate tagging or be too new for the tagging API. Tagged resources
+    the names do not account for are recorded as kind 'stray'.
+    """
+    known = known or {}
+    tagged = {}
+    if 'stack_tag' in names:
+        with tracer.span('discover:tagged'):
+            tagged = discover_tagged(clients, names['stack_tag'])
+
+    # Tagged resources that carry the stack's names, by kind; the rest are strays unless they belong to one
+    found = {kind: [] for kind in TAGGED_KINDS}
+    unnamed = []
+    for record in tagged.values():
+        kind = _TAGGED_TYPES.get(record['type'])
+        wanted = names.get(kind)
+        if kind and (record['resource_name'] in wanted if kind == 'sns_topics' else record['resource_name'] == wanted):
+            found[kind].append(record)
+        else:
+            unnamed.append(record)
+
+    def known_id(kind, field='id'):
+        if found.get(kind):
+            return found[kind][0][field]
+        entry = known.get(kind, {}).get(names.get(kind))
+        return entry.get(field) if entry else None
+
+    results = {}
+    for kind in TAGGED_KINDS if tagged else ():
+        if kind not in names:
+            continue
+        if kind == 'sns_topics':
+            # Topic records hold nothing but the ARN, the query has them all once every topic is tagged
+            by_name = {record['resource_name']: _from_tags(kind, record) for record in found[kind]}
+            if set(names[kind]) <= set(by_name):
+                results[kind] = {name: by_name[name] for name in names[kind]}
+        elif found[kind] and (kind == 'bucket' or not attributes):
+            results[kind] = _from_tags(kind, found[kind][0])
+
+    instance_ids = [record['id'] for record in found['instance']] or (
+        [known_id('instance')] if known_id('instance') else None)
+    tasks = {
+        'instance': lambda: discover_instances(clients, names['instance'], instance_ids),
+        'load_balancer': lambda: discover_load_balancer(clients, names['load_balancer'], known_id('load_balancer', 'arn')),
+        'target_group': lambda: discover_target_group(clients, names['target_group'], known_id('target_group', 'arn')),
+        'launch_template': lambda: discover_launch_template(clients, names['launch_template'], known_id('launch_template')),
+        'auto_scaling_group': lambda: discover_auto_scaling_group(clients, names['auto_scaling_group']),
+        'bucket': lambda: discover_bucket(clients, names['bucket']),
+        'alarm': lambda: discover_alarm(clients, names['alarm']),
+        'sns_topics': lambda: discover_sns_topics(clients, names['sns_topics']),
+    }
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {kind: executor.submit(tracer.wrap(task, f"discover:{kind}"))
+                   for kind, task in tasks.items() if kind in names and kind not in results}
+    results.update({kind: future.result() for kind, future in futures.items()})
+
+    # Tagged records keep their tags, deploy tags the ones that lack the stack tag
+    tagged = {key: record['tags'] for record in tagged.values() for key in (record['arn'], record['id'])}
+    snapshot = Snapshot()
+    for kind, result in results.items():
+        if kind == 'instance':
+            snapshot.record(kind, names[kind], _with_tags(result[0], tagged) if result else None)
+        elif kind == 'load_balancer':
+            alb_record, listener_record = result
+            snapshot.record('load_balancer', names[kind], _with_tags(alb_record, tagged))
+            snapshot.record('listener', names[kind], listener_record)
+        elif kind == 'sns_topics':
+            for topic_name, topic_record in result.items():
+                snapshot.record('sns_topic', topic_name, _with_tags(topic_record, tagged))
+        else:
+            snapshot.record(kind, names[kind], _with_tags(result, tagged))
+    template = snapshot.get('launch_template', names.get('launch_template'))
+    for record in unnamed:
+        owner = _OWNED_TYPES.get(record['type'])
+        if owner == 'launch_template':
+            owned = template is not None and record['id'] == template['id']
+        else:
+            owned = owner and record['resource_name'] == names.get(owner)
+        # Instances of the stack's own group go with the group
+        if not owned and record['tags'].get('aws:autoscaling:groupName') != names.get('auto_scaling_group'):
+            snapshot.record('stray', record['arn'], record)
+    return snapshot
+
+
+# Snapshots survive between warm invocations of the same Lambda container
+_snapshots = {}
+# Guards the two dicts; each stack's discovery holds only that stack's lock, so stacks discover in parallel
+_snapshots_lock = threading.Lock()
+_stack_locks = {}
+
+
+def _snapshot_key(names, scope):
+    return scope, tuple(sorted(names.items()))
+
+
+def get_snapshot(clients, names, ttl=60, refresh=False, known=None, scope=None, attributes=True):
+    """Return the cached snapshot for a stack, rediscovering it once it is older than `ttl` seconds.
+
+    `scope` tells apart stacks that use the same names, e.g. in another region or account.
+    `attributes` applies to a new discovery (see discover_stack).
+    """
+    key = _snapshot_key(names, scope)
+    with _snapshots_lock:
+        stack_lock = _stack_locks.setdefault(key, threading.Lock())
+    with stack_lock:
+        with _snapshots_lock:
+            snapshot = _snapshots.get(key)
+        if refresh or snapshot is None or time.monotonic() - snapshot.taken_at > ttl:
+            snapshot = discover_stack(clients, names, known, attributes)
+            with _snapshots_lock:
+                _snapshots[key] = snapshot
+        return snapshot
+
+
+def drop_snapshot(names, scope=None):
+    """Forget a stack's cached snapshot, e.g. after it was torn down"""
+    with _snapshots_lock:
+        _snapshots.pop(_snapshot_key(names, scope), None)
@@ -0,0 +1,268 @@
+"""Pull the stack's CloudWatch metrics into a compact columnar store.
+
+Every metric of every ASG instance and target group is fetched with
+get_metric_data, up to 500 queries per call, and appended to three flat
+NumPy columns (series, timestamp, value). Only settled periods are pulled,
+so a stored datapoint is final, and a later refresh only asks for data
+newer than what the store already holds.
+
+    python metrics_store.py <auto scaling group> [store.npz]
+"""
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+# get_metric_data accepts at most 500 queries per call
+MAX_QUERIES = 500
+DEFAULT_PERIOD = 300
+DEFAULT_LOOKBACK = 3 * 3600
+# Seconds after a period ends before its datapoints count as complete (late Sum datapoints keep arriving)
+SETTLE_DELAY = 600
+
+# (namespace, metric, statistic) pulled for each instance and each target group
+INSTANCE_METRICS = [
+    ('AWS/EC2', 'CPUUtilization', 'Average'),
+    ('AWS/EC2', 'NetworkIn', 'Sum'),
+]
+TARGET_GROUP_METRICS = [
+    ('AWS/ApplicationELB', 'RequestCount', 'Sum'),
+    ('AWS/ApplicationELB', 'TargetResponseTime', 'Average'),
+]
+
+
+class MetricStore:
+    """Append-only columnar store of metric datapoints.
+
+    Series are identified by a key tuple (namespace, metric, statistic,
+    dimensions) where dimensions is a tuple of (name, value) pairs. All
+    datapoints live in three growing arrays indexed by series number, so
+    millions of points cost a few bytes each and save to one .npz file.
+    """
+
+    def __init__(self, capacity=1024):
+        self.keys = []
+        self._index = {}
+        self._series = np.zeros(capacity, dtype=np.int32)
+        self._timestamps = np.zeros(capacity, dtype=np.int64)
+        self._values = np.zeros(capacity, dtype=np.float64)
+        self._size = 0
+        self._last_seen = []
+
+    def __len__(self):
+        return self._size
+
+    def series_id(self, key):
+        if key not in self._index:
+            self._index[key] = len(self.keys)
+            self.keys.append(key)
+            self._last_seen.append(-1)
+        return self._index[key]
+
+    def last_seen(self, key):
+        """Epoch seconds of the newest datapoint of a series, or None"""
+        i = self._index.get(key)
+        if i is None or self._last_seen[i] < 0:
+            return None
+        return self._last_seen[i]
+
+    def append(self, key, timestamps, values):
+        """Add datapoints to a series, dropping those already stored. Returns how many were added."""
+        i = self.series_id(key)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        # Refresh windows overlap by design, keep only what is newer than the series' last point
+        new = timestamps > self._last_seen[i]
+        timestamps, values = timestamps[new], values[new]
+        count = len(timestamps)
+        if not count:
+            return 0
+        self._reserve(self._size + count)
+        end = self._size + count
+        self._series[self._size:end] = i
+        self._timestamps[self._size:end] = timestamps
+        self._values[self._size:end] = values
+        self._size = end
+        self._last_seen[i] = int(timestamps.max())
+        return count
+
+    def _reserve(self, size):
+        if size <= len(self._timestamps):
+            return
+        capacity = max(size, 2 * len(self._timestamps))
+        self._series = np.resize(self._series, capacity)
+        self._timestamps = np.resize(self._timestamps, capacity)
+        self._values = np.resize(self._values, capacity)
+
+    def series(self, key):
+        """Return (timestamps, values) of a series, sorted by time"""
+        i = self._index.get(key)
+        if i is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        mask = self._series[:self._size] == i
+        timestamps, values = self._timestamps[:self._size][mask], self._values[:self._size][mask]
+        order = np.argsort(timestamps, kind='stable')
+        return timestamps[order], values[order]
+
+    def find(self, metric_name=None, **dimensions):
+        """Keys of the series matching a metric name and/or dimension values"""
+        return [
+            key for key in self.keys
+            if (metric_name is None or key[1] == metric_name)
+            and all(dict(key[3]).get(name) == value for name, value in dimensions.items())
+        ]
+
+    def save(self, path):
+        """Write the store to a compressed .npz file"""
+        np.savez_compressed(
+            path,
+            series=self._series[:self._size],
+            timestamps=self._timestamps[:self._size],
+            values=self._values[:self._size],
+            keys=np.array(json.dumps([[k[0], k[1], k[2], [list(d) for d in k[3]]] for k in self.keys])),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Read a store written by save()"""
+        with np.load(path) as data:
+            store = cls(capacity=max(1024, len(data['timestamps'])))
+            for namespace, metric, stat, dimensions in json.loads(str(data['keys'])):
+                store.series_id((namespace, metric, stat, tuple(tuple(d) for d in dimensions)))
+            size = len(data['timestamps'])
+            store._series[:size] = data['series']
+            store._timestamps[:size] = data['timestamps']
+            store._values[:size] = data['values']
+            store._size = size
+        for i in range(len(store.keys)):
+            points = store._timestamps[:size][store._series[:size] == i]
+            if len(points):
+                store._last_seen[i] = int(points.max())
+        return store
+
+
+def load_balancer_dimension(arn):
+    """CloudWatch's LoadBalancer dimension value: the ARN part after 'loadbalancer/'"""
+    return arn.split(':loadbalancer/', 1)[1]
+
+
+def target_group_dimension(arn):
+    """CloudWatch's TargetGroup dimension value: 'targetgroup/<name>/<id>'"""
+    return arn.rsplit(':', 1)[1]
+
+
+def discover_metric_sources(clients, asg_name):
+    """Return the instance IDs of an ASG and the (target group, load balancer) dimensions it serves"""
+    response = clients['autoscaling'].describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+    if not response['AutoScalingGroups']:
+        return [], []
+    asg = response['AutoScalingGroups'][0]
+    instance_ids = [instance['InstanceId'] for instance in asg['Instances']]
+
+    target_groups = []
+    if asg.get('TargetGroupARNs'):
+        described = clients['elbv2'].describe_target_groups(TargetGroupArns=asg['TargetGroupARNs'])
+        for target_group in described['TargetGroups']:
+            # ALB metrics of a target group are published per load balancer it is attached to
+            for alb_arn in target_group['LoadBalancerArns']:
+                target_groups.append((target_group_dimension(target_group['TargetGroupArn']),
+                                      load_balancer_dimension(alb_arn)))
+    return instance_ids, target_groups
+
+
+def metric_keys(instance_ids, target_groups):
+    """Series keys for every instance and target group metric"""
+    keys = []
+    for instance_id in instance_ids:
+        for namespace, metric, stat in INSTANCE_METRICS:
+            keys.append((namespace, metric, stat, (('InstanceId', instance_id),)))
+    for target_group, load_balancer in target_groups:
+        for namespace, metric, stat in TARGET_GROUP_METRICS:
+            keys.append((namespace, metric, stat, (('LoadBalancer', load_balancer), ('TargetGroup', target_group))))
+    return keys
+
+
+def _query(query_id, key, period):
+    namespace, metric, stat, dimensions = key
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': namespace,
+                'MetricName': metric,
+                'Dimensions': [{'Name': name, 'Value': value} for name, value in dimensions],
+            },
+            'Period': period,
+            'Stat': stat,
+        },
+        'ReturnData': True,
+    }
+
+
+def pull_metrics(cloudwatch_client, store, keys, end=None, period=DEFAULT_PERIOD, lookback=DEFAULT_LOOKBACK):
+    """Fetch every series in `keys` into the store, starting after the newest point it already has.
+
+    Queries go out in chunks of 500 per get_metric_data call; each chunk
+    starts at the oldest last-seen timestamp of its series (or `lookback`
+    seconds ago for new series). The window ends at the last period
+    boundary at least SETTLE_DELAY seconds before `end`: a period still
+    filling up would be stored partial and never fetched again. Returns the
+    number of datapoints added.
+    """
+    end = (int(end or time.time()) - SETTLE_DELAY) // period * period
+    default_start = end - lookback
+
+    def start_of(key):
+        last = store.last_seen(key)
+        return default_start if last is None else last + period
+
+    # Series with similar starting points share a chunk, so one window fits all of them
+    keys = sorted(keys, key=start_of)
+    added = 0
+    paginator = cloudwatch_client.get_paginator('get_metric_data')
+    for chunk_start in range(0, len(keys), MAX_QUERIES):
+        chunk = keys[chunk_start:chunk_start + MAX_QUERIES]
+        start = min(start_of(key) for key in chunk)
+        if start >= end:
+            continue
+        by_id = {f"m{i}": key for i, key in enumerate(chunk)}
+        pages = paginator.paginate(
+            MetricDataQueries=[_query(query_id, key, period) for query_id, key in by_id.items()],
+            StartTime=datetime.fromtimestamp(start, timezone.utc),
+            EndTime=datetime.fromtimestamp(end, timezone.utc),
+            ScanBy='TimestampAscending',
+        )
+        for page in pages:
+            for result in page['MetricDataResults']:
+                timestamps = [int(ts.timestamp()) for ts in result['Timestamps']]
+                added += store.append(by_id[result['Id']], timestamps, result['Values'])
+    return added
+
+
+def refresh_store(clients, asg_name, store=None, path=None, period=DEFAULT_PERIOD, lookback=DEFAULT_LOOKBACK):
+    """Load the store (if `path` exists), pull what is new for the ASG's instances and target groups, save it"""
+    if store is None:
+        try:
+            store = MetricStore.load(path) if path else MetricStore()
+        except FileNotFoundError:
+            store = MetricStore()
+    instance_ids, target_groups = discover_metric_sources(clients, asg_name)
+    keys = metric_keys(instance_ids, target_groups)
+    start = time.perf_counter()
+    added = pull_metrics(clients['cloudwatch'], store, keys, period=period, lookback=lookback)
+    print(f"Pulled {added} datapoints for {len(keys)} series of '{asg_name}' "
+          f"in {time.perf_counter() - start:.2f}s ({len(store)} stored).")
+    if path:
+        store.save(path)
+    return store
+
+
+if __name__ == '__main__':
+    from aws_clients import get_client
+
+    asg_name = sys.argv[1] if len(sys.argv) > 1 else 'Deb-auto-scaling-group-sep25'
+    path = sys.argv[2] if len(sys.argv) > 2 else 'metrics_store.npz'
+    clients = {service: get_client(service) for service in ('autoscaling', 'elbv2', 'cloudwatch')}
+    refresh_store(clients, asg_name, path=path)
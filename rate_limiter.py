@@ -0,0 +1,165 @@
+import random
+import threading
+import time
+
+# Error codes AWS services use to signal throttling
+THROTTLE_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+    'SlowDown', 'RequestLimitExceededException', 'PriorRequestNotComplete',
+}
+# Errors worth retrying that are not throttles
+TRANSIENT_CODES = {'RequestTimeout', 'RequestTimeoutException', 'InternalError', 'InternalFailure', 'ServiceUnavailable'}
+TRANSIENT_STATUS = {500, 502, 503, 504}
+
+# Starting rate, burst and ceiling (requests per second) per API family
+DEFAULT_LIMITS = {
+    'read': {'rate': 20.0, 'burst': 40, 'max_rate': 100.0},
+    'mutate': {'rate': 5.0, 'burst': 10, 'max_rate': 20.0},
+}
+
+
+def api_family(operation_name):
+    """Group operations the way AWS rate-limits them: cheap reads vs mutating calls"""
+    if operation_name.startswith(('Describe', 'List', 'Get', 'Head')):
+        return 'read'
+    return 'mutate'
+
+
+class TokenBucket:
+    """Token bucket whose refill rate adapts to throttling (additive increase, multiplicative decrease)"""
+
+    def __init__(self, rate, burst, max_rate, min_rate=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            # Grows by roughly one request/s for every `rate` successful requests
+            self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+
+
+class RetryBudget:
+    """Process-wide cap on retries: each retry spends a token, each success earns back a fraction"""
+
+    def __init__(self, capacity=100, refund=0.1):
+        self.capacity = capacity
+        self.refund = refund
+        self._tokens = float(capacity)
+        self._lock = threading.Lock()
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.refund)
+
+
+class AdaptiveRateLimiter:
+    """Rate-limit and retry every call made by the clients registered with it.
+
+    Hooks into botocore events: `before-send` takes a token from the bucket of
+    the call's (service, API family) before every attempt, and `needs-retry`
+    feeds the outcome back into the bucket and decides on a jittered retry.
+    Clients must be created with botocore's own retries disabled (see
+    aws_clients.client_config) so this is the only retry policy in play.
+    """
+
+    def __init__(self, limits=None, max_attempts=8, base_delay=0.2, max_delay=20.0, budget=None):
+        self.limits = limits or DEFAULT_LIMITS
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service, operation_name, region_name=None):
+        # AWS applies its limits per region, so each region gets its own buckets
+        family = api_family(operation_name)
+        key = (region_name, service, family)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(**self.limits[family])
+            return self._buckets[key]
+
+    def register(self, client):
+        """Attach the limiter to a boto3 client"""
+        region_name = client.meta.region_name
+        client.meta.events.register_first(
+            'before-send', lambda event_name, **kwargs: self.before_send(event_name, region_name=region_name, **kwargs)
+        )
+        client.meta.events.register_first(
+            'needs-retry', lambda event_name, **kwargs: self.needs_retry(event_name, region_name=region_name, **kwargs)
+        )
+
+    def before_send(self, event_name, region_name=None, **kwargs):
+        _, service, operation_name = event_name.split('.')[:3]
+        self.bucket(service, operation_name, region_name).acquire()
+
+    def needs_retry(self, event_name, response=None, attempts=1, caught_exception=None, region_name=None, **kwargs):
+        """Return the seconds to sleep before retrying, or None to stop"""
+        _, service, operation_name = event_name.split('.')[:3]
+        bucket = self.bucket(service, operation_name, region_name)
+
+        if caught_exception is not None:
+            code, status = None, None
+        else:
+            http_response, parsed = response
+            code = parsed.get('Error', {}).get('Code')
+            status = http_response.status_code
+            if status < 300 and not code:
+                bucket.on_success()
+                self.budget.deposit()
+                return None
+
+        throttled = code in THROTTLE_CODES or status == 429
+        if throttled:
+            bucket.on_throttle()
+        retryable = throttled or caught_exception is not None or code in TRANSIENT_CODES or status in TRANSIENT_STATUS
+        if not retryable or attempts >= self.max_attempts:
+            return None
+        if not self.budget.withdraw():
+            print(f"Retry budget exhausted, not retrying {service}.{operation_name}")
+            return None
+
+        # Full jitter: spread retries of concurrent callers over the whole backoff window
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+        print(f"Retrying {service}.{operation_name} ({code or status or caught_exception}) "
+              f"in {delay:.2f}s, attempt {attempts + 1}")
+        return delay
+
+
+# Shared by every client the registry creates
+rate_limiter = AdaptiveRateLimiter()
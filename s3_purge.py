@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from instrumentation import tracer
+
+# delete_objects accepts at most 1000 keys per request
+MAX_BATCH_SIZE = 1000
+
+
+def iter_delete_batches(s3_client, bucket_name, batch_size=MAX_BATCH_SIZE):
+    """Lazily page through every object version and delete marker, yielding batches of keys"""
+    paginator = s3_client.get_paginator('list_object_versions')
+    batch = []
+    # Unversioned buckets still list their objects here, with VersionId 'null'
+    for page in paginator.paginate(Bucket=bucket_name, PaginationConfig={'PageSize': batch_size}):
+        for item in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            batch.append({'Key': item['Key'], 'VersionId': item['VersionId']})
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def delete_batch(s3_client, bucket_name, batch_number, objects):
+    """Delete one batch of object versions and report its throughput"""
+    started = time.monotonic()
+    try:
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': objects, 'Quiet': True}
+        )
+        errors = response.get('Errors', [])
+    except ClientError as e:
+        errors = [{'Key': obj['Key'], 'Code': e.response['Error']['Code']} for obj in objects]
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    deleted = len(objects) - len(errors)
+    print(f"Batch {batch_number}: deleted {deleted} objects in {elapsed:.2f}s "
+          f"({deleted / elapsed:.0f} objects/s), {len(errors)} errors")
+    for error in errors[:5]:
+        print(f"  Error deleting '{error['Key']}': {error.get('Code')} {error.get('Message', '')}")
+    return deleted, len(errors)
+
+
+def purge_bucket(s3_client, bucket_name, max_workers=8, batch_size=MAX_BATCH_SIZE):
+    """Delete every object version and delete marker in a bucket.
+
+    Listing and deletion are pipelined: at most `max_workers * 2` batches are
+    held in memory at any time, however large the bucket is.
+    """
+    in_flight = threading.BoundedSemaphore(max_workers * 2)
+    lock = threading.Lock()
+    summary = {'batches': 0, 'deleted': 0, 'errors': 0}
+    started = time.monotonic()
+
+    def run_batch(batch_number, objects):
+        try:
+            deleted, errors = delete_batch(s3_client, bucket_name, batch_number, objects)
+        except Exception as e:
+            # A batch that raised something other than a ClientError deleted nothing it can vouch for
+            print(f"Batch {batch_number}: failed with {type(e).__name__}: {e}")
+            deleted, errors = 0, len(objects)
+        finally:
+            in_flight.release()
+        with lock:
+            summary['deleted'] += deleted
+            summary['errors'] += errors
+
+    # Each batch records its own outcome, so no future is kept once its batch is done
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch_number, objects in enumerate(iter_delete_batches(s3_client, bucket_name, batch_size), start=1):
+            # Block the listing until a worker frees up a slot
+            in_flight.acquire()
+            summary['batches'] = batch_number
+            executor.submit(tracer.wrap(run_batch), batch_number, objects)
+
+    summary['seconds'] = round(time.monotonic() - started, 2)
+    print(f"Purged bucket '{bucket_name}': {summary['deleted']} objects in {summary['batches']} batches, "
+          f"{summary['errors']} errors, {summary['seconds']}s")
+    return summary
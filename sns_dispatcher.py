@@ -0,0 +1,143 @@
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# publish_batch accepts at most 10 messages per call
+MAX_BATCH_SIZE = 10
+# SNS rejects subjects longer than 100 characters
+MAX_SUBJECT_LENGTH = 100
+
+
+def summarize(alert):
+    """Turn one aggregated alert into the subject and message that get published"""
+    message = alert['message']
+    if alert['count'] > 1:
+        elapsed = alert['last_seen'] - alert['first_seen']
+        message = f"{message}\n\n({alert['count']} similar alerts for {alert['instance_id']} in the last {elapsed:.0f}s)"
+    return alert['subject'][:MAX_SUBJECT_LENGTH], message
+
+
+class NotificationDispatcher:
+    """Buffer alerts per topic and publish them in batches, coalescing duplicates.
+
+    Alerts with the same (topic, instance, alert type) that arrive within one
+    `window` are merged into a single summary message, and each topic's
+    buffer is sent with publish_batch in chunks of 10. At most `max_pending`
+    distinct alerts are buffered: beyond that `notify` blocks until the next
+    flush, which is started right away. Flushes run one at a time, and
+    close() waits for the background thread's flush before its own.
+    """
+
+    def __init__(self, sns_client, window=1.0, max_pending=500):
+        self.sns_client = sns_client
+        self.window = window
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        # Held for a whole flush, so close() cannot return while a batch is still being published
+        self._flush_lock = threading.Lock()
+        self._closing = False
+        self._buffer = {}  # topic_arn -> {(instance_id, alert_type): alert}
+        self._pending = 0
+        self._thread = None
+        self.stats = {'alerts': 0, 'published': 0, 'batches': 0, 'failed': 0}
+
+    def notify(self, topic_arn, alert_type, instance_id, subject, message):
+        """Queue an alert, merging it with a buffered alert of the same topic, instance and type"""
+        key = (instance_id, alert_type)
+        now = time.monotonic()
+        with self._cond:
+            # Backpressure: wait for a flush instead of growing the buffer without bound
+            while self._pending >= self.max_pending and key not in self._buffer.get(topic_arn, {}):
+                self._wakeup.set()
+                self._cond.wait()
+            alerts = self._buffer.setdefault(topic_arn, {})
+            alert = alerts.get(key)
+            if alert is None:
+                alerts[key] = {
+                    'instance_id': instance_id,
+                    'alert_type': alert_type,
+                    'subject': subject,
+                    'message': message,
+                    'count': 1,
+                    'first_seen': now,
+                    'last_seen': now,
+                }
+                self._pending += 1
+            else:
+                alert['message'] = message
+                alert['count'] += 1
+                alert['last_seen'] = now
+            self.stats['alerts'] += 1
+            if self._thread is None and not self._closing:
+                self._wakeup.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        """Publish everything buffered so far and return how many messages were sent"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._cond:
+            buffer, self._buffer = self._buffer, {}
+            self._pending = 0
+            self._cond.notify_all()
+
+        published = 0
+        for topic_arn, alerts in buffer.items():
+            entries = []
+            for i, alert in enumerate(alerts.values()):
+                subject, message = summarize(alert)
+                entries.append({'Id': str(i), 'Subject': subject, 'Message': message})
+            for start in range(0, len(entries), MAX_BATCH_SIZE):
+                published += self._publish_batch(topic_arn, entries[start:start + MAX_BATCH_SIZE])
+        return published
+
+    def _publish_batch(self, topic_arn, entries):
+        try:
+            response = self.sns_client.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+        except ClientError as e:
+            print(f"Error publishing {len(entries)} notifications to {topic_arn}: {e}")
+            failed = len(entries)
+        else:
+            failed = len(response.get('Failed', []))
+            for failure in response.get('Failed', []):
+                print(f"Notification {failure['Id']} to {topic_arn} failed: {failure.get('Message')}")
+        with self._cond:
+            self.stats['batches'] += 1
+            self.stats['published'] += len(entries) - failed
+            self.stats['failed'] += failed
+        print(f"Sent {len(entries) - failed} notifications to {topic_arn} in one batch.")
+        return len(entries) - failed
+
+    def close(self):
+        """Stop the background thread, wait for its flush, then publish the rest, e.g. before a Lambda invocation returns.
+
+        Returns how many messages the final flush sent. The dispatcher can be
+        used again afterwards: the next alert starts a new background thread.
+        """
+        with self._cond:
+            self._closing = True
+            thread = self._thread
+        self._wakeup.set()
+        if thread:
+            thread.join()
+        try:
+            return self.flush()
+        finally:
+            with self._cond:
+                self._closing = False
+
+    def _run(self):
+        while True:
+            # Flush once per window, or early when a caller is blocked on a full buffer or close() is waiting
+            self._wakeup.wait(self.window)
+            self._wakeup.clear()
+            self.flush()
+            with self._cond:
+                if not self._buffer or self._closing:
+                    self._thread = None
+                    return
@@ -0,0 +1,154 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Where the manifest lives: a local path, or s3://bucket/key. /tmp is the
+# only writable path inside Lambda, the local file also serves as the stand-in
+# for S3 when running tests or scripts on a workstation.
+DEFAULT_MANIFEST_URI = '/tmp/stack_manifest.json'
+
+
+class LocalManifestStore:
+    """Keep the manifest in a local JSON file, replaced atomically on every save"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, data):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file next to the target and rename it over, so a
+        # crash mid-write never leaves a truncated manifest behind
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.manifest-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def __repr__(self):
+        return f"LocalManifestStore({self.path!r})"
+
+
+class S3ManifestStore:
+    """Keep the manifest in an S3 object (a PUT replaces the whole object atomically)"""
+
+    def __init__(self, bucket, key, s3_client=None):
+        self.bucket = bucket
+        self.key = key
+        self._s3_client = s3_client
+
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            from aws_clients import get_client
+            self._s3_client = get_client('s3')
+        return self._s3_client
+
+    def load(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+    def save(self, data):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=json.dumps(data, indent=2, sort_keys=True).encode(),
+            ContentType='application/json'
+        )
+
+    def __repr__(self):
+        return f"S3ManifestStore('s3://{self.bucket}/{self.key}')"
+
+
+def manifest_store_from_uri(uri):
+    """Build a store from a local path or an s3://bucket/key URI"""
+    if uri.startswith('s3://'):
+        bucket, _, key = uri[len('s3://'):].partition('/')
+        return S3ManifestStore(bucket, key or 'stack_manifest.json')
+    return LocalManifestStore(uri)
+
+
+class StackManifest:
+    """Record of every resource the stack created: its ID, ARN and version.
+
+    Entries are keyed by (kind, name), the same keys the inventory uses. The
+    manifest is saved after every change, so it is accurate even when a deploy
+    fails halfway through.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self.data = store.load() or {'revision': 0, 'resources': {}}
+
+    @staticmethod
+    def _key(kind, name):
+        return f"{kind}/{name}"
+
+    def get(self, kind, name):
+        with self._lock:
+            return self.data['resources'].get(self._key(kind, name))
+
+    def record(self, kind, name, resource_id=None, arn=None, version=None, **extra):
+        """Store a resource's identifiers, saving the manifest only if something changed"""
+        entry = {'id': resource_id, 'arn': arn, 'version': version}
+        entry.update(extra)
+        with self._lock:
+            key = self._key(kind, name)
+            current = self.data['resources'].get(key)
+            if current and {k: current.get(k) for k in entry} == entry:
+                return current
+            entry['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            self.data['resources'][key] = dict(current or {}, **entry)
+            self.data['revision'] += 1
+            self.store.save(self.data)
+            return entry
+
+    def remove(self, kind, name):
+        with self._lock:
+            if self.data['resources'].pop(self._key(kind, name), None) is not None:
+                self.data['revision'] += 1
+                self.store.save(self.data)
+
+    def known_ids(self):
+        """Return {kind: {name: entry}} for seeding discovery with direct ID lookups"""
+        with self._lock:
+            known = {}
+            for key, entry in self.data['resources'].items():
+                kind, _, name = key.partition('/')
+                known.setdefault(kind, {})[name] = entry
+            return known
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def load_manifest(uri=None):
+    """Return the shared manifest for a URI (default: $STACK_MANIFEST_URI or /tmp/stack_manifest.json)"""
+    uri = uri or os.environ.get('STACK_MANIFEST_URI', DEFAULT_MANIFEST_URI)
+    with _manifests_lock:
+        if uri not in _manifests:
+            _manifests[uri] = StackManifest(manifest_store_from_uri(uri))
+        return _manifests[uri]
@@ -0,0 +1,51 @@
+# A desired resource is a dict with 'kind', 'name', 'attributes' (settings to
+# compare against the live record), optionally 'state' (the state it should be
+# in) and 'updatable' (attributes that can be changed in place). Anything else
+# that drifts needs the resource to be replaced.
+
+
+def diff_resource(desired, record):
+    """Compare one desired resource with its live record and return a change dict, or None"""
+    change = {'kind': desired['kind'], 'name': desired['name']}
+    if record is None:
+        return dict(change, action='create', drift={})
+
+    actual = record.get('attributes', {})
+    # Attributes we have no live value (e.g. a record written right after a create) or no desired value for
+    # never count as drift
+    drift = {
+        attribute: {'actual': actual[attribute], 'desired': wanted}
+        for attribute, wanted in desired.get('attributes', {}).items()
+        if wanted is not None and actual.get(attribute) is not None and actual[attribute] != wanted
+    }
+    if drift:
+        in_place = set(drift) <= set(desired.get('updatable', ()))
+        return dict(change, action='update' if in_place else 'replace', drift=drift)
+
+    wanted_state = desired.get('state')
+    if wanted_state and record.get('state') and record['state'] != wanted_state:
+        return dict(change, action='start', drift={'state': {'actual': record['state'], 'desired': wanted_state}})
+    return None
+
+
+def build_plan(desired_resources, snapshot):
+    """Diff the desired stack against a snapshot of live state and return the minimal list of changes"""
+    plan = []
+    for desired in desired_resources:
+        change = diff_resource(desired, snapshot.get(desired['kind'], desired['name']))
+        if change:
+            plan.append(change)
+    return plan
+
+
+def format_plan(plan):
+    """Render a plan as one line per change"""
+    if not plan:
+        return ["No changes: the stack matches the desired state."]
+    lines = []
+    for change in plan:
+        details = ", ".join(
+            f"{attribute}: {values['actual']} -> {values['desired']}" for attribute, values in change['drift'].items()
+        )
+        lines.append(f"{change['action']:<8} {change['kind']} '{change['name']}'" + (f" ({details})" if details else ""))
+    return lines
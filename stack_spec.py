@@ -0,0 +1,205 @@
+import json
+from dataclasses import asdict, dataclass, field, fields, replace
+
+from stack_manifest import DEFAULT_MANIFEST_URI
+
+# Load balancer and target group names are limited to 32 characters
+MAX_ELB_NAME_LENGTH = 32
+# States a warm pool can keep its instances in
+WARM_POOL_STATES = ('Stopped', 'Running', 'Hibernated')
+# Tag every resource of a stack carries, with the stack name as its value
+STACK_TAG_KEY = 'WebAppStack'
+
+# Hardcoded email and phone number
+email = 'debkiitian@gmail.com'
+phone_number = '+919731429550'
+
+
+def default_sns_topics():
+    """Multiple SNS Topics, each with the endpoints subscribed to it"""
+    return {
+        "HealthIssuesAlert-deb-sep252": {
+            "email": email,
+            "sms": phone_number
+        },
+        "ScalingEventsAlert-deb-sep252": {
+            "email": email,
+            "sms": phone_number
+        },
+        "HighTrafficAlert-deb-sep25-2": {
+            "email": email,
+            "sms": phone_number
+        }
+    }
+
+
+def warm_pool_label(configuration):
+    """One-line summary of a WarmPoolConfiguration, the same for the desired and the live pool"""
+    if not configuration or configuration.get('Status') == 'PendingDelete':
+        return 'none'
+    max_prepared = configuration.get('MaxGroupPreparedCapacity')
+    reuse = configuration.get('InstanceReusePolicy', {}).get('ReuseOnScaleIn', False)
+    return (f"{configuration['PoolState']}, min {configuration.get('MinSize', 0)}, "
+            f"max prepared {max_prepared if max_prepared not in (None, -1) else 'default'}"
+            f"{', reuse on scale-in' if reuse else ''}")
+
+
+@dataclass(frozen=True)
+class StackSpec:
+    """Everything that differs between two deployments of the web app stack.
+
+    The defaults are the original single stack. `account` only groups stacks
+    for the fan-out concurrency cap; the credentials come from `profile_name`
+    (or the environment when it is None) and the region from `region`.
+    """
+
+    name: str = 'default'
+    account: str = 'default'
+    profile_name: str = None
+    region: str = None
+    key_name: str = 'deb-key-pair-sept25'
+    instance_type: str = 't2.micro'
+    ami_id: str = 'ami-08d8ac128e0a1b91c'
+    vpc_id: str = 'vpc-03d760fe88b18680f'
+    subnet_ids: tuple = ('subnet-0fd07baca9b6e64fa', 'subnet-1fd07baca9b6e64fb')  # Subnets in different AZs
+    security_group_id: str = 'sg-0ae83dc5b0560641b'
+    instance_name: str = 'MyAppInstance'
+    bucket_name: str = 'your-webapp-static-files-deb-sep251'
+    alb_name: str = 'deb-alb-sep25'
+    target_group_name: str = 'Deb-target-group-sep25'
+    auto_scaling_group_name: str = 'Deb-auto-scaling-group-sep25'
+    launch_template_name: str = 'Deb-launch-template-sep25'
+    alarm_name: str = 'HighCPUUtilization-deb-sept25'
+    alarm_threshold: float = 80.0
+    alarm_period: int = 300
+    asg_min_size: int = 1
+    asg_max_size: int = 3
+    asg_desired_capacity: int = 1
+    health_check_path: str = '/'
+    # Rolling AMI updates: capacity kept in service, seconds before a new instance counts, instances replaced at once
+    refresh_min_healthy_percentage: int = 100
+    refresh_instance_warmup: int = 300
+    refresh_batch_size: int = 1
+    # Seconds to watch a refresh, below Lambda's 15 minute limit; a longer refresh keeps running on its own
+    refresh_timeout: int = 840
+    # Warm pool of instances that already ran their user data, None for no pool.
+    # Without a max prepared capacity the pool holds MaxSize - DesiredCapacity instances (at least the min size).
+    warm_pool_state: str = None
+    warm_pool_min_size: int = 0
+    warm_pool_max_prepared_capacity: int = None
+    warm_pool_reuse_on_scale_in: bool = False
+    # Boot instances from an image with the web server baked in (see image_bake.py) instead of installing it
+    bake_image: bool = False
+    lambda_function_arn: str = 'arn:aws:lambda:us-west-2:975050024946:function:create_s3_deb_sept25'
+    sns_topics: dict = field(default_factory=default_sns_topics)
+    manifest_uri: str = None
+
+    def __post_init__(self):
+        for attribute in ('alb_name', 'target_group_name'):
+            if len(getattr(self, attribute)) > MAX_ELB_NAME_LENGTH:
+                raise ValueError(f"{attribute} '{getattr(self, attribute)}' is longer than {MAX_ELB_NAME_LENGTH} characters")
+        if self.warm_pool_state not in (None,) + WARM_POOL_STATES:
+            raise ValueError(f"warm_pool_state must be one of {WARM_POOL_STATES} or None, got '{self.warm_pool_state}'")
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a spec from a JSON-style dict, e.g. the 'stack' entry of a Lambda event"""
+        known = {f.name for f in fields(cls)}
+        unknown = set(data) - known
+        if unknown:
+            raise ValueError(f"Unknown stack spec fields: {sorted(unknown)}")
+        data = dict(data)
+        if 'subnet_ids' in data:
+            data['subnet_ids'] = tuple(data['subnet_ids'])
+        return cls(**data)
+
+    def to_dict(self):
+        return asdict(self)
+
+    def key(self):
+        """String that identifies this exact spec, used to cache per-stack state"""
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def scope(self):
+        """Where the stack lives: stacks with the same names in different regions or accounts do not clash"""
+        return self.account, self.profile_name, self.region, self.name
+
+    def names(self):
+        """Resource names of this stack, keyed by inventory kind"""
+        return {
+            'instance': self.instance_name,
+            'load_balancer': self.alb_name,
+            'target_group': self.target_group_name,
+            'launch_template': self.launch_template_name,
+            'auto_scaling_group': self.auto_scaling_group_name,
+            'bucket': self.bucket_name,
+            'alarm': self.alarm_name,
+            'sns_topics': tuple(self.sns_topics),
+            'stack_tag': self.name,
+        }
+
+    def stack_tag(self):
+        """The tag every resource of the stack carries, as {key: value}"""
+        return {STACK_TAG_KEY: self.name}
+
+    def stack_tags(self):
+        """The stack tag in the [{'Key': ..., 'Value': ...}] form create calls take"""
+        return [{'Key': key, 'Value': value} for key, value in self.stack_tag().items()]
+
+    def warm_pool_configuration(self):
+        """put_warm_pool arguments (without the group name) for this stack, or None for no warm pool"""
+        if self.warm_pool_state is None:
+            return None
+        configuration = {
+            'MinSize': self.warm_pool_min_size,
+            'PoolState': self.warm_pool_state,
+            'InstanceReusePolicy': {'ReuseOnScaleIn': self.warm_pool_reuse_on_scale_in},
+        }
+        if self.warm_pool_max_prepared_capacity is not None:
+            configuration['MaxGroupPreparedCapacity'] = self.warm_pool_max_prepared_capacity
+        return configuration
+
+    def manifest_location(self):
+        """The default stack keeps the original manifest, every other stack gets its own file"""
+        if self.manifest_uri or self.name == 'default':
+            return self.manifest_uri
+        base, _, extension = DEFAULT_MANIFEST_URI.rpartition('.')
+        return f"{base}-{self.name}-{self.region or 'default'}.{extension}"
+
+    def for_environment(self, environment, **overrides):
+        """A copy of this stack for another environment, with every resource name suffixed.
+
+        Bucket names are global and lowercase, so the suffix is lowercased there,
+        and load balancer names are shortened to keep the whole suffix.
+        """
+        suffix = f"-{environment}"
+
+        def elb_name(name):
+            return name[:MAX_ELB_NAME_LENGTH - len(suffix)].rstrip('-') + suffix
+
+        renamed = {
+            'name': environment,
+            'instance_name': self.instance_name + suffix,
+            'bucket_name': (self.bucket_name + suffix).lower(),
+            'alb_name': elb_name(self.alb_name),
+            'target_group_name': elb_name(self.target_group_name),
+            'auto_scaling_group_name': self.auto_scaling_group_name + suffix,
+            'launch_template_name': self.launch_template_name + suffix,
+            'alarm_name': self.alarm_name + suffix,
+            'sns_topics': {topic + suffix: endpoints for topic, endpoints in self.sns_topics.items()},
+        }
+        renamed.update(overrides)
+        if 'subnet_ids' in renamed:
+            renamed['subnet_ids'] = tuple(renamed['subnet_ids'])
+        return replace(self, **renamed)
+
+
+def load_specs(path):
+    """Read stack specs from a JSON file: a list of spec dicts, or {'base': {...}, 'environments': {name: overrides}}"""
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return [StackSpec.from_dict(entry) for entry in data]
+    base = StackSpec.from_dict(data.get('base', {}))
+    return [base.for_environment(environment, **overrides)
+            for environment, overrides in data['environments'].items()]
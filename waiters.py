@@ -0,0 +1,321 @@
+import threading
+import time
+
+from instrumentation import tracer
+
+
+# Each poll function takes the clients dict and every pending (kind, resource_id)
+# pair for its service, makes one batched describe call per tick and returns a
+# dict of resolved key -> None on success or an exception if the resource
+# reached a state it can never leave.
+
+def poll_images(clients, pending):
+    """Resolve image_available conditions with one describe_images call"""
+    image_ids = sorted({image_id for _, image_id in pending})
+    states = {}
+    # Filtering, unlike ImageIds=, does not fail on an image that is not visible yet
+    response = clients['ec2'].describe_images(Filters=[{'Name': 'image-id', 'Values': image_ids}])
+    for image in response['Images']:
+        states[image['ImageId']] = (image['State'], image.get('StateReason', {}).get('Message'))
+
+    resolved = {}
+    for kind, image_id in pending:
+        state, reason = states.get(image_id, (None, None))
+        if state == 'available':
+            resolved[(kind, image_id)] = None
+        elif state in ('failed', 'invalid', 'deregistered', 'error'):
+            resolved[(kind, image_id)] = RuntimeError(f"Image {image_id} is {state}: {reason or 'no reason given'}")
+    return resolved
+
+
+def poll_ec2(clients, pending):
+    """Resolve instance_running, instance_stopped, instance_terminated and image_available conditions"""
+    images = [(kind, resource_id) for kind, resource_id in pending if kind == 'image_available']
+    pending = [(kind, resource_id) for kind, resource_id in pending if kind != 'image_available']
+    resolved = poll_images(clients, images) if images else {}
+    if not pending:
+        return resolved
+
+    instance_ids = sorted({resource_id for _, resource_id in pending})
+    states = {}
+    # Filtering by instance-id, unlike InstanceIds=, does not fail on IDs that are
+    # not visible yet (just launched) or any more (long terminated)
+    paginator = clients['ec2'].get_paginator('describe_instances')
+    for i in range(0, len(instance_ids), 200):
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': instance_ids[i:i + 200]}]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    states[instance['InstanceId']] = instance['State']['Name']
+
+    for kind, instance_id in pending:
+        state = states.get(instance_id)
+        if kind == 'instance_running':
+            if state == 'running':
+                resolved[(kind, instance_id)] = None
+            elif state in ('shutting-down', 'terminated', 'stopping', 'stopped'):
+                resolved[(kind, instance_id)] = RuntimeError(f"Instance {instance_id} is {state}, it will not start")
+        elif kind == 'instance_stopped':
+            if state == 'stopped':
+                resolved[(kind, instance_id)] = None
+            elif state in ('shutting-down', 'terminated'):
+                resolved[(kind, instance_id)] = RuntimeError(f"Instance {instance_id} is {state}")
+        elif kind == 'instance_terminated':
+            if state in ('terminated', None):
+                resolved[(kind, instance_id)] = None
+    return resolved
+
+
+def poll_elbv2(clients, pending):
+    """Resolve load_balancer_active, load_balancer_deleted and target_healthy conditions"""
+    resolved = {}
+    lb_pending = [(kind, arn) for kind, arn in pending if kind.startswith('load_balancer_')]
+    if lb_pending:
+        # Describing by ARN fails as soon as one of them is gone, so list them all once
+        states = {}
+        paginator = clients['elbv2'].get_paginator('describe_load_balancers')
+        for page in paginator.paginate():
+            states.update({lb['LoadBalancerArn']: lb['State']['Code'] for lb in page['LoadBalancers']})
+        for kind, arn in lb_pending:
+            state = states.get(arn)
+            if kind == 'load_balancer_deleted' and state is None:
+                resolved[(kind, arn)] = None
+            elif kind == 'load_balancer_active':
+                if state == 'active':
+                    resolved[(kind, arn)] = None
+                elif state in (None, 'failed'):
+                    resolved[(kind, arn)] = RuntimeError(f"Load balancer {arn} is {state or 'gone'}")
+
+    # Target health is per target group: one call covers every pending target in it
+    by_target_group = {}
+    for kind, (target_group_arn, instance_id) in [(k, r) for k, r in pending if k == 'target_healthy']:
+        by_target_group.setdefault(target_group_arn, []).append(instance_id)
+    for target_group_arn, instance_ids in by_target_group.items():
+        response = clients['elbv2'].describe_target_health(TargetGroupArn=target_group_arn)
+        health = {
+            target['Target']['Id']: target['TargetHealth']['State']
+            for target in response['TargetHealthDescriptions']
+        }
+        for instance_id in instance_ids:
+            if health.get(instance_id) == 'healthy':
+                resolved[('target_healthy', (target_group_arn, instance_id))] = None
+    return resolved
+
+
+# Instance refresh states it never leaves
+REFRESH_DONE = {'Successful', 'Failed', 'Cancelled', 'RollbackSuccessful', 'RollbackFailed'}
+# The final state each refresh condition waits for
+REFRESH_SUCCESS = {'instance_refresh_done': 'Successful', 'instance_refresh_rolled_back': 'RollbackSuccessful'}
+
+
+def poll_instance_refreshes(clients, pending):
+    """Resolve instance_refresh_done and instance_refresh_rolled_back conditions, one describe call per group"""
+    by_group = {}
+    for _, (asg_name, refresh_id) in pending:
+        by_group.setdefault(asg_name, set()).add(refresh_id)
+    resolved = {}
+    for asg_name, refresh_ids in by_group.items():
+        response = clients['autoscaling'].describe_instance_refreshes(
+            AutoScalingGroupName=asg_name, InstanceRefreshIds=sorted(refresh_ids)
+        )
+        for refresh in response['InstanceRefreshes']:
+            status = refresh['Status']
+            print(f"Instance refresh {refresh['InstanceRefreshId']} of '{asg_name}': {status}, "
+                  f"{refresh.get('PercentageComplete', 0)}% complete, "
+                  f"{refresh.get('InstancesToUpdate', 0)} instances to update.")
+            if status not in REFRESH_DONE:
+                continue
+            for kind, wanted in REFRESH_SUCCESS.items():
+                key = (kind, (asg_name, refresh['InstanceRefreshId']))
+                if key in pending:
+                    resolved[key] = None if status == wanted else RuntimeError(
+                        f"Instance refresh {refresh['InstanceRefreshId']} of '{asg_name}' ended {status}: "
+                        f"{refresh.get('StatusReason', 'no reason given')}"
+                    )
+    return resolved
+
+
+def poll_autoscaling(clients, pending):
+    """Resolve auto_scaling_group_in_service, auto_scaling_group_deleted and instance refresh conditions"""
+    refreshes = [(kind, resource_id) for kind, resource_id in pending if kind in REFRESH_SUCCESS]
+    pending = [(kind, resource_id) for kind, resource_id in pending if kind not in REFRESH_SUCCESS]
+    resolved = poll_instance_refreshes(clients, refreshes) if refreshes else {}
+    if not pending:
+        return resolved
+
+    names = sorted({name for _, name in pending})
+    groups = {}
+    # describe_auto_scaling_groups accepts at most 50 names per call
+    for i in range(0, len(names), 50):
+        response = clients['autoscaling'].describe_auto_scaling_groups(AutoScalingGroupNames=names[i:i + 50])
+        groups.update({asg['AutoScalingGroupName']: asg for asg in response['AutoScalingGroups']})
+
+    for kind, name in pending:
+        asg = groups.get(name)
+        if kind == 'auto_scaling_group_deleted' and asg is None:
+            resolved[(kind, name)] = None
+        elif kind == 'auto_scaling_group_in_service':
+            if asg is None:
+                resolved[(kind, name)] = RuntimeError(f"Auto Scaling Group {name} does not exist")
+                continue
+            in_service = [i for i in asg['Instances'] if i['LifecycleState'] == 'InService']
+            if len(in_service) >= asg['DesiredCapacity']:
+                resolved[(kind, name)] = None
+    return resolved
+
+
+POLLERS = {
+    'ec2': poll_ec2,
+    'elbv2': poll_elbv2,
+    'autoscaling': poll_autoscaling,
+}
+
+# Wait condition -> service whose poll function resolves it
+CONDITIONS = {
+    'instance_running': 'ec2',
+    'instance_stopped': 'ec2',
+    'instance_terminated': 'ec2',
+    'image_available': 'ec2',
+    'load_balancer_active': 'elbv2',
+    'load_balancer_deleted': 'elbv2',
+    'target_healthy': 'elbv2',
+    'auto_scaling_group_in_service': 'autoscaling',
+    'auto_scaling_group_deleted': 'autoscaling',
+    'instance_refresh_done': 'autoscaling',
+    'instance_refresh_rolled_back': 'autoscaling',
+}
+
+
+class WaiterMultiplexer:
+    """Wait on many pending conditions across services through one shared polling loop.
+
+    Callers register a (condition, resource ID) pair and block until it
+    resolves. A single background thread makes one batched describe call per
+    service on every tick, so N concurrent waits cost the same API calls as
+    one. The tick interval starts at `min_delay`, grows by `backoff` while
+    nothing changes and drops back as soon as a condition resolves or a new
+    one is added. A failing poll is retried until the condition times out;
+    if the loop itself dies, every pending wait fails instead of hanging.
+    """
+
+    def __init__(self, clients, min_delay=2, max_delay=30, backoff=1.5, timeout=900):
+        self.clients = clients
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}  # (kind, resource_id) -> {'event', 'error', 'deadline'}
+        self._thread = None
+
+    def watch(self, kind, resource_id, timeout=None):
+        """Start tracking a condition and return its pending entry"""
+        if kind not in CONDITIONS:
+            raise ValueError(f"Unknown wait condition '{kind}'")
+        with self._lock:
+            entry = self._pending.get((kind, resource_id))
+            if entry is None:
+                entry = {
+                    'event': threading.Event(),
+                    'error': None,
+                    'deadline': time.monotonic() + (timeout or self.timeout),
+                }
+                self._pending[(kind, resource_id)] = entry
+                self._wakeup.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return entry
+
+    def wait(self, kind, resource_id, timeout=None):
+        """Block until the resource reaches the requested condition, or `timeout` seconds (the default timeout) pass"""
+        entry = self.watch(kind, resource_id, timeout)
+        with tracer.span(f"wait:{kind}"):
+            self._await((kind, resource_id), entry)
+        if entry['error']:
+            raise entry['error']
+
+    def wait_all(self, conditions):
+        """Block until every (kind, resource_id) pair resolves, raising the first error"""
+        entries = [((kind, resource_id), self.watch(kind, resource_id)) for kind, resource_id in conditions]
+        kinds = sorted({kind for kind, _ in conditions})
+        with tracer.span(f"wait:{'+'.join(kinds)}"):
+            for key, entry in entries:
+                self._await(key, entry)
+        for _, entry in entries:
+            if entry['error']:
+                raise entry['error']
+
+    def _await(self, key, entry):
+        """Block until the entry resolves, timing it out here if the polling loop has not by its deadline"""
+        if not entry['event'].wait(max(0, entry['deadline'] - time.monotonic())):
+            self._resolve(key, self._timeout_error(key, entry))
+            entry['event'].wait()
+
+    @staticmethod
+    def _timeout_error(key, entry):
+        last_error = entry.get('last_error')
+        return TimeoutError(f"Timed out waiting for {key[0]} on {key[1]}"
+                            f"{f' (last polling error: {last_error})' if last_error else ''}")
+
+    def _run(self):
+        idle = False
+        try:
+            self._poll_until_idle()
+            idle = True
+        finally:
+            if not idle:
+                # Fail whatever is pending rather than leave its waiters blocked
+                with self._lock:
+                    self._thread = None
+                    stranded = list(self._pending)
+                for key in stranded:
+                    self._resolve(key, RuntimeError(f"Waiter polling loop stopped while waiting for {key[0]} on {key[1]}"))
+
+    def _poll_until_idle(self):
+        delay = self.min_delay
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._wakeup.clear()
+                by_service = {}
+                for kind, resource_id in self._pending:
+                    by_service.setdefault(CONDITIONS[kind], []).append((kind, resource_id))
+
+            progressed = False
+            for service, pending in by_service.items():
+                try:
+                    with tracer.span(f"poll:{service}"):
+                        resolved = POLLERS[service](self.clients, pending)
+                except Exception as e:
+                    # Connection errors, throttling past botocore's retries or an odd response:
+                    # poll again on the next tick, and report the error if the wait times out
+                    print(f"Error polling {service} for {len(pending)} pending conditions: {e}")
+                    with self._lock:
+                        for key in pending:
+                            if key in self._pending:
+                                self._pending[key]['last_error'] = e
+                    resolved = {}
+                for key, error in resolved.items():
+                    progressed = True
+                    self._resolve(key, error)
+
+            now = time.monotonic()
+            with self._lock:
+                expired = [(key, entry) for key, entry in self._pending.items() if entry['deadline'] < now]
+            for key, entry in expired:
+                self._resolve(key, self._timeout_error(key, entry))
+
+            delay = self.min_delay if progressed else min(delay * self.backoff, self.max_delay)
+            # A newly added condition cuts the sleep short and resets the backoff
+            if self._wakeup.wait(delay):
+                delay = self.min_delay
+
+    def _resolve(self, key, error=None):
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        if entry:
+            entry['error'] = error
+            entry['event'].set()